@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+人格切换插件 - 基准测试脚本（独立运行，不随插件加载）
+
+用法：
+    python benchmarks/bench_plugin.py switch [--rounds 轮数]
+    python benchmarks/bench_plugin.py semantic_cache --db 数据库文件 [--rounds 最近消息条数] [--scene 场景] [--mood 情绪]
+    python benchmarks/bench_plugin.py persona [--config 配置文件] [--rounds 轮数]
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from types import MappingProxyType
+from typing import Any, Dict, List, Optional, Tuple
+
+import toml
+
+# 只导入plugin模块中的类和函数，不实例化插件
+os.environ.setdefault("PERSONALITY_SWITCH_NO_AUTOLOAD", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plugin import (  # noqa: E402
+    DatabaseManager, PREFERENCE_INCREMENT, PERSONA_RELATIONSHIP_UPSERT, PERSONA_GROWTH_UPSERT, OPERATION_LOG_INSERT,
+    MessageClassifier, SemanticReplyCache, normalize_message, semantic_cache_scope,
+    compile_personas, compose_system_prompt, resolve_scene_config
+)
+
+# 允许的最大轮数（避免构造过大的用例列表）
+MAX_ROUNDS = 100000
+
+
+# 人格切换写入基准测试：逐条提交 vs 单事务（在临时SQLite文件上运行，不影响业务数据）
+def benchmark_persona_switch(rounds: int = 200, pragmas: Optional[List[str]] = None) -> Dict[str, float]:
+    schema = [
+        "CREATE TABLE persona_relationships (persona1 TEXT NOT NULL, persona2 TEXT NOT NULL, level INTEGER DEFAULT 1, interact_count INTEGER DEFAULT 0, PRIMARY KEY (persona1, persona2))",
+        "CREATE TABLE persona_growth (persona_name TEXT PRIMARY KEY, interact_count INTEGER DEFAULT 0, unlocked TEXT DEFAULT '[]')",
+        "CREATE TABLE persona_switch (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, time TEXT NOT NULL, persona_name TEXT NOT NULL, trigger_type TEXT NOT NULL)",
+        "CREATE TABLE persona_stats (persona_name TEXT PRIMARY KEY, switch_count INTEGER DEFAULT 0)",
+        "CREATE TABLE user_preference (user_id TEXT PRIMARY KEY, preference_json TEXT NOT NULL)",
+        "CREATE TABLE user_persona_preference (user_id TEXT NOT NULL, persona_name TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, persona_name))",
+        "CREATE TABLE operation_log (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, operation TEXT NOT NULL, time TEXT NOT NULL, result TEXT NOT NULL)"
+    ]
+    personas = ["p0", "p1", "p2", "p3"]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ("per_statement", "single_transaction"):
+            conn = sqlite3.connect(os.path.join(tmp_dir, f"{mode}.db"))
+            for pragma in pragmas or []:
+                conn.execute(pragma)
+            for sql in schema:
+                conn.execute(sql)
+            conn.commit()
+            cursor = conn.cursor()
+            start = time.perf_counter()
+            for i in range(rounds):
+                old, new = personas[i % 4], personas[(i + 1) % 4]
+                user_id = f"user{i % 10}"
+                time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+                preference_json = json.dumps({new: i})
+                if mode == "per_statement":
+                    # 原切换路径：关系、成长、切换记录+活跃度、偏好（先读后写）、操作日志各自提交
+                    cursor.execute("REPLACE INTO persona_relationships VALUES (?, ?, ?, ?)", (old, new, 1, i))
+                    conn.commit()
+                    cursor.execute("REPLACE INTO persona_growth VALUES (?, ?, ?)", (new, i, "[]"))
+                    conn.commit()
+                    cursor.execute("INSERT INTO persona_switch (user_id, time, persona_name, trigger_type) VALUES (?, ?, ?, ?)", (user_id, time_str, new, "manual"))
+                    cursor.execute("UPDATE persona_stats SET switch_count = switch_count + 1 WHERE persona_name = ?", (new,))
+                    conn.commit()
+                    cursor.execute("SELECT preference_json FROM user_preference WHERE user_id = ?", (user_id,))
+                    cursor.fetchone()
+                    cursor.execute("REPLACE INTO user_preference VALUES (?, ?)", (user_id, preference_json))
+                    conn.commit()
+                    cursor.execute("INSERT INTO operation_log (user_id, operation, time, result) VALUES (?, ?, ?, ?)", (user_id, "switch_persona", time_str, new))
+                    conn.commit()
+                else:
+                    for sql, params in DatabaseManager.persona_switch_statements(user_id, time_str, new, "manual") + [
+                        (PREFERENCE_INCREMENT, (user_id, new)),
+                        (PERSONA_RELATIONSHIP_UPSERT, (old, new, 1, i)),
+                        (PERSONA_GROWTH_UPSERT, (new, i, "[]")),
+                        (OPERATION_LOG_INSERT, (user_id, "switch_persona", time_str, new))
+                    ]:
+                        cursor.execute(sql, params)
+                    conn.commit()
+            results[mode] = (time.perf_counter() - start) * 1000 / rounds
+            conn.close()
+    return {
+        "rounds": rounds,
+        "per_statement_ms": round(results["per_statement"], 3),
+        "single_transaction_ms": round(results["single_transaction"], 3),
+        "speedup": round(results["per_statement"] / results["single_transaction"], 2) if results["single_transaction"] else None
+    }
+
+
+def benchmark_semantic_cache(records: List[Tuple[str, str, str, str, str]], classifier: MessageClassifier,
+                             semantic_config: Dict[str, Any]) -> Dict[str, Any]:
+    """用历史消息回放评估语义缓存：按时间顺序逐条查询，未命中则写入
+
+    records为(user_id, persona_name, content, scene, mood)，隔离范围与插件相同（semantic_cache_scope）；
+    同时统计归一化后完全相同（精确缓存可命中）的比例作对照
+    """
+    cache = SemanticReplyCache(
+        threshold=semantic_config.get("threshold", 0.6),
+        bands=semantic_config.get("bands", 16),
+        rows=semantic_config.get("rows", 2),
+        max_entries=max(len(records), 1)
+    )
+    share_across_users = semantic_config.get("share_across_users", False)
+    exact_seen = set()
+    exact_hits = 0
+    for user_id, persona_name, content, scene, mood in records:
+        features = classifier.classify(content)
+        scope = semantic_cache_scope(user_id, features, persona_name, scene, mood, share_across_users)
+        exact_key = (scope, normalize_message(content))
+        if exact_key in exact_seen:
+            exact_hits += 1
+        exact_seen.add(exact_key)
+        if cache.get(scope, content) is None:
+            cache.set(scope, content, content)
+    stats = cache.stats()
+    return {
+        "messages": len(records),
+        "hit_rate": stats["hit_rate"],
+        "exact_hit_rate": round(exact_hits / len(records), 3) if records else None,
+        "avg_candidates": stats["avg_candidates"],
+        "lookup_p50_ms": stats["lookup_p50_ms"],
+        "lookup_p99_ms": stats["lookup_p99_ms"],
+        "entries": stats["entries"]
+    }
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """对象及其引用的容器/字符串的总内存（字节，同一对象只计一次）"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (dict, MappingProxyType)):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_sizeof(getattr(obj, field), seen) for field in obj.__slots__ if hasattr(obj, field))
+    return size
+
+
+def dict_system_prompt(persona: Dict[str, Any], scene: str, mood: str, scene_specific: bool = True) -> str:
+    """编译前的热路径：每条消息从人格配置字典查场景/情绪风格再拼接系统提示词"""
+    scene_style = resolve_scene_config(persona, scene, scene_specific)["reply_style"]
+    mood_style = persona.get("mood_reply_style", {}).get(mood, scene_style)
+    return compose_system_prompt(persona["personality_desc"], scene, scene_style, mood, mood_style, persona.get("watermark", ""))
+
+
+def benchmark_compiled_personas(personalities: Dict[str, Any], scene_config: Dict[str, Any],
+                                rounds: int = 10000) -> Dict[str, Any]:
+    """对比字典版和编译版人格在消息处理热路径上的查找耗时与内存占用"""
+    scene_specific = scene_config.get("scene_specific_config", True)
+    compiled = compile_personas(personalities, scene_config)
+    names = list(compiled)
+    scenes = list(scene_config.get("default_scenes", {}).keys()) or ["general"]
+    if not names:
+        return {"rounds": 0}
+    cases = [(names[i % len(names)], scenes[i % len(scenes)]) for i in range(rounds)]
+    cases = [(name, scene, compiled[name].moods[i % len(compiled[name].moods)]) for i, (name, scene) in enumerate(cases)]
+
+    start = time.perf_counter()
+    for name, scene, mood in cases:
+        dict_system_prompt(personalities[name], scene, mood, scene_specific)
+    dict_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for name, scene, mood in cases:
+        compiled[name].system_prompt(scene, mood)
+    compiled_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "rounds": rounds,
+        "personas": len(compiled),
+        "dict_us": round(dict_ms * 1000 / rounds, 3),
+        "compiled_us": round(compiled_ms * 1000 / rounds, 3),
+        "speedup": round(dict_ms / compiled_ms, 1) if compiled_ms else None,
+        "dict_kb": round(deep_sizeof(personalities) / 1024, 1),
+        "compiled_kb": round(deep_sizeof(compiled) / 1024, 1)
+    }
+
+
+def load_conversation_records(db_path: str, limit: int, scene: str = "general", mood: str = "平静") -> List[Tuple[str, str, str, str, str]]:
+    """从插件数据库读取最近limit条对话（按时间正序），只读打开不影响业务数据
+
+    对话表不记录场景和情绪，回放时统一使用scene/mood
+    """
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT user_id, persona_name, content FROM user_conversation ORDER BY id DESC LIMIT ?", (limit,)
+        ).fetchall()[::-1]
+        return [(user_id, persona_name, content, scene, mood) for user_id, persona_name, content in rows]
+    finally:
+        conn.close()
+
+
+def _rounds(value: str) -> int:
+    rounds = int(value)
+    if not 1 <= rounds <= MAX_ROUNDS:
+        raise argparse.ArgumentTypeError(f"轮数需在1~{MAX_ROUNDS}之间")
+    return rounds
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="人格切换插件基准测试")
+    parser.add_argument("target", choices=["switch", "semantic_cache", "persona"], help="测试项目")
+    parser.add_argument("--rounds", type=_rounds, default=200, help=f"轮数（1~{MAX_ROUNDS}）")
+    parser.add_argument("--pragma", action="append", default=[],
+                        help="switch：建表前执行的PRAGMA语句（可多次指定，如 \"PRAGMA journal_mode = WAL\"）")
+    parser.add_argument("--db", help="semantic_cache：回放的插件SQLite数据库文件")
+    parser.add_argument("--threshold", type=float, default=0.6, help="semantic_cache：相似度阈值（同[cache.semantic]）")
+    parser.add_argument("--share-across-users", action="store_true", help="semantic_cache：跨用户复用")
+    parser.add_argument("--scene", default="general", help="semantic_cache：回放使用的场景（对话表不记录场景）")
+    parser.add_argument("--mood", default="平静", help="semantic_cache：回放使用的情绪（对话表不记录情绪）")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.toml"),
+                        help="persona：读取[personalities]和[scene]的配置文件（默认插件目录下的config.toml）")
+    args = parser.parse_args(argv)
+    if args.target == "switch":
+        result = benchmark_persona_switch(args.rounds, args.pragma)
+        print(
+            f"📊 人格切换写入基准（{result['rounds']}次）\n"
+            f"逐条提交：{result['per_statement_ms']}ms/次\n"
+            f"单事务：{result['single_transaction_ms']}ms/次\n"
+            f"提升：{result['speedup']}倍"
+        )
+    elif args.target == "semantic_cache":
+        if not args.db:
+            parser.error("semantic_cache需要--db指定数据库文件")
+        records = load_conversation_records(args.db, args.rounds, args.scene, args.mood)
+        semantic_config = {"threshold": args.threshold, "share_across_users": args.share_across_users}
+        result = benchmark_semantic_cache(records, MessageClassifier(), semantic_config)
+        print(
+            f"📊 语义缓存回放（最近{result['messages']}条消息）\n"
+            f"语义命中率：{result['hit_rate']}（归一化精确命中率：{result['exact_hit_rate']}）\n"
+            f"平均候选数：{result['avg_candidates']}\n"
+            f"查询耗时：p50 {result['lookup_p50_ms']}ms / p99 {result['lookup_p99_ms']}ms"
+        )
+    elif args.target == "persona":
+        try:
+            with open(args.config, "r", encoding="utf-8") as f:
+                config = toml.load(f)
+        except (OSError, toml.TomlDecodeError) as e:
+            parser.error(f"读取配置文件失败：{str(e)}")
+        result = benchmark_compiled_personas(config.get("personalities", {}), config.get("scene", {}), args.rounds)
+        print(
+            f"📊 人格查找基准（{result['rounds']}次，{result.get('personas', 0)}个人格）\n"
+            f"字典查找+拼接：{result.get('dict_us')}μs/次\n"
+            f"编译后人格：{result.get('compiled_us')}μs/次（提升{result.get('speedup')}倍）\n"
+            f"内存：字典{result.get('dict_kb')}KB / 编译后{result.get('compiled_kb')}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -44,6 +44,10 @@ import time
 import random
 import asyncio
 import logging
+import threading
+import atexit
+import tempfile
+from typing import Dict, Optional, Any
 logger = logging.getLogger("personality_switch_plugin")
 
 # 根据提供的路径定位botconfig
@@ -88,127 +92,249 @@ class YourPlugin:
         current_mode = self.persona_config["user_custom"].get(user_id, self.persona_config["global"]["default_mode"])
         return f"人格切换成功！当前模式：{current_mode}"
 
-def switch_global_personality(personality_name):
-    """切换全局人格（覆盖botconfig）- 修复版"""
-    # 在函数开头声明全局变量
+def resolve_bot_config_path() -> Optional[str]:
+    """定位botconfig.toml（找到后更新BOT_CONFIG_PATH，只需在首次使用时调用）"""
     global BOT_CONFIG_PATH
-    
-    try:
-        # 验证路径是否存在
-        if not os.path.exists(BOT_CONFIG_PATH):
-            # 尝试其他可能的路径
-            alt_paths = [
-                r"F:\QQRobot\00DMMaibot\LL\MaiBot\config\bot_config.toml",
-                os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "bot_config.toml"),
-                os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config", "bot_config.toml"),
-                os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))), "config", "bot_config.toml"),
+    if os.path.exists(BOT_CONFIG_PATH):
+        return BOT_CONFIG_PATH
+    # 尝试其他可能的路径
+    alt_paths = [
+        r"F:\QQRobot\00DMMaibot\LL\MaiBot\config\bot_config.toml",
+        os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "bot_config.toml"),
+        os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "config", "bot_config.toml"),
+        os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))), "config", "bot_config.toml"),
+    ]
+    for path in alt_paths:
+        if os.path.exists(path):
+            BOT_CONFIG_PATH = path
+            logger.info(f"找到botconfig.toml: {path}")
+            return path
+    logger.error(f"找不到botconfig.toml文件，请检查路径")
+    return None
+
+
+def apply_personality_to_config(bot_config: dict, personality_name: str) -> bool:
+    """把人格名写入botconfig中的人格相关字段，返回配置内容是否发生变化"""
+    changed = False
+
+    # 深度搜索并修改人格配置
+    def deep_update_config(config, path=""):
+        nonlocal changed
+        modified = False
+
+        if isinstance(config, dict):
+            # 检查常见的人格配置字段
+            personality_fields = [
+                "personality", "default_personality", "master", "default", 
+                "current_persona", "active_personality", "current_personality"
             ]
-            
-            for path in alt_paths:
-                if os.path.exists(path):
-                    BOT_CONFIG_PATH = path
-                    logger.info(f"找到botconfig.toml: {path}")
-                    break
-            else:
-                logger.error(f"找不到botconfig.toml文件，请检查路径")
-                return False
-        
-        logger.info(f"开始修改botconfig.toml: {BOT_CONFIG_PATH}")
-        
-        # 读取原有配置
-        with open(BOT_CONFIG_PATH, 'r', encoding='utf-8') as f:
-            bot_config = toml.load(f)
-        
-        # 备份原配置
-        backup_path = BOT_CONFIG_PATH + ".bak"
-        with open(backup_path, 'w', encoding='utf-8') as f:
-            toml.dump(bot_config, f)
-        logger.info(f"备份原配置到: {backup_path}")
-        
-        # 深度搜索并修改人格配置
-        def deep_update_config(config, path=""):
-            modified = False
-            
-            if isinstance(config, dict):
-                # 检查常见的人格配置字段
-                personality_fields = [
-                    "personality", "default_personality", "master", "default", 
-                    "current_persona", "active_personality", "current_personality"
-                ]
-                
-                for field in personality_fields:
-                    if field in config:
-                        old_value = config[field]
+
+            for field in personality_fields:
+                if field in config:
+                    old_value = config[field]
+                    if old_value != personality_name:
                         config[field] = personality_name
+                        changed = True
                         logger.info(f"在路径 {path}.{field} 修改 {old_value} -> {personality_name}")
-                        modified = True
-                
-                # 递归检查子字段
-                for key, value in config.items():
-                    if deep_update_config(value, f"{path}.{key}"):
-                        modified = True
-            elif isinstance(config, list):
-                # 检查列表中的字典项
-                for i, item in enumerate(config):
-                    if deep_update_config(item, f"{path}[{i}]"):
-                        modified = True
-            
-            return modified
-        
-        # 尝试修改现有配置
-        modified = deep_update_config(bot_config, "")
-        
-        # 如果没找到相关字段，直接在最外层添加
-        if not modified:
-            # 检查是否已经有personality字段
-            if "personality" not in bot_config:
-                bot_config["personality"] = {}
-            
-            if isinstance(bot_config["personality"], dict):
-                # 检查常见的内层字段
-                inner_fields = ["default", "master", "current", "active"]
-                for field in inner_fields:
-                    if field in bot_config["personality"]:
-                        bot_config["personality"][field] = personality_name
-                        logger.info(f"在personality.{field}设置人格: {personality_name}")
-                        modified = True
-                        break
-                
-                if not modified:
-                    # 直接设置default字段
-                    bot_config["personality"]["default"] = personality_name
-                    logger.info(f"添加personality.default: {personality_name}")
                     modified = True
+
+            # 递归检查子字段
+            for key, value in config.items():
+                if deep_update_config(value, f"{path}.{key}"):
+                    modified = True
+        elif isinstance(config, list):
+            # 检查列表中的字典项
+            for i, item in enumerate(config):
+                if deep_update_config(item, f"{path}[{i}]"):
+                    modified = True
+
+        return modified
+
+    # 尝试修改现有配置
+    modified = deep_update_config(bot_config, "")
+
+    # 如果没找到相关字段，直接在最外层添加
+    if not modified:
+        # 检查是否已经有personality字段
+        if "personality" not in bot_config:
+            bot_config["personality"] = {}
+
+        if isinstance(bot_config["personality"], dict):
+            # 检查常见的内层字段
+            inner_fields = ["default", "master", "current", "active"]
+            for field in inner_fields:
+                if field in bot_config["personality"]:
+                    bot_config["personality"][field] = personality_name
+                    logger.info(f"在personality.{field}设置人格: {personality_name}")
+                    modified = True
+                    break
+
+            if not modified:
+                # 直接设置default字段
+                bot_config["personality"]["default"] = personality_name
+                logger.info(f"添加personality.default: {personality_name}")
+        else:
+            # personality字段不是字典，直接替换
+            bot_config["personality"] = personality_name
+            logger.info(f"设置personality字段为: {personality_name}")
+        changed = True
+
+    return changed
+
+
+class BotConfigWriter:
+    """botconfig.toml后台写入线程
+
+    - 连续多次切换只写入最后一次：每次切换都重新计时debounce_ms，安静下来后才写入，
+      但从第一次未写入的切换算起最多等待max_wait_ms
+    - 缓存解析后的配置，文件被外部修改（mtime变化）时才重新读取
+    - 人格字段未变化时跳过写入
+    - 写临时文件后os.replace原子替换，进程内只在首次写入前备份一次.bak
+    """
+
+    def __init__(self, path: str, debounce_ms: int = 200, max_wait_ms: int = 1000):
+        self.path = path
+        self.debounce = debounce_ms / 1000
+        self.max_wait = max_wait_ms / 1000
+        self._config: Optional[dict] = None
+        self._mtime: Optional[float] = None
+        self._backed_up = False
+        self._pending: Optional[str] = None
+        self._first_submit = 0.0  # 第一次未写入的切换时间
+        self._last_submit = 0.0  # 最近一次切换时间
+        # 待写入的切换和metrics都由这把锁保护（collect_runtime_metrics在其他线程读取）
+        self._lock = threading.Condition()
+        self._write_mutex = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="bot-config-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+        self.metrics = {
+            "submitted": 0,
+            "coalesced": 0,
+            "written": 0,
+            "skipped_unchanged": 0,
+            "errors": 0,
+            "last_write_ms": None
+        }
+
+    def submit(self, personality_name: str):
+        """提交人格切换（立即返回，由后台线程写入）"""
+        with self._lock:
+            now = time.monotonic()
+            if self._pending is not None:
+                self.metrics["coalesced"] += 1
             else:
-                # personality字段不是字典，直接替换
-                bot_config["personality"] = personality_name
-                logger.info(f"设置personality字段为: {personality_name}")
-                modified = True
-        
-        # 持久化配置
-        with open(BOT_CONFIG_PATH, 'w', encoding='utf-8') as f:
-            toml.dump(bot_config, f)
-        
-        # 验证写入
-        with open(BOT_CONFIG_PATH, 'r', encoding='utf-8') as f:
-            verify_config = toml.load(f)
-        
-        logger.info(f"✅ 全局人格已切换为「{personality_name}」")
-        logger.info(f"配置文件已更新: {BOT_CONFIG_PATH}")
-        logger.info(f"验证配置: {verify_config}")
-        
-        return True
-    except Exception as e:
-        logger.error(f"修改全局人格失败：{str(e)}")
-        import traceback
-        logger.error(f"详细错误: {traceback.format_exc()}")
-        return False
+                self._first_submit = now
+            self._pending = personality_name
+            self._last_submit = now
+            self.metrics["submitted"] += 1
+            self._lock.notify()
+
+    def flush(self):
+        """立即写入尚未落盘的切换（进程退出时调用，会等待进行中的写入完成）"""
+        self._write_pending()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._pending is None:
+                    self._lock.wait()
+                # 去抖窗口：每次新的切换都重新计时，期间的连续切换只保留最后一次
+                while self._pending is not None:
+                    remaining = min(self._last_submit + self.debounce, self._first_submit + self.max_wait) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._lock.wait(remaining)
+            self._write_pending()
+
+    def _write_pending(self):
+        with self._write_mutex:
+            with self._lock:
+                personality_name = self._pending
+                self._pending = None
+            if personality_name is not None:
+                self._write(personality_name)
+
+    def _load(self) -> dict:
+        mtime = os.path.getmtime(self.path)
+        if self._config is None or mtime != self._mtime:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._config = toml.load(f)
+            self._mtime = mtime
+        return self._config
+
+    def _write(self, personality_name: str):
+        start = time.time()
+        try:
+            bot_config = self._load()
+            if not self._backed_up:
+                # 备份原配置
+                backup_path = self.path + ".bak"
+                with open(backup_path, 'w', encoding='utf-8') as f:
+                    toml.dump(bot_config, f)
+                self._backed_up = True
+                logger.info(f"备份原配置到: {backup_path}")
+            if not apply_personality_to_config(bot_config, personality_name):
+                with self._lock:
+                    self.metrics["skipped_unchanged"] += 1
+                logger.debug(f"全局人格已是「{personality_name}」，跳过写入")
+                return
+            # 写临时文件再原子替换，避免写到一半时被读到不完整的配置
+            fd, tmp_path = tempfile.mkstemp(prefix=".bot_config.", suffix=".tmp", dir=os.path.dirname(self.path) or ".")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    toml.dump(bot_config, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._mtime = os.path.getmtime(self.path)
+            with self._lock:
+                self.metrics["written"] += 1
+                self.metrics["last_write_ms"] = int((time.time() - start) * 1000)
+            logger.info(f"✅ 全局人格已切换为「{personality_name}」，配置文件已更新: {self.path}")
+        except Exception as e:
+            # 缓存可能已被部分修改，下次写入时重新读取文件
+            self._config = None
+            with self._lock:
+                self.metrics["errors"] += 1
+            logger.error(f"修改全局人格失败：{str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"path": self.path, "pending": self._pending, **self.metrics}
+
+
+BOT_CONFIG_WRITER: Optional[BotConfigWriter] = None
+
+
+def switch_global_personality(personality_name):
+    """切换全局人格（覆盖botconfig）：提交给后台写入线程，不阻塞消息处理"""
+    global BOT_CONFIG_WRITER
+    if BOT_CONFIG_WRITER is None:
+        path = resolve_bot_config_path()
+        if not path:
+            return False
+        BOT_CONFIG_WRITER = BotConfigWriter(path)
+    BOT_CONFIG_WRITER.submit(personality_name)
+    return True
 
 import sqlite3
 import hashlib
 import threading
 import re
-from typing import Dict, Optional, Any, List, Tuple, Union
+import unicodedata
+import zlib
+import weakref
+from collections import OrderedDict, Counter, deque
+from types import MappingProxyType
+from contextlib import contextmanager
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Any, List, Tuple, Union, Iterable, Iterator
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from logging.handlers import TimedRotatingFileHandler
 from flask import Flask, render_template_string, request, redirect, url_for, session
@@ -220,7 +346,7 @@ import base64
 
 # LLM依赖
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
 except ImportError:
     raise ImportError("请安装openai库：pip install openai")
 try:
@@ -248,8 +374,10 @@ except ImportError:
     print("警告：未安装icalendar，日历工具禁用")
 try:
     import requests
+    HAS_REQUESTS = True
 except ImportError:
     print("警告：未安装requests，第三方工具（天气/图片生成）禁用")
+    HAS_REQUESTS = False
 
 # 初始化一个基本的日志记录器
 LOGGER = logging.getLogger("personality_switch_plugin")
@@ -349,9 +477,21 @@ PERSONA_MOOD: Dict[str, str] = {}  # 人格当前情绪
 CURRENT_TOPIC: Dict[str, str] = {}  # 全局话题：{user_id: 话题}
 TOPIC_CHAT_COUNT: Dict[str, int] = {}  # 话题聊天轮数：{user_id: 次数}
 DB_CONN: Optional[sqlite3.Connection] = None
-CACHE_CLIENT: Any = None  # 缓存客户端（Redis/本地字典）
+CACHE_CLIENT: Any = None  # 缓存客户端（本地LocalReplyCache / Redis两级TieredReplyCache）
 USER_HABITS: Dict[str, Dict[str, List[str]]] = {}  # 用户习惯：{user_id: {high_freq_words: [], reply_length: [], topic_preference: []}}
 EMOTION_MODEL: Any = None  # 情绪识别模型
+CONNECTIVITY_MONITOR: Any = None  # 网络连通性监控器
+PERSONA_TRIGGER_INDEX: Any = None  # 人格触发词索引（热插拔时整体替换）
+COMPILED_PERSONAS: Dict[str, Any] = {}  # 编译后的人格（热插拔时与触发词索引一起整体替换）
+SESSION_STORE: Any = None  # 会话状态存储（按 会话+场景 隔离当前人格）
+LLM_SINGLE_FLIGHT: Any = None  # 进行中的LLM请求表（相同请求合并）
+INBOUND_QUEUE: Any = None  # 用户消息入站队列（连发消息合并）
+SWITCH_LATENCY: Any = None  # 人格切换耗时统计
+SEMANTIC_CACHE: Any = None  # 近似重复消息的语义缓存（MinHash+LSH）
+RATE_LIMITER: Any = None  # LLM调用限流（用户/群/人格/模型客户端令牌桶）
+PROMPT_BUILDER: Any = None  # LLM提示词构建（人格×场景×情绪的固定前缀）
+SLOW_REPLY_STATS: Dict[str, int] = {"template_replies": 0, "late_followups": 0, "late_dropped": 0, "late_failed": 0}  # LLM超过场景时限时的兜底统计
+LATE_REPLY_TASKS: set = set()  # 场景时限后在会话锁外等待LLM结果的后台任务（保持引用，避免被回收）
 
 # 提醒相关全局变量
 USER_REMINDERS: Dict[str, List[Dict[str, Any]]] = {}  # 用户提醒列表
@@ -387,16 +527,307 @@ def init_logger():
 # 确保日志记录器已初始化
 LOGGER = init_logger()
 
-# 动态LLM客户端（修改部分）
-class DynamicLLMClient:
-    def __init__(self, model_config: Dict[str, Any]):
-        self.model_type = model_config.get("model_type", "openai")  # 添加默认值
-        self.api_base = model_config.get("api_base")
-        self.api_key = model_config.get("api_key")
-        self.model_name = model_config.get("model_name", "gpt-3.5-turbo")  # 添加默认模型
-        self.temperature = model_config.get("temperature", 0.7)
-        self.max_tokens = model_config.get("max_tokens", 300)
+# LLM连接池的公共参数（[llm]中的值作为各连接池的默认值）
+LLM_POOL_KEYS = ("timeout", "max_concurrency", "max_attempts", "min_retry_budget", "ewma_alpha",
+                 "eject_after_failures", "eject_error_rate", "eject_seconds", "eject_max_seconds",
+                 "hedge_enable", "hedge_percentile", "hedge_min_delay_ms", "hedge_min_samples", "hedge_max_rate",
+                 "circuit_breaker")
+# LLM调用失败时的兜底回复
+LLM_FALLBACK_REPLY = "哎呀，我有点卡壳啦～稍后再聊吧～😣"
+# 推理模型（如deepseek-r1）输出的思考片段
+REASONING_PATTERN = re.compile(r"<think>.*?(?:</think>|$)", re.S)
+_STREAM_END = object()
+_FIRST_ITEM_TIMEOUT = object()
+
+
+def strip_reasoning(text: str) -> str:
+    """去掉回复中的思考片段"""
+    return REASONING_PATTERN.sub("", text).strip()
+
+
+async def collect_stream(stream) -> str:
+    """把异步迭代器产出的文本分片拼接为完整文本"""
+    return "".join([text async for text in stream])
+
+
+async def iter_with_first_timeout(stream, timeout: Optional[float]):
+    """转发异步迭代器的内容；第一项超过timeout秒仍未产出时先产出_FIRST_ITEM_TIMEOUT标记，然后继续等待"""
+    iterator = stream.__aiter__()
+    if timeout is not None:
+        first = asyncio.ensure_future(iterator.__anext__())
+        try:
+            done, _ = await asyncio.wait({first}, timeout=timeout)
+            if not done:
+                yield _FIRST_ITEM_TIMEOUT
+            try:
+                item = await first
+            except StopAsyncIteration:
+                return
+        finally:
+            if not first.done():
+                first.cancel()
+        yield item
+    async for item in iterator:
+        yield item
+
+
+class ReasoningFilter:
+    """流式去除<think>...</think>片段（标签可能被拆在多个分片中）"""
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_reasoning = False
+        self._at_start = True  # 开头（或思考片段结束后）的空白不输出
+
+    @staticmethod
+    def _partial_tag_length(text: str, tag: str) -> int:
+        """text末尾与tag开头重合的最大长度（需要留到下一个分片再判断）"""
+        for length in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:length]):
+                return length
+        return 0
+
+    def feed(self, text: str) -> str:
+        self._buffer += text
+        visible = ""
+        while self._buffer:
+            if self._in_reasoning:
+                index = self._buffer.find(self.CLOSE_TAG)
+                if index < 0:
+                    keep = self._partial_tag_length(self._buffer, self.CLOSE_TAG)
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                self._buffer = self._buffer[index + len(self.CLOSE_TAG):]
+                self._in_reasoning = False
+                self._at_start = True
+            else:
+                index = self._buffer.find(self.OPEN_TAG)
+                if index < 0:
+                    keep = self._partial_tag_length(self._buffer, self.OPEN_TAG)
+                    visible += self._buffer[:len(self._buffer) - keep]
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                visible += self._buffer[:index]
+                self._buffer = self._buffer[index + len(self.OPEN_TAG):]
+                self._in_reasoning = True
+        if self._at_start:
+            visible = visible.lstrip()
+            self._at_start = not visible
+        return visible
+
+    def flush(self) -> str:
+        rest = "" if self._in_reasoning else self._buffer
+        self._buffer = ""
+        return rest.rstrip()
+
+
+class SentenceChunker:
+    """把流式文本按句子切块（句末标点处切分，过短则与下一句合并，过长则强制切分）"""
+    SENTENCE_ENDINGS = "。！？!?～~…\n"
+
+    def __init__(self, min_chars: int = 8, max_chars: int = 120):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        chunks = []
+        for char in text:
+            self._buffer += char
+            if char in self.SENTENCE_ENDINGS and len(self._buffer.strip()) >= self.min_chars:
+                chunks.append(self._buffer.strip())
+                self._buffer = ""
+            elif len(self._buffer) >= self.max_chars:
+                chunks.append(self._buffer.strip())
+                self._buffer = ""
+        return [chunk for chunk in chunks if chunk]
+
+    def flush(self) -> str:
+        rest = self._buffer.strip()
+        self._buffer = ""
+        return rest
+
+
+class PromptBuilder:
+    """LLM提示词构建：固定内容在前、每条消息变化的内容在后，便于模型服务商命中提示词前缀缓存
+
+    - 系统提示词取编译后人格中预先生成的 场景×情绪 提示词，相同组合每次都是同一个字符串
+    - 用户意图、情绪和消息本身放在最后一条user消息中
+    - 根据接口返回的usage统计前缀缓存命中率（OpenAI: prompt_tokens_details.cached_tokens，DeepSeek: prompt_cache_hit_tokens）
+    """
+
+    def __init__(self):
+        self.metrics = {"prefix_builds": 0, "prefix_reuses": 0, "usage_reports": 0, "prompt_tokens": 0, "cached_tokens": 0}
+
+    def system_prompt(self, persona: "CompiledPersona", scene: str, mood: str) -> str:
+        prompt, precompiled = persona.system_prompt(scene, mood)
+        self.metrics["prefix_reuses" if precompiled else "prefix_builds"] += 1
+        return prompt
+
+    @staticmethod
+    def user_prompt(message: str, intent: str, emotion: str, intensity: str) -> str:
+        return f"用户意图：{intent}，用户情绪：{emotion}（强度：{intensity}）\n用户消息：{message}"
+
+    def build(self, persona: "CompiledPersona", scene: str, mood: str, history: List[str], message: str,
+              intent: str, emotion: str, intensity: str) -> List[Dict[str, str]]:
+        messages = [{"role": "system", "content": self.system_prompt(persona, scene, mood)}]
+        messages.extend({"role": "user", "content": content} for content in history)
+        messages.append({"role": "user", "content": self.user_prompt(message, intent, emotion, intensity)})
+        return messages
+
+    def record_usage(self, usage: Any):
+        """记录一次接口返回的token用量（不同服务商字段不同，没有缓存字段时只计提示词token）"""
+        if usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+        if cached_tokens is None:
+            cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+        self.metrics["usage_reports"] += 1
+        self.metrics["prompt_tokens"] += prompt_tokens
+        self.metrics["cached_tokens"] += cached_tokens or 0
+
+    def stats(self) -> Dict[str, Any]:
+        prompt_tokens = self.metrics["prompt_tokens"]
+        return {
+            **self.metrics,
+            "prefix_cache_hit_rate": round(self.metrics["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else None
+        }
+
+
+class Deadline:
+    """单条消息的处理时限，沿处理流程传递，各环节按剩余时间设置超时"""
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，请求被直接拒绝（调用方应改用缓存/模板回复）"""
+
+
+class CircuitBreaker:
+    """LLM连接池熔断器
+
+    - closed：正常放行，统计最近window次调用，失败率或慢调用率超过阈值时打开
+    - open：直接拒绝，open_seconds后进入half_open
+    - half_open：只放行half_open_max_calls个探测请求，全部成功则关闭，任一失败重新打开
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, breaker_config: Dict[str, Any]):
+        self.name = name
+        self.window = breaker_config.get("window", 20)
+        self.min_calls = breaker_config.get("min_calls", 10)
+        self.failure_rate = breaker_config.get("failure_rate", 0.5)
+        self.slow_call_ms = breaker_config.get("slow_call_ms", 15000)
+        self.slow_call_rate = breaker_config.get("slow_call_rate", 0.8)
+        self.open_seconds = breaker_config.get("open_seconds", 30)
+        self.half_open_max_calls = breaker_config.get("half_open_max_calls", 1)
+        self.state = self.CLOSED
+        self._outcomes: deque = deque(maxlen=self.window)  # (是否成功, 是否慢调用)
+        self._opened_at = 0.0
+        self._probes = 0  # half_open状态下在途的探测请求数
+        self._probe_successes = 0
+        self.metrics = {"rejected": 0, "opened": 0}
+
+    def acquire(self) -> bool:
+        """申请一次调用；half_open状态下占用一个探测名额（调用结束后必须record）"""
+        if self.state == self.OPEN:
+            if time.time() - self._opened_at < self.open_seconds:
+                self.metrics["rejected"] += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+            LOGGER.info(f"LLM熔断器{self.name}进入半开状态，放行探测请求")
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_max_calls:
+                self.metrics["rejected"] += 1
+                return False
+            self._probes += 1
+        return True
+
+    def release(self):
+        """调用被取消、没有结果时归还探测名额"""
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+
+    def record(self, success: bool, elapsed_ms: float):
+        slow = elapsed_ms >= self.slow_call_ms
+        if self.state == self.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if not success or slow:
+                self._open()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_max_calls:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                LOGGER.info(f"LLM熔断器{self.name}探测成功，恢复正常")
+            return
+        if self.state == self.OPEN:
+            return
+        self._outcomes.append((success, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        failures = sum(1 for ok, _ in self._outcomes if not ok)
+        slow_calls = sum(1 for _, is_slow in self._outcomes if is_slow)
+        if failures / len(self._outcomes) >= self.failure_rate or slow_calls / len(self._outcomes) >= self.slow_call_rate:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        self._outcomes.clear()
+        self.metrics["opened"] += 1
+        LOGGER.warning(f"LLM熔断器{self.name}打开，{self.open_seconds}秒内直接使用降级回复")
+
+    def stats(self) -> Dict[str, Any]:
+        failures = sum(1 for ok, _ in self._outcomes if not ok)
+        return {
+            "state": self.state,
+            "recent_calls": len(self._outcomes),
+            "recent_failure_rate": round(failures / len(self._outcomes), 3) if self._outcomes else None,
+            **self.metrics
+        }
+
+
+# 单个LLM接入点（一个api_base+api_key），记录在途请求数、延迟/错误率EWMA和摘除状态
+class LLMEndpoint:
+    def __init__(self, model_type: str, endpoint_config: Dict[str, Any], pool_config: Dict[str, Any]):
+        self.model_type = model_type
+        self.api_base = endpoint_config.get("api_base")
+        self.api_key = endpoint_config.get("api_key")
+        self.model_name = endpoint_config.get("model_name") or pool_config["model_name"]
+        self.weight = max(0.01, float(endpoint_config.get("weight", 1)))
+        self.timeout = pool_config["timeout"]
+        self.max_concurrency = endpoint_config.get("max_concurrency") or pool_config["max_concurrency"]
+        self.label = endpoint_config.get("name") or self.api_base or model_type
         self.client = self._init_client()
+        self.async_client = self._init_async_client()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # 健康状态
+        self.outstanding = 0
+        self.latency_ewma: Optional[float] = None  # 成功请求耗时（秒）
+        self.error_ewma = 0.0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.metrics = {"requests": 0, "failures": 0, "ejections": 0}
 
     def _init_client(self):
         if self.model_type == "openai":
@@ -410,106 +841,1266 @@ class DynamicLLMClient:
         else:
             # 添加对None的处理
             raise ValueError(f"不支持的模型类型：{self.model_type}（请检查config.toml中的llm.default_model_type配置）")
-    
+
+    def _init_async_client(self):
+        """初始化原生异步客户端（ChatGLM无异步SDK，返回None走工作线程适配）"""
+        if self.model_type in ["openai", "deepseek"]:
+            # 超时由连接池按截止时间控制，SDK自身不重试（换接入点重试）
+            return AsyncOpenAI(api_key=self.api_key or "placeholder", base_url=self.api_base, timeout=self.timeout, max_retries=0)
+        return None
+
+    def get_semaphore(self) -> asyncio.Semaphore:
+        """懒加载并发信号量（确保绑定到运行中的事件循环）"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """懒加载同步SDK的工作线程池（线程数与并发上限一致）"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency, thread_name_prefix=f"llm-{self.model_type}"
+            )
+        return self._executor
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def score(self) -> float:
+        """加权最少在途请求；延迟和错误率高的接入点分数变差（越小越优先）"""
+        score = (self.outstanding + 1) / self.weight
+        if self.latency_ewma is not None:
+            score *= 1 + self.latency_ewma / self.timeout
+        return score * (1 + self.error_ewma * 4)
+
+    def record(self, success: bool, elapsed: float, pool_config: Dict[str, Any]):
+        alpha = pool_config["ewma_alpha"]
+        self.metrics["requests"] += 1
+        self.error_ewma = self.error_ewma * (1 - alpha) + (0.0 if success else alpha)
+        if success:
+            self.consecutive_failures = 0
+            self.ejections = 0
+            self.latency_ewma = elapsed if self.latency_ewma is None else self.latency_ewma * (1 - alpha) + elapsed * alpha
+            return
+        self.metrics["failures"] += 1
+        self.consecutive_failures += 1
+        # 摘除前已发出的请求陆续失败时不重复摘除
+        if not self.available(time.time()):
+            return
+        if (self.consecutive_failures >= pool_config["eject_after_failures"]
+                or self.error_ewma >= pool_config["eject_error_rate"]):
+            # 连续被摘除时摘除时间翻倍，恢复成功后重置
+            duration = min(pool_config["eject_seconds"] * 2 ** self.ejections, pool_config["eject_max_seconds"])
+            self.ejected_until = time.time() + duration
+            self.ejections += 1
+            self.consecutive_failures = 0
+            self.metrics["ejections"] += 1
+            LOGGER.warning(f"LLM接入点{self.label}故障，摘除{duration:.0f}秒")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "error_ewma": round(self.error_ewma, 3),
+            "ejected": not self.available(time.time()),
+            **self.metrics
+        }
+
+
+# 动态LLM客户端：一组接入点组成的连接池（加权最少在途请求负载均衡+故障摘除+截止时间内换接入点重试）
+class DynamicLLMClient:
+    def __init__(self, model_config: Dict[str, Any], name: str = "default"):
+        self.name = name
+        self.model_type = model_config.get("model_type", "openai")  # 添加默认值
+        self.model_name = model_config.get("model_name", "gpt-3.5-turbo")  # 添加默认模型
+        self.temperature = model_config.get("temperature", 0.7)
+        self.max_tokens = model_config.get("max_tokens", 300)
+        # 单次回复的总超时（秒，含换接入点重试）和单接入点最大并发数
+        self.timeout = model_config.get("timeout") or 60
+        self.max_concurrency = model_config.get("max_concurrency") or 8
+        self.pool_config = {
+            "model_name": self.model_name,
+            "timeout": self.timeout,
+            "max_concurrency": self.max_concurrency,
+            "max_attempts": model_config.get("max_attempts", 3),
+            "min_retry_budget": model_config.get("min_retry_budget", 2),
+            "ewma_alpha": model_config.get("ewma_alpha", 0.2),
+            "eject_after_failures": model_config.get("eject_after_failures", 3),
+            "eject_error_rate": model_config.get("eject_error_rate", 0.5),
+            "eject_seconds": model_config.get("eject_seconds", 30),
+            "eject_max_seconds": model_config.get("eject_max_seconds", 300),
+            # 对冲请求：主请求超过历史耗时的hedge_percentile分位仍未返回时，向备用接入点/连接池再发一份，先成功的为准
+            "hedge_enable": model_config.get("hedge_enable", False),
+            "hedge_percentile": model_config.get("hedge_percentile", 95),
+            "hedge_min_delay_ms": model_config.get("hedge_min_delay_ms", 500),
+            "hedge_min_samples": model_config.get("hedge_min_samples", 20),
+            "hedge_max_rate": model_config.get("hedge_max_rate", 0.1)
+        }
+        # 未配置endpoints时，api_base/api_key本身就是唯一的接入点
+        endpoint_configs = model_config.get("endpoints") or [
+            {"api_base": model_config.get("api_base"), "api_key": model_config.get("api_key")}
+        ]
+        self.endpoints = [LLMEndpoint(self.model_type, config, self.pool_config) for config in endpoint_configs]
+        # 对冲目标：hedge_pool指定的连接池（初始化所有连接池后关联），未指定时用本池的其他接入点
+        self.hedge_pool = model_config.get("hedge_pool")
+        self.hedge_client: Optional["DynamicLLMClient"] = None
+        self.breaker = CircuitBreaker(name, model_config.get("circuit_breaker", {}))
+        self.latency = LatencyTracker()
+        self._hedge_budget = 0.0  # 每个请求积累hedge_max_rate个对冲额度，对冲一次消耗1个
+        self.metrics = {"retries": 0, "exhausted": 0, "hedges": 0, "hedge_wins": 0, "hedges_over_budget": 0}
+
+    def _pick(self, tried: List[LLMEndpoint]) -> Optional[LLMEndpoint]:
+        """选出未尝试过的最优接入点；全部被摘除时选最早恢复的（不至于完全不可用）"""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+        if not candidates:
+            return None
+        now = time.time()
+        healthy = [endpoint for endpoint in candidates if endpoint.available(now)]
+        if not healthy:
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        return min(healthy, key=lambda endpoint: endpoint.score())
+
+    def _create_completion(self, endpoint: LLMEndpoint, messages: List[Dict[str, str]], stream: bool = False):
+        """同步调用（仅在工作线程中执行）"""
+        return endpoint.client.chat.completions.create(
+            model=endpoint.model_name, messages=messages, temperature=self.temperature,
+            max_tokens=self.max_tokens, stream=stream
+        )
+
     def generate_reply(self, messages: List[Dict[str, str]]) -> str:
+        endpoint = self._pick([])
         try:
-            if self.model_type in ["openai", "deepseek"]:
-                response = self.client.chat.completions.create(
-                    model=self.model_name, messages=messages, temperature=self.temperature, max_tokens=self.max_tokens
-                )
-                return response.choices[0].message.content.strip()
-            elif self.model_type == "chatglm":
-                response = self.client.chat.completions.create(
-                    model=self.model_name, messages=messages, temperature=self.temperature, max_tokens=self.max_tokens
-                )
-                return response.choices[0].message.content.strip()
+            response = self._create_completion(endpoint, messages)
+            return response.choices[0].message.content.strip()
         except Exception as e:
             LOGGER.error(f"LLM调用失败：{str(e)}")
-            return "哎呀，我有点卡壳啦～稍后再聊吧～😣"
+            return LLM_FALLBACK_REPLY
 
-# 数据库操作类
-class DatabaseManager:
-    def __init__(self):
-        self.enable = CONFIG["database"]["enable"]
-        if not self.enable:
-            return
-        self.type = CONFIG["database"]["type"]
-        if self.type == "sqlite":
-            self.conn = sqlite3.connect(CONFIG["database"]["path"], check_same_thread=False)
-            self._create_tables()
-        elif self.type == "mysql":
-            import pymysql
-            mysql_config = CONFIG["database"]["mysql_config"]
-            self.conn = pymysql.connect(
-                host=mysql_config["host"],
-                port=mysql_config["port"],
-                user=mysql_config["user"],
-                password=mysql_config["password"],
-                db=mysql_config["db_name"],
-                charset="utf8mb4"
+    async def _request(self, endpoint: LLMEndpoint, messages: List[Dict[str, str]], timeout: float):
+        async with endpoint.get_semaphore():
+            if endpoint.async_client is not None:
+                request = endpoint.async_client.chat.completions.create(
+                    model=endpoint.model_name, messages=messages, temperature=self.temperature, max_tokens=self.max_tokens
+                )
+            else:
+                # 同步SDK（ZhipuAI）放到工作线程执行
+                loop = asyncio.get_running_loop()
+                request = loop.run_in_executor(endpoint.get_executor(), self._create_completion, endpoint, messages)
+            return await asyncio.wait_for(request, timeout=timeout)
+
+    def _retry_allowed(self, tried: List[LLMEndpoint], deadline: Deadline) -> bool:
+        return len(tried) < self.pool_config["max_attempts"] and deadline.remaining() >= self.pool_config["min_retry_budget"]
+
+    async def _generate(self, messages: List[Dict[str, str]], deadline: Deadline, tried: List[LLMEndpoint]) -> Optional[str]:
+        """在截止时间内依次尝试接入点，全部失败返回None；tried可与对冲请求共享，两边不会打到同一个接入点"""
+        retrying = False
+        while True:
+            endpoint = self._pick(tried)
+            if endpoint is None:
+                return None
+            # 确实选到了接入点才算一次重试（没有可换的接入点时不计数）
+            if retrying:
+                self.metrics["retries"] += 1
+            tried.append(endpoint)
+            start = time.monotonic()
+            endpoint.outstanding += 1
+            try:
+                response = await self._request(endpoint, messages, deadline.remaining())
+                endpoint.record(True, time.monotonic() - start, self.pool_config)
+                if CONNECTIVITY_MONITOR:
+                    CONNECTIVITY_MONITOR.report_success()
+                if PROMPT_BUILDER:
+                    PROMPT_BUILDER.record_usage(getattr(response, "usage", None))
+                return strip_reasoning(response.choices[0].message.content)
+            except asyncio.TimeoutError:
+                LOGGER.error(f"LLM调用超时（{endpoint.label}）：{endpoint.model_name}")
+                endpoint.record(False, time.monotonic() - start, self.pool_config)
+                if CONNECTIVITY_MONITOR:
+                    CONNECTIVITY_MONITOR.report_failure()
+            except Exception as e:
+                LOGGER.error(f"LLM调用失败（{endpoint.label}）：{str(e)}")
+                endpoint.record(False, time.monotonic() - start, self.pool_config)
+                if CONNECTIVITY_MONITOR and is_network_error(e):
+                    CONNECTIVITY_MONITOR.report_failure()
+            finally:
+                endpoint.outstanding -= 1
+            if not self._retry_allowed(tried, deadline):
+                return None
+            retrying = True
+
+    def _hedge_delay(self) -> Optional[float]:
+        """发起对冲前的等待时间（秒）；未启用、样本不足或没有对冲目标时返回None"""
+        if not self.pool_config["hedge_enable"]:
+            return None
+        if self.hedge_client is None and len(self.endpoints) < 2:
+            return None
+        if self.latency.count < self.pool_config["hedge_min_samples"]:
+            return None
+        threshold_ms = max(self.latency.percentile(self.pool_config["hedge_percentile"]), self.pool_config["hedge_min_delay_ms"])
+        return threshold_ms / 1000
+
+    async def agenerate_reply(self, messages: List[Dict[str, str]], deadline: Optional[Deadline] = None) -> str:
+        """异步生成回复（不阻塞事件循环）
+
+        - 失败时在截止时间内换一个接入点重试（未传deadline时以timeout为限）
+        - 启用对冲时，主请求超过历史耗时分位仍未返回则再发一份对冲请求，先成功的为准，另一个取消；
+          对冲总量不超过请求数的hedge_max_rate
+        - 熔断器打开时不发请求，直接抛出CircuitOpenError
+        """
+        if not self.breaker.acquire():
+            raise CircuitOpenError(self.name)
+        deadline = deadline or Deadline(self.timeout)
+        start = time.monotonic()
+        tried: List[LLMEndpoint] = []
+        self._hedge_budget = min(self._hedge_budget + self.pool_config["hedge_max_rate"], 10.0)
+        delay = self._hedge_delay()
+        primary = asyncio.ensure_future(self._generate(messages, deadline, tried))
+        tasks = {primary}
+        hedge = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=min(delay, deadline.remaining()))
+                if not done and not deadline.expired():
+                    if self._hedge_budget >= 1:
+                        self._hedge_budget -= 1
+                        self.metrics["hedges"] += 1
+                        # 对冲目标连接池熔断时改用本池其他接入点
+                        target = self.hedge_client if self.hedge_client and self.hedge_client.breaker.state == CircuitBreaker.CLOSED else self
+                        hedge = asyncio.ensure_future(target._generate(messages, deadline, tried if target is self else []))
+                        tasks.add(hedge)
+                    else:
+                        self.metrics["hedges_over_budget"] += 1
+            reply = None
+            while tasks and reply is None:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None and reply is None:
+                        reply = task.result()
+                        if task is hedge:
+                            self.metrics["hedge_wins"] += 1
+        except asyncio.CancelledError:
+            # 调用方放弃等待（如合并请求的等待者全部离开），不计入熔断统计，但要归还探测名额
+            self.breaker.release()
+            raise
+        except Exception:
+            # 意外异常（如结果解析出错）计为一次失败，半开状态下的探测名额随之归还
+            self.breaker.record(False, (time.monotonic() - start) * 1000)
+            raise
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+        elapsed_ms = (time.monotonic() - start) * 1000
+        self.breaker.record(reply is not None, elapsed_ms)
+        if reply is None:
+            self.metrics["exhausted"] += 1
+            return LLM_FALLBACK_REPLY
+        self.latency.observe(elapsed_ms)
+        return reply
+
+    async def _iter_stream_deltas(self, endpoint: LLMEndpoint, messages: List[Dict[str, str]], deadline: Deadline):
+        """逐个产出原始文本分片（ChatGLM同步流在工作线程中读取，经队列转交给事件循环）
+
+        每个分片的等待时间不超过单次超时和本条消息剩余时限中较小的一个；
+        结束、出错或调用方中途放弃时都会关闭底层流（ChatGLM通知工作线程停止读取）
+        """
+        if endpoint.async_client is not None:
+            stream = await asyncio.wait_for(
+                endpoint.async_client.chat.completions.create(
+                    model=endpoint.model_name, messages=messages, temperature=self.temperature,
+                    max_tokens=self.max_tokens, stream=True
+                ),
+                timeout=deadline.remaining()
             )
-            self._create_tables()
+            try:
+                iterator = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), timeout=min(self.timeout, deadline.remaining()))
+                    except StopAsyncIteration:
+                        return
+                    # 部分服务商在最后一个分片附带usage
+                    if PROMPT_BUILDER and getattr(chunk, "usage", None):
+                        PROMPT_BUILDER.record_usage(chunk.usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
         else:
-            raise ValueError(f"不支持的数据库类型：{self.type}")
-        global DB_CONN
-        DB_CONN = self.conn
-        LOGGER.info("数据库连接成功")
+            loop = asyncio.get_running_loop()
+            queue: asyncio.Queue = asyncio.Queue()
+            stop = threading.Event()
 
-    def _create_tables(self):
-        """创建数据表（包含所有新增功能表）"""
-        cursor = self.conn.cursor()
-        # 1. 用户对话历史表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_conversation (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            time TEXT NOT NULL,
-            persona_name TEXT NOT NULL,
-            content TEXT NOT NULL,
-            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        # 2. 用户偏好表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_preference (
-            user_id TEXT PRIMARY KEY,
-            preference_json TEXT NOT NULL
-        )
-        """)
-        # 3. 人格切换记录表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS persona_switch (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            time TEXT NOT NULL,
-            persona_name TEXT NOT NULL,
-            trigger_type TEXT NOT NULL,
-            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
-        # 4. 人格活跃度统计表
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS persona_stats (
-            persona_name TEXT PRIMARY KEY,
-            switch_count INTEGER DEFAULT 0
-        )
-        """)
-        # 5. 人格关系表（成长系统）
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS persona_relationships (
-            persona1 TEXT NOT NULL,
-            persona2 TEXT NOT NULL,
-            level INTEGER DEFAULT 1,
-            interact_count INTEGER DEFAULT 0,
-            PRIMARY KEY (persona1, persona2)
-        )
-        """)
-        # 6. 人格成长表（成长系统）
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS persona_growth (
-            persona_name TEXT PRIMARY KEY,
-            interact_count INTEGER DEFAULT 0,
-            unlocked TEXT DEFAULT '[]'
+            def pump():
+                stream = None
+                try:
+                    stream = self._create_completion(endpoint, messages, stream=True)
+                    for chunk in stream:
+                        if stop.is_set():
+                            break
+                        loop.call_soon_threadsafe(queue.put_nowait, chunk)
+                except Exception as e:
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+                finally:
+                    close = getattr(stream, "close", None)
+                    if close:
+                        try:
+                            close()
+                        except Exception:
+                            pass
+                    loop.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+            loop.run_in_executor(endpoint.get_executor(), pump)
+            try:
+                while True:
+                    item = await asyncio.wait_for(queue.get(), timeout=min(self.timeout, deadline.remaining()))
+                    if item is _STREAM_END:
+                        return
+                    if isinstance(item, Exception):
+                        raise item
+                    if PROMPT_BUILDER and getattr(item, "usage", None):
+                        PROMPT_BUILDER.record_usage(item.usage)
+                    if item.choices and item.choices[0].delta.content:
+                        yield item.choices[0].delta.content
+            finally:
+                stop.set()
+
+    async def astream_reply(self, messages: List[Dict[str, str]], deadline: Optional[Deadline] = None):
+        """流式生成回复：逐段产出可见文本（已实时去除思考片段）
+
+        还没输出内容前失败可换接入点重试；熔断器打开时抛出CircuitOpenError
+        """
+        if not self.breaker.acquire():
+            raise CircuitOpenError(self.name)
+        deadline = deadline or Deadline(self.timeout)
+        start_all = time.monotonic()
+        outcome: Optional[bool] = None  # None表示调用方中途放弃
+        try:
+            tried: List[LLMEndpoint] = []
+            produced = False
+            retrying = False
+            while True:
+                endpoint = self._pick(tried)
+                if endpoint is None:
+                    break
+                if retrying:
+                    self.metrics["retries"] += 1
+                tried.append(endpoint)
+                reasoning_filter = ReasoningFilter()
+                deltas = self._iter_stream_deltas(endpoint, messages, deadline)
+                start = time.monotonic()
+                endpoint.outstanding += 1
+                try:
+                    async with endpoint.get_semaphore():
+                        async for delta in deltas:
+                            visible = reasoning_filter.feed(delta)
+                            if visible:
+                                produced = True
+                                yield visible
+                    rest = reasoning_filter.flush()
+                    if rest:
+                        produced = True
+                        yield rest
+                    endpoint.record(True, time.monotonic() - start, self.pool_config)
+                    if CONNECTIVITY_MONITOR:
+                        CONNECTIVITY_MONITOR.report_success()
+                    outcome = True
+                    return
+                except Exception as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        LOGGER.error(f"LLM流式调用超时（{endpoint.label}）：{endpoint.model_name}")
+                    else:
+                        LOGGER.error(f"LLM流式调用失败（{endpoint.label}）：{str(e)}")
+                    endpoint.record(False, time.monotonic() - start, self.pool_config)
+                    if CONNECTIVITY_MONITOR and is_network_error(e):
+                        CONNECTIVITY_MONITOR.report_failure()
+                finally:
+                    endpoint.outstanding -= 1
+                    # 调用方中途放弃时立即关闭底层流，不等垃圾回收
+                    await deltas.aclose()
+                # 已经发出部分内容时不能重试，否则用户会收到重复的开头
+                if produced or not self._retry_allowed(tried, deadline):
+                    break
+                retrying = True
+            outcome = False
+            if not produced:
+                self.metrics["exhausted"] += 1
+                yield LLM_FALLBACK_REPLY
+        finally:
+            if outcome is None:
+                self.breaker.release()
+            else:
+                self.breaker.record(outcome, (time.monotonic() - start_all) * 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model_type": self.model_type,
+            **self.metrics,
+            "hedge_win_rate": round(self.metrics["hedge_wins"] / self.metrics["hedges"], 3) if self.metrics["hedges"] else None,
+            "latency": self.latency.stats(),
+            "circuit_breaker": self.breaker.stats(),
+            "endpoints": {endpoint.label: endpoint.stats() for endpoint in self.endpoints}
+        }
+
+# 多模式关键词自动机（Aho–Corasick，一次扫描匹配全部关键词）
+class KeywordAutomaton:
+    """构建后只读；关键词变化时构建新实例再整体替换引用，保证读取方无锁且一致"""
+
+    def __init__(self, keywords: Iterable[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Any]] = [[]]
+        self.keyword_count = 0
+        for keyword, payload in keywords:
+            if keyword:
+                self._add(keyword, payload)
+        self._build()
+
+    def _add(self, keyword: str, payload: Any):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state].append(payload)
+        self.keyword_count += 1
+
+    def _build(self):
+        """BFS计算失败指针，并把后缀状态的输出合并进来"""
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and char not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                fallback = self._goto[fail_state].get(char, 0)
+                self._fail[next_state] = fallback if fallback != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, Any]]:
+        """单次扫描文本，产出（结束位置, payload）"""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for payload in output[state]:
+                    yield index, payload
+
+
+class PersonaTriggerIndex:
+    """人格触发词+指令名索引：一次扫描得到应切换的人格和被提及的人格"""
+
+    def __init__(self, personalities: Dict[str, Any]):
+        keywords = []
+        for order, (name, persona) in enumerate(personalities.items()):
+            for trigger in persona.get("trigger_names", []):
+                keywords.append((trigger, ("trigger", order, name)))
+            keywords.append((name, ("command", order, name)))
+        self._automaton = KeywordAutomaton(keywords)
+
+    def scan(self, message: str) -> Tuple[Optional[str], List[str]]:
+        """返回（触发词命中的人格名, 消息中提及的人格名列表）
+
+        多个人格同时命中时按配置顺序取第一个，与逐个人格扫描的结果一致
+        """
+        best_order = None
+        best_name = None
+        mentioned = []
+        for _, (kind, order, name) in self._automaton.iter_matches(message):
+            if kind == "trigger":
+                if best_order is None or order < best_order:
+                    best_order, best_name = order, name
+            elif name not in mentioned:
+                mentioned.append(name)
+        return best_name, mentioned
+
+    def match_trigger(self, message: str) -> Optional[str]:
+        return self.scan(message)[0]
+
+
+# 消息分类关键词表（意图/情绪/工具/离线模板等，启动时预编译为一个自动机）
+INTENT_RULES: Dict[str, List[str]] = {
+    "comfort": ["好累", "难过", "崩溃", "不开心", "伤心"],
+    "question": ["什么", "怎么", "如何", "为什么", "请教"],
+    "share": ["分享", "今天", "我", "遇到", "发现"],
+    "complain": ["吐槽", "烦", "讨厌", "垃圾", "生气"],
+    "praise": ["好棒", "厉害", "优秀", "好看", "好听"]
+}
+EMOTION_KEYWORDS: Dict[str, Dict[str, List[str]]] = {
+    "happy": {
+        "weak": ["开心", "高兴", "不错", "挺好"],
+        "medium": ["超开心", "超棒", "太好", "惊喜"],
+        "strong": ["狂喜", "激动", "疯了", "幸福"]
+    },
+    "sad": {
+        "weak": ["难过", "失落", "不开心", "遗憾"],
+        "medium": ["很伤心", "崩溃", "想哭", "委屈"],
+        "strong": ["绝望", "心碎", "生无可恋", "痛苦"]
+    },
+    "angry": {
+        "weak": ["生气", "烦躁", "讨厌", "不满"],
+        "medium": ["很生气", "愤怒", "不爽", "恼火"],
+        "strong": ["暴怒", "气炸", "恨", "抓狂"]
+    },
+    "neutral": {
+        "weak": ["普通", "一般", "随便", "都行"],
+        "medium": ["平静", "淡然", "无所谓", "还好"],
+        "strong": ["冷漠", "无感", "麻木"]
+    }
+}
+# 离线模板分类（按顺序优先匹配）
+OFFLINE_TEMPLATE_KEYWORDS: Dict[str, List[str]] = {
+    "greeting": ["你好", "哈喽", "hi", "早上好", "早安", "晚安"],
+    "comfort": ["难过", "伤心", "不开心"],
+    "food": ["吃", "美食", "小笼包", "糖葫芦"],
+    "music": ["唱歌", "音乐", "歌声"]
+}
+# 消息标记（工具触发、提醒、多模态等只关心"是否出现"的关键词）
+MESSAGE_FLAG_KEYWORDS: Dict[str, List[str]] = {
+    "weather": ["天气", "温度", "下雨", "晴天", "预报"],
+    "todo": ["待办", "提醒"],
+    "todo_add": ["添加"],
+    "todo_query": ["查询"],
+    "todo_complete": ["完成"],
+    "calendar": ["日历", "会议", "日程"],
+    "reminder": ["提醒"],
+    "pronoun": ["我", "你"],
+    "list_reminders": ["我的提醒", "列出提醒", "查看提醒"],
+    "persona_list": ["人格列表"],
+    "image": ["生成图片", "画画"],
+    "voice": ["语音回复", "说出来"]
+}
+# 会直接触发动作（工具/提醒/人格列表）的标记：连发消息合并时不跨消息组合这些标记
+ACTION_FLAGS = frozenset(("weather", "todo", "todo_add", "todo_query", "todo_complete", "calendar",
+                          "reminder", "list_reminders", "persona_list"))
+
+
+class MessageFeatures:
+    """单条消息的分类结果（在消息处理流程中传递，各环节不再重复扫描文本）"""
+    __slots__ = ("normalized", "intent", "emotion", "emotion_intensity", "offline_category", "flags")
+
+    def __init__(self, normalized: str):
+        self.normalized = normalized
+        self.intent = "general"
+        self.emotion: Optional[str] = None  # 无关键词命中时为None，由调用方降级到情绪模型
+        self.emotion_intensity: Optional[str] = None
+        self.offline_category: Optional[str] = None
+        self.flags = set()
+
+    def has(self, flag: str) -> bool:
+        return flag in self.flags
+
+
+class MessageClassifier:
+    """把所有关键词表编译成一个自动机，一次扫描得到意图、情绪、工具标记和离线模板分类
+
+    多个关键词同时命中时按各表的声明顺序取第一个，与逐表扫描的结果一致
+    """
+
+    def __init__(self):
+        keywords = []
+        for order, (intent, words) in enumerate(INTENT_RULES.items()):
+            keywords.extend((word, ("intent", order, intent)) for word in words)
+        order = 0
+        for emotion, intensity_keywords in EMOTION_KEYWORDS.items():
+            for intensity, words in intensity_keywords.items():
+                keywords.extend((word, ("emotion", order, (emotion, intensity))) for word in words)
+                order += 1
+        for order, (category, words) in enumerate(OFFLINE_TEMPLATE_KEYWORDS.items()):
+            keywords.extend((word, ("offline", order, category)) for word in words)
+        for flag, words in MESSAGE_FLAG_KEYWORDS.items():
+            keywords.extend((word, ("flag", 0, flag)) for word in words)
+        self._automaton = KeywordAutomaton(keywords)
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        # 与逐表 in 查找一致，区分大小写（英文关键词不会因为转小写多命中）
+        return message.strip()
+
+    def classify(self, message: str) -> MessageFeatures:
+        features = MessageFeatures(self.normalize(message))
+        best = {}
+        for _, (group, order, value) in self._automaton.iter_matches(features.normalized):
+            if group == "flag":
+                features.flags.add(value)
+            elif group not in best or order < best[group][0]:
+                best[group] = (order, value)
+        if "intent" in best:
+            features.intent = best["intent"][1]
+        if "emotion" in best:
+            features.emotion, features.emotion_intensity = best["emotion"][1]
+        if "offline" in best:
+            features.offline_category = best["offline"][1]
+        return features
+
+    @staticmethod
+    def merge(features_list: List[MessageFeatures]) -> MessageFeatures:
+        """合并连发消息各自的分类结果：意图/情绪/离线分类取最后一条命中的，动作类标记不跨消息组合"""
+        merged = MessageFeatures("\n".join(features.normalized for features in features_list))
+        for features in features_list:
+            if features.intent != "general":
+                merged.intent = features.intent
+            if features.emotion is not None:
+                merged.emotion, merged.emotion_intensity = features.emotion, features.emotion_intensity
+            if features.offline_category is not None:
+                merged.offline_category = features.offline_category
+            merged.flags |= features.flags - ACTION_FLAGS
+        return merged
+
+
+def normalize_message(message: str) -> str:
+    """缓存用的消息归一化：全角转半角（NFKC）、转小写，去掉空白、标点、符号和emoji，只保留文字和数字
+
+    例如"早上好！！😊"、"早上好 🥰"、"早上好!"归一化后都是"早上好"
+    """
+    folded = unicodedata.normalize("NFKC", message).lower()
+    return "".join(ch for ch in folded if unicodedata.category(ch)[0] in "LNM")
+
+
+def rebuild_trigger_index():
+    """重建人格触发词索引和编译后的人格（加载/导入/删除/修改人格后调用，全部构建完成后再原子替换引用）"""
+    global PERSONA_TRIGGER_INDEX, COMPILED_PERSONAS
+    personalities = dict(PERSONALITIES)
+    trigger_index = PersonaTriggerIndex(personalities)
+    compiled = compile_personas(personalities, CONFIG.get("scene", {}))
+    PERSONA_TRIGGER_INDEX, COMPILED_PERSONAS = trigger_index, compiled
+    LOGGER.debug(f"人格触发词索引已重建：{PERSONA_TRIGGER_INDEX._automaton.keyword_count}个关键词，{len(COMPILED_PERSONAS)}个人格")
+
+
+# 编译后的人格：加载时校验字段并预先算好 场景×情绪 的配置和提示词，消息处理只做属性访问
+def resolve_scene_config(persona: Dict[str, Any], scene_name: str, scene_specific: bool = True) -> Dict[str, Any]:
+    """从人格配置字典解析场景配置（场景专属配置覆盖全局；scene_specific为False时忽略场景专属配置）"""
+    scene_config = persona.get("scene_config", {}).get(scene_name, {}) if scene_specific else {}
+    return {
+        "reply_style": scene_config.get("reply_style", persona["reply_style"]),
+        "plan_style": scene_config.get("plan_style", persona.get("plan_style", "")),
+        "private_plan_style": scene_config.get("private_plan_style", persona.get("private_plan_style", "")),
+        "speak_frequency": scene_config.get("speak_frequency", "medium"),
+        "visual_style": scene_config.get("visual_style", persona.get("visual_style", ""))
+    }
+
+
+def compose_system_prompt(persona_desc: str, scene: str, scene_style: str, mood: str, mood_style: str, watermark: str) -> str:
+    """LLM系统提示词（只含人格×场景×情绪决定的固定内容，保证相同输入得到相同文本）"""
+    return (
+        f"你现在的身份是：{persona_desc}\n"
+        f"当前场景：{scene}，场景专属回复风格：{scene_style}\n"
+        f"当前情绪：{mood}，情绪回复风格：{mood_style}\n"
+        "回复要求：\n"
+        "1. 严格贴合人格设定和当前情绪，不偏离人设\n"
+        "2. 适配当前场景，符合场景回复风格\n"
+        "3. 回应用户的情绪和意图，有共情力\n"
+        "4. 回复简短自然，不超过3句话\n"
+        f"5. 保留人格专属水印：{watermark}"
+    )
+
+
+class CompiledScene:
+    __slots__ = ("reply_style", "plan_style", "private_plan_style", "speak_frequency", "visual_style")
+
+    def __init__(self, scene_config: Dict[str, Any]):
+        for field in self.__slots__:
+            object.__setattr__(self, field, str(scene_config[field]))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledScene不可修改")
+
+
+class CompiledPersona:
+    """不可变的人格对象：字段已校验，场景配置和 场景×情绪 的情绪风格、系统提示词已预先计算
+
+    人格配置变化时重新编译整体替换（见rebuild_trigger_index），不在原对象上修改
+    """
+    __slots__ = ("name", "command", "personality_desc", "reply_style", "watermark", "default_mood",
+                 "trigger_names", "moods", "_base_scene", "_scenes", "_mood_styles", "_prompts")
+    REQUIRED_FIELDS = ("personality_desc", "reply_style")
+
+    def __init__(self, name: str, persona: Dict[str, Any], scene_names: Iterable[str], scene_specific: bool = True):
+        missing = [field for field in self.REQUIRED_FIELDS if not persona.get(field)]
+        if missing:
+            raise ValueError(f"人格{name}缺少必填字段：{'/'.join(missing)}")
+        setattr_ = object.__setattr__
+        setattr_(self, "name", name)
+        setattr_(self, "command", str(persona.get("command", name)))
+        setattr_(self, "personality_desc", str(persona["personality_desc"]))
+        setattr_(self, "reply_style", str(persona["reply_style"]))
+        setattr_(self, "watermark", str(persona.get("watermark", "")))
+        setattr_(self, "default_mood", str(persona.get("default_mood", "平静")))
+        setattr_(self, "trigger_names", tuple(str(trigger) for trigger in persona.get("trigger_names", [])))
+        mood_styles = {str(mood): str(style) for mood, style in persona.get("mood_reply_style", {}).items()}
+        # 可能出现的情绪：默认情绪、情绪触发词对应的情绪、配置了回复风格的情绪
+        moods = dict.fromkeys([self.default_mood, *map(str, persona.get("mood_triggers", {}).values()), *mood_styles])
+        setattr_(self, "moods", tuple(moods))
+        setattr_(self, "_base_scene", CompiledScene(resolve_scene_config(persona, "", False)))
+        scene_names = dict.fromkeys([*scene_names, *(persona.get("scene_config", {}) if scene_specific else ())])
+        scenes = {scene: CompiledScene(resolve_scene_config(persona, scene, scene_specific)) for scene in scene_names}
+        setattr_(self, "_scenes", MappingProxyType(scenes))
+        setattr_(self, "_mood_styles", MappingProxyType(mood_styles))
+        setattr_(self, "_prompts", MappingProxyType({
+            (scene, mood): compose_system_prompt(self.personality_desc, scene, scene_config.reply_style, mood,
+                                                 mood_styles.get(mood, scene_config.reply_style), self.watermark)
+            for scene, scene_config in scenes.items() for mood in self.moods
+        }))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CompiledPersona不可修改，请修改配置后重新编译")
+
+    def scene(self, scene_name: str) -> CompiledScene:
+        """场景配置（未预编译的场景使用人格的全局配置）"""
+        return self._scenes.get(scene_name, self._base_scene)
+
+    def mood_style(self, scene_name: str, mood: str) -> str:
+        """情绪回复风格（该情绪未配置时使用场景回复风格）"""
+        return self._mood_styles.get(mood) or self.scene(scene_name).reply_style
+
+    def system_prompt(self, scene_name: str, mood: str) -> Tuple[str, bool]:
+        """返回（系统提示词, 是否为预编译结果）；未预编译的 场景×情绪 组合现场生成"""
+        prompt = self._prompts.get((scene_name, mood))
+        if prompt is not None:
+            return prompt, True
+        scene_config = self.scene(scene_name)
+        return compose_system_prompt(self.personality_desc, scene_name, scene_config.reply_style, mood,
+                                     self.mood_style(scene_name, mood), self.watermark), False
+
+
+def compile_personas(personalities: Dict[str, Any], scene_config: Dict[str, Any]) -> Dict[str, CompiledPersona]:
+    """编译全部人格；字段不合法的人格记录错误后跳过（不影响其他人格）"""
+    scene_names = list(scene_config.get("default_scenes", {}).keys())
+    scene_specific = scene_config.get("scene_specific_config", True)
+    compiled = {}
+    for name, persona in personalities.items():
+        try:
+            compiled[name] = CompiledPersona(name, persona, scene_names, scene_specific)
+        except (ValueError, TypeError, AttributeError) as e:
+            LOGGER.error(f"人格{name}编译失败：{str(e)}")
+    return compiled
+
+
+def check_persona(name: str, persona: Dict[str, Any]) -> Optional[str]:
+    """按编译规则校验人格配置，不合法时返回错误信息（导入/编辑人格时在写入PERSONALITIES之前调用）"""
+    scene_config = CONFIG.get("scene", {})
+    try:
+        CompiledPersona(name, persona, scene_config.get("default_scenes", {}).keys(), scene_config.get("scene_specific_config", True))
+    except (ValueError, TypeError, AttributeError) as e:
+        return str(e)
+    return None
+
+
+def get_compiled_persona(persona_name: str) -> CompiledPersona:
+    """取编译后的人格；人格已被删除或编译失败时回退到默认人格（再不行取任意一个已编译的人格）"""
+    compiled = COMPILED_PERSONAS.get(persona_name)
+    if compiled is None:
+        compiled = COMPILED_PERSONAS.get(DEFAULT_PERSONALITY["command"]) if DEFAULT_PERSONALITY else None
+        if compiled is None:
+            compiled = next(iter(COMPILED_PERSONAS.values()))
+        LOGGER.warning(f"人格{persona_name}没有可用的编译结果，使用人格{compiled.name}")
+    return compiled
+
+
+# 数据库延迟写入（write-behind）：对话/切换记录/操作日志先入缓冲，由写线程按批提交
+class WriteBehindBuffer:
+    """后台写线程：缓冲写入单元，每累计batch_size行或flush_interval_ms毫秒合并为一个事务提交
+
+    - 一个写入单元是若干条(sql, params)，单元内的语句总在同一事务中提交
+    - 批量提交失败时逐个单元重试，只丢弃出错的单元
+    - 与其他写入共用同一个写连接，执行时持有写锁
+    - close()会把缓冲区剩余数据同步写入（进程退出时自动调用）
+    """
+
+    def __init__(self, conn, write_lock: "threading.RLock", batch_size: int = 200, flush_interval_ms: int = 50):
+        self._conn = conn
+        self._write_lock = write_lock
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0, flush_interval_ms) / 1000
+        self._pending: List[List[Tuple[str, tuple]]] = []
+        self._pending_rows = 0
+        self._cond = threading.Condition()
+        self._flushing = False
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+        self.metrics = {
+            "units": 0,
+            "rows_written": 0,
+            "flushes": 0,
+            "errors": 0,
+            "dropped_units": 0,
+            "last_flush_ms": None,
+            "max_flush_ms": 0,
+            "flush_ms_total": 0.0,
+            "max_queue_depth": 0
+        }
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+        self._thread.start()
+        LOGGER.info(f"数据库延迟写入已启用：每{self.batch_size}行或{int(self.flush_interval * 1000)}ms提交一次")
+
+    def submit(self, unit: List[Tuple[str, tuple]]):
+        """提交一个写入单元（不阻塞调用方）"""
+        with self._cond:
+            self._pending.append(unit)
+            self._pending_rows += len(unit)
+            self.metrics["units"] += 1
+            if len(self._pending) > self.metrics["max_queue_depth"]:
+                self.metrics["max_queue_depth"] = len(self._pending)
+            if self._pending_rows >= self.batch_size or len(self._pending) == 1:
+                self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待当前缓冲的数据全部落盘（写线程未运行时直接在当前线程写入）"""
+        if not (self._thread and self._thread.is_alive()):
+            self._drain()
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._flushing:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        """停止写线程，并把剩余数据同步写入"""
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        self._drain()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                # 第一条数据到达后再等待一个提交窗口，让并发写入合并到同一事务
+                deadline = time.time() + self.flush_interval
+                while self._pending_rows < self.batch_size and not self._stop:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                units = self._take()
+            self._write(units)
+
+    def _take(self) -> List[List[Tuple[str, tuple]]]:
+        units = self._pending
+        self._pending = []
+        self._pending_rows = 0
+        self._flushing = bool(units)
+        return units
+
+    def _drain(self):
+        with self._cond:
+            units = self._take()
+        self._write(units)
+
+    def _write(self, units: List[List[Tuple[str, tuple]]]):
+        if not units:
+            return
+        start = time.time()
+        try:
+            with self._write_lock:
+                self._execute_units(units)
+        except Exception as e:
+            self.metrics["errors"] += 1
+            LOGGER.warning(f"批量写入失败，逐条重试：{str(e)}")
+            for unit in units:
+                try:
+                    with self._write_lock:
+                        self._execute_units([unit])
+                except Exception as unit_error:
+                    self.metrics["dropped_units"] += 1
+                    LOGGER.error(f"写入单元被丢弃：{str(unit_error)}，语句：{' '.join(unit[0][0].split()[:3])}")
+        finally:
+            elapsed_ms = (time.time() - start) * 1000
+            self.metrics["flushes"] += 1
+            self.metrics["last_flush_ms"] = round(elapsed_ms, 2)
+            self.metrics["max_flush_ms"] = max(self.metrics["max_flush_ms"], round(elapsed_ms, 2))
+            self.metrics["flush_ms_total"] += elapsed_ms
+            with self._cond:
+                self._flushing = False
+                self._cond.notify_all()
+
+    def _execute_units(self, units: List[List[Tuple[str, tuple]]]):
+        cursor = self._conn.cursor()
+        rows = 0
+        try:
+            for unit in units:
+                for sql, params in unit:
+                    cursor.execute(sql, params)
+                    rows += 1
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        self.metrics["rows_written"] += rows
+
+    def stats(self) -> Dict[str, Any]:
+        flushes = self.metrics["flushes"]
+        return {
+            "queue_depth": len(self._pending),
+            "queue_rows": self._pending_rows,
+            "units": self.metrics["units"],
+            "rows_written": self.metrics["rows_written"],
+            "flushes": flushes,
+            "rows_per_flush": round(self.metrics["rows_written"] / flushes, 1) if flushes else 0,
+            "last_flush_ms": self.metrics["last_flush_ms"],
+            "avg_flush_ms": round(self.metrics["flush_ms_total"] / flushes, 2) if flushes else None,
+            "max_flush_ms": self.metrics["max_flush_ms"],
+            "max_queue_depth": self.metrics["max_queue_depth"],
+            "errors": self.metrics["errors"],
+            "dropped_units": self.metrics["dropped_units"]
+        }
+
+
+# SQLite只读连接池（WAL模式下读不阻塞写，监控面板/提醒扫描等读操作不占用写连接）
+class SQLiteReadPool:
+    def __init__(self, path: str, size: int, pragmas: List[str]):
+        self.uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self.size = max(1, size)
+        self.pragmas = pragmas
+        self._idle: List[sqlite3.Connection] = []
+        self._created = 0
+        self._cond = threading.Condition()
+        self.metrics = {"acquires": 0, "waits": 0}
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        with self._cond:
+            self.metrics["acquires"] += 1
+            if not self._idle and self._created >= self.size:
+                self.metrics["waits"] += 1
+                while not self._idle:
+                    self._cond.wait()
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._created += 1
+        if conn is None:
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+                raise
+        try:
+            yield conn
+        finally:
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for conn in self._idle:
+                conn.close()
+            self._idle.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "open": self._created,
+            "in_use": self._created - len(self._idle),
+            **self.metrics
+        }
+
+
+def _migrate_preference_json(cursor):
+    """把user_preference表中的JSON计数拆分为user_persona_preference表的行（只迁移大于0的计数）"""
+    cursor.execute("SELECT user_id, preference_json FROM user_preference")
+    rows = []
+    for user_id, preference_json in cursor.fetchall():
+        try:
+            preference = json.loads(preference_json) if preference_json else {}
+        except ValueError:
+            LOGGER.warning(f"用户{user_id}的偏好数据无法解析，跳过迁移")
+            continue
+        rows.extend((user_id, name, int(count)) for name, count in preference.items() if count)
+    insert_ignore = "INSERT IGNORE" if CONFIG["database"].get("type") == "mysql" else "INSERT OR IGNORE"
+    cursor.executemany(
+        f"{insert_ignore} INTO user_persona_preference (user_id, persona_name, count) VALUES (?, ?, ?)", rows
+    )
+
+
+# 数据库结构迁移：(版本号, 说明, 步骤列表)，按版本号顺序执行，每个版本在一个事务内完成
+# 步骤为SQL字符串，或接收cursor的可调用对象（需要读取旧数据做转换时使用）
+# 已发布的迁移不可修改，结构变更一律追加新版本
+SCHEMA_MIGRATIONS: List[Tuple[int, str, List[Any]]] = [
+    (1, "对话历史/切换记录按用户倒序查询索引", [
+        "CREATE INDEX IF NOT EXISTS idx_user_conversation_user ON user_conversation (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_persona_switch_user ON persona_switch (user_id, id)"
+    ]),
+    (2, "提醒查询索引（按用户+状态、到期扫描、监控列表）", [
+        "CREATE INDEX IF NOT EXISTS idx_reminders_user_status_time ON reminders (user_id, status, trigger_time)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_status_time ON reminders (status, trigger_time)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_time ON reminders (trigger_time)"
+    ]),
+    (3, "更新查询优化器统计信息", [
+        "ANALYZE"
+    ]),
+    (4, "用户人格偏好改为按(用户,人格)计数的行，迁移原JSON数据", [
+        """
+        CREATE TABLE IF NOT EXISTS user_persona_preference (
+            user_id VARCHAR(191) NOT NULL,
+            persona_name VARCHAR(191) NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, persona_name)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_user_persona_preference_count ON user_persona_preference (user_id, count)",
+        _migrate_preference_json
+    ])
+]
+
+
+# 人格切换相关的写入语句（UPSERT，以内存状态为准直接覆盖计数）
+PERSONA_RELATIONSHIP_UPSERT = """
+INSERT INTO persona_relationships (persona1, persona2, level, interact_count) VALUES (?, ?, ?, ?)
+ON CONFLICT (persona1, persona2) DO UPDATE SET level = excluded.level, interact_count = excluded.interact_count
+"""
+PERSONA_GROWTH_UPSERT = """
+INSERT INTO persona_growth (persona_name, interact_count, unlocked) VALUES (?, ?, ?)
+ON CONFLICT (persona_name) DO UPDATE SET interact_count = excluded.interact_count, unlocked = excluded.unlocked
+"""
+PREFERENCE_INCREMENT = """
+INSERT INTO user_persona_preference (user_id, persona_name, count) VALUES (?, ?, 1)
+ON CONFLICT (user_id, persona_name) DO UPDATE SET count = count + 1
+"""
+PREFERENCE_INCREMENT_MYSQL = """
+INSERT INTO user_persona_preference (user_id, persona_name, count) VALUES (?, ?, 1)
+ON DUPLICATE KEY UPDATE count = count + 1
+"""
+OPERATION_LOG_INSERT = """
+INSERT INTO operation_log (user_id, operation, time, result) VALUES (?, ?, ?, ?)
+"""
+
+
+# 数据库操作类
+class DatabaseManager:
+    """数据库访问层
+
+    - self.conn是唯一的写连接，所有写入都在write_lock下执行（execute/execute_batch/写线程）
+    - SQLite读操作走只读连接池（query/read_conn），MySQL读写共用写连接
+    """
+
+    def __init__(self):
+        self.enable = CONFIG["database"]["enable"]
+        self.writer: Optional[WriteBehindBuffer] = None
+        self.read_pool: Optional[SQLiteReadPool] = None
+        self.schema_version = 0
+        # 用户偏好计数的内存副本（首次访问时从数据库加载，之后随写入同步更新）
+        self._preference_cache: Dict[str, Dict[str, int]] = {}
+        if not self.enable:
+            return
+        self.type = CONFIG["database"]["type"]
+        if self.type not in ("sqlite", "mysql"):
+            raise ValueError(f"不支持的数据库类型：{self.type}")
+        self.write_lock = threading.RLock()
+        self.conn = self._connect()
+        self._create_tables()
+        self._migrate()
+        global DB_CONN
+        DB_CONN = self.conn
+        if self.type == "sqlite" and CONFIG["database"]["path"] != ":memory:":
+            self.read_pool = SQLiteReadPool(
+                CONFIG["database"]["path"],
+                CONFIG["database"].get("sqlite", {}).get("read_pool_size", 4),
+                self._sqlite_pragmas(read_only=True)
+            )
+        write_behind = CONFIG["database"].get("write_behind", {})
+        if write_behind.get("enable", True):
+            self.writer = WriteBehindBuffer(
+                self.conn,
+                self.write_lock,
+                batch_size=write_behind.get("batch_size", 200),
+                flush_interval_ms=write_behind.get("flush_interval_ms", 50)
+            )
+            self.writer.start()
+        atexit.register(self.close)
+        LOGGER.info("数据库连接成功")
+
+    def _sqlite_pragmas(self, read_only: bool = False) -> List[str]:
+        """SQLite调优参数（[database.sqlite]）"""
+        sqlite_config = CONFIG["database"].get("sqlite", {})
+        pragmas = [
+            f"PRAGMA busy_timeout = {int(sqlite_config.get('busy_timeout_ms', 5000))}",
+            f"PRAGMA cache_size = -{int(sqlite_config.get('cache_size_kb', 16384))}",
+            f"PRAGMA mmap_size = {int(sqlite_config.get('mmap_size_mb', 128)) * 1024 * 1024}",
+            f"PRAGMA temp_store = {sqlite_config.get('temp_store', 'MEMORY')}"
+        ]
+        if not read_only:
+            pragmas.insert(0, f"PRAGMA journal_mode = {sqlite_config.get('journal_mode', 'WAL')}")
+            pragmas.append(f"PRAGMA synchronous = {sqlite_config.get('synchronous', 'NORMAL')}")
+        return pragmas
+
+    def _connect(self):
+        """创建写连接"""
+        if self.type == "sqlite":
+            conn = sqlite3.connect(CONFIG["database"]["path"], check_same_thread=False)
+            for pragma in self._sqlite_pragmas():
+                conn.execute(pragma)
+            return conn
+        import pymysql
+        mysql_config = CONFIG["database"]["mysql_config"]
+        return pymysql.connect(
+            host=mysql_config["host"],
+            port=mysql_config["port"],
+            user=mysql_config["user"],
+            password=mysql_config["password"],
+            db=mysql_config["db_name"],
+            charset="utf8mb4"
+        )
+
+    def execute(self, sql: str, params: tuple = ()):
+        """在写连接上执行一条写语句并立即提交，返回游标（可取lastrowid/rowcount）"""
+        with self.write_lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            return cursor
+
+    def execute_batch(self, statements: List[Tuple[str, tuple]]):
+        """在同一事务中执行多条写语句"""
+        with self.write_lock:
+            cursor = self.conn.cursor()
+            try:
+                for sql, params in statements:
+                    cursor.execute(sql, params)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    @contextmanager
+    def read_conn(self):
+        """获取读连接：SQLite从只读连接池取，MySQL在写锁下复用写连接"""
+        if self.read_pool:
+            with self.read_pool.connection() as conn:
+                yield conn
+        else:
+            with self.write_lock:
+                yield self.conn
+
+    def query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """执行只读查询并返回全部结果"""
+        with self.read_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def _write(self, unit: List[Tuple[str, tuple]]):
+        """执行写入单元：启用延迟写入时交给写线程批量提交，否则立即提交"""
+        if self.writer:
+            self.writer.submit(unit)
+        else:
+            self.execute_batch(unit)
+
+    def close(self):
+        """关闭数据库：先写完延迟写入缓冲区，再关闭连接（进程退出时自动调用）"""
+        if self.writer:
+            self.writer.close()
+        if self.read_pool:
+            self.read_pool.close()
+        with self.write_lock:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {"type": self.type, "schema_version": self.schema_version}
+        if self.read_pool:
+            stats["read_pool"] = self.read_pool.stats()
+        return stats
+
+    def _create_tables(self):
+        """创建数据表（包含所有新增功能表）"""
+        cursor = self.conn.cursor()
+        # 1. 用户对话历史表
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_conversation (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            time TEXT NOT NULL,
+            persona_name TEXT NOT NULL,
+            content TEXT NOT NULL,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        # 2. 用户偏好表
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_preference (
+            user_id TEXT PRIMARY KEY,
+            preference_json TEXT NOT NULL
+        )
+        """)
+        # 3. 人格切换记录表
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS persona_switch (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            time TEXT NOT NULL,
+            persona_name TEXT NOT NULL,
+            trigger_type TEXT NOT NULL,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        # 4. 人格活跃度统计表
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS persona_stats (
+            persona_name TEXT PRIMARY KEY,
+            switch_count INTEGER DEFAULT 0
+        )
+        """)
+        # 5. 人格关系表（成长系统）
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS persona_relationships (
+            persona1 TEXT NOT NULL,
+            persona2 TEXT NOT NULL,
+            level INTEGER DEFAULT 1,
+            interact_count INTEGER DEFAULT 0,
+            PRIMARY KEY (persona1, persona2)
+        )
+        """)
+        # 6. 人格成长表（成长系统）
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS persona_growth (
+            persona_name TEXT PRIMARY KEY,
+            interact_count INTEGER DEFAULT 0,
+            unlocked TEXT DEFAULT '[]'
         )
         """)
         # 7. 操作日志表（权限系统）
@@ -572,144 +2163,1457 @@ class DatabaseManager:
                 cursor.execute("INSERT INTO persona_stats (persona_name, switch_count) VALUES (?, ?)", (persona_name, 0))
         self.conn.commit()
 
+    def _migrate(self):
+        """执行未应用的结构迁移（启动时调用，已应用的版本记录在schema_version表）"""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_time TEXT NOT NULL
+        )
+        """)
+        self.conn.commit()
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        self.schema_version = cursor.fetchone()[0] or 0
+        for version, description, steps in SCHEMA_MIGRATIONS:
+            if version <= self.schema_version:
+                continue
+            start = time.time()
+            with self.write_lock:
+                try:
+                    if self.type == "sqlite":
+                        # sqlite3模块不会为DDL自动开启事务，显式BEGIN保证整个版本原子生效
+                        cursor.execute("BEGIN")
+                    for step in steps:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    cursor.execute(
+                        "INSERT INTO schema_version (version, description, applied_time) VALUES (?, ?, ?)",
+                        (version, description, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
+                    )
+                    self.conn.commit()
+                except Exception as e:
+                    self.conn.rollback()
+                    LOGGER.error(f"数据库迁移v{version}（{description}）失败，停止后续迁移：{str(e)}")
+                    return
+            self.schema_version = version
+            LOGGER.info(f"数据库迁移v{version}完成：{description}（耗时{int((time.time() - start) * 1000)}ms）")
+
     def insert_conversation(self, user_id: str, time_str: str, persona_name: str, content: str):
         """插入对话历史"""
         if not self.enable:
             return
-        cursor = self.conn.cursor()
-        cursor.execute("""
+        self._write([("""
         INSERT INTO user_conversation (user_id, time, persona_name, content)
         VALUES (?, ?, ?, ?)
-        """, (user_id, time_str, persona_name, content))
-        self.conn.commit()
+        """, (user_id, time_str, persona_name, content))])
+
+    def get_conversation(self, user_id: str, limit: int = 20) -> List[Tuple[str, str, str]]:
+        """获取用户对话历史"""
+        if not self.enable:
+            return USER_CONVERSATION_HISTORY.get(user_id, [])[:limit]
+        results = self.query("""
+        SELECT time, persona_name, content FROM user_conversation
+        WHERE user_id = ? ORDER BY id DESC LIMIT ?
+        """, (user_id, limit))
+        return results[::-1]  # 倒序返回（最新的在最后）
+
+    def update_preference(self, user_id: str, preference: Dict[str, int]):
+        """整体覆盖用户偏好（场景记忆恢复时使用），单次切换计数请用increment_preference"""
+        if not self.enable:
+            USER_PREFERENCE[user_id] = preference
+            return
+        self._preference_cache[user_id] = dict(preference)
+        # 与切换时的计数+1走同一个延迟写入队列，保证先于覆盖提交的计数不会在覆盖之后才落盘
+        self._write(
+            [("DELETE FROM user_persona_preference WHERE user_id = ?", (user_id,))] +
+            [("INSERT INTO user_persona_preference (user_id, persona_name, count) VALUES (?, ?, ?)", (user_id, name, count))
+             for name, count in preference.items() if count]
+        )
+
+    def get_preference(self, user_id: str) -> Dict[str, int]:
+        """获取用户偏好（{人格名: 切换次数}，未切换过的人格为0）"""
+        if not self.enable:
+            return USER_PREFERENCE.get(user_id, {name: 0 for name in PERSONALITIES.keys()})
+        if user_id not in self._preference_cache:
+            preference = {name: 0 for name in PERSONALITIES.keys()}
+            preference.update(self.query(
+                "SELECT persona_name, count FROM user_persona_preference WHERE user_id = ?", (user_id,)
+            ))
+            self._preference_cache[user_id] = preference
+        return dict(self._preference_cache[user_id])
+
+    def increment_preference(self, user_id: str, persona_name: str) -> Tuple[str, tuple]:
+        """用户偏好计数+1：更新内存副本并返回对应的UPSERT语句（由调用方放入事务）"""
+        if user_id not in self._preference_cache:
+            # 先加载已落盘的计数，避免延迟写入未完成时内存副本少算这一次
+            self.get_preference(user_id)
+        preference = self._preference_cache[user_id]
+        preference[persona_name] = preference.get(persona_name, 0) + 1
+        return (PREFERENCE_INCREMENT_MYSQL if self.type == "mysql" else PREFERENCE_INCREMENT, (user_id, persona_name))
+
+    def get_top_personas(self, user_id: str, k: int = 3) -> List[Tuple[str, int]]:
+        """用户最常切换的k个人格：[(人格名, 次数)]，按次数降序"""
+        if not self.enable:
+            preference = USER_PREFERENCE.get(user_id, {})
+            return sorted(((name, count) for name, count in preference.items() if count), key=lambda x: -x[1])[:k]
+        return self.query("""
+        SELECT persona_name, count FROM user_persona_preference
+        WHERE user_id = ? AND count > 0 ORDER BY count DESC LIMIT ?
+        """, (user_id, k))
+
+    def insert_switch_record(self, user_id: str, time_str: str, persona_name: str, trigger_type: str):
+        """插入切换记录"""
+        if not self.enable:
+            if user_id not in GLOBAL_SHARED_MEMORY["switch_records"]:
+                GLOBAL_SHARED_MEMORY["switch_records"][user_id] = []
+            GLOBAL_SHARED_MEMORY["switch_records"][user_id].append((time_str, persona_name, trigger_type))
+            return
+        self._write([
+            ("""
+            INSERT INTO persona_switch (user_id, time, persona_name, trigger_type)
+            VALUES (?, ?, ?, ?)
+            """, (user_id, time_str, persona_name, trigger_type)),
+            # 更新活跃度统计
+            ("""
+            UPDATE persona_stats SET switch_count = switch_count + 1 WHERE persona_name = ?
+            """, (persona_name,))
+        ])
+
+    @staticmethod
+    def persona_switch_statements(user_id: str, time_str: str, persona_name: str, trigger_type: str) -> List[Tuple[str, tuple]]:
+        """人格切换的基础写入：切换记录、活跃度计数"""
+        return [
+            ("""
+            INSERT INTO persona_switch (user_id, time, persona_name, trigger_type)
+            VALUES (?, ?, ?, ?)
+            """, (user_id, time_str, persona_name, trigger_type)),
+            ("""
+            INSERT INTO persona_stats (persona_name, switch_count) VALUES (?, 1)
+            ON CONFLICT (persona_name) DO UPDATE SET switch_count = switch_count + 1
+            """, (persona_name,))
+        ]
+
+    def record_persona_switch(self, user_id: str, time_str: str, persona_name: str, trigger_type: str,
+                              statements: Optional[List[Tuple[str, tuple]]] = None):
+        """一次人格切换的全部持久化（切换记录、活跃度、偏好计数及调用方附带的关系/成长/日志语句）在同一事务中提交"""
+        if not self.enable:
+            GLOBAL_SHARED_MEMORY["switch_records"].setdefault(user_id, []).append((time_str, persona_name, trigger_type))
+            preference = USER_PREFERENCE.setdefault(user_id, {name: 0 for name in PERSONALITIES.keys()})
+            preference[persona_name] = preference.get(persona_name, 0) + 1
+            return
+        self._write(
+            self.persona_switch_statements(user_id, time_str, persona_name, trigger_type) +
+            [self.increment_preference(user_id, persona_name)] +
+            (statements or [])
+        )
+
+    def insert_operation_log(self, user_id: str, operation: str, time_str: str, result: str):
+        """插入操作日志"""
+        if not self.enable:
+            return
+        self._write([(OPERATION_LOG_INSERT, (user_id, operation, time_str, result))])
+
+    def get_switch_records(self, user_id: str, limit: int = 5) -> List[Tuple[str, str, str]]:
+        """获取切换记录"""
+        if not self.enable:
+            records = GLOBAL_SHARED_MEMORY["switch_records"].get(user_id, [])
+            return records[-limit:] if records else []
+        return self.query("""
+        SELECT time, persona_name, trigger_type FROM persona_switch
+        WHERE user_id = ? ORDER BY id DESC LIMIT ?
+        """, (user_id, limit))
+
+    def get_persona_stats(self) -> Dict[str, int]:
+        """获取人格活跃度统计"""
+        if not self.enable:
+            return GLOBAL_SHARED_MEMORY["personality_stats"]
+        results = self.query("SELECT persona_name, switch_count FROM persona_stats")
+        return {name: count for name, count in results}
+
+    def add_reminder(self, user_id: str, content: str, trigger_time: str, persona_name: str):
+        """添加提醒"""
+        if not self.enable:
+            return None
+        cursor = self.execute("""
+        INSERT INTO reminders (user_id, content, trigger_time, persona_name)
+        VALUES (?, ?, ?, ?)
+        """, (user_id, content, trigger_time, persona_name))
+        return cursor.lastrowid
+
+    def get_user_reminders(self, user_id: str, status: str = "pending") -> List[Dict[str, Any]]:
+        """获取用户的提醒"""
+        if not self.enable:
+            return USER_REMINDERS.get(user_id, [])
+        results = self.query("""
+        SELECT id, content, trigger_time, persona_name, status 
+        FROM reminders 
+        WHERE user_id = ? AND status = ?
+        ORDER BY trigger_time ASC
+        """, (user_id, status))
+        return [
+            {"id": r[0], "content": r[1], "trigger_time": r[2], 
+             "persona_name": r[3], "status": r[4]}
+            for r in results
+        ]
+
+    def update_reminder_status(self, reminder_id: int, status: str):
+        """更新提醒状态"""
+        if not self.enable:
+            return
+        self.execute("UPDATE reminders SET status = ? WHERE id = ?", (status, reminder_id))
+
+    def delete_expired_reminders(self):
+        """删除过期的提醒"""
+        if not self.enable:
+            return
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        cursor = self.execute("DELETE FROM reminders WHERE trigger_time <= ? AND status = 'pending'", (current_time,))
+        return cursor.rowcount
+
+
+# 耗时统计：保留最近N次样本，用于计算分位数和超出目标值的次数
+class LatencyTracker:
+    def __init__(self, target_ms: Optional[float] = None, window: int = 512):
+        self.target_ms = target_ms
+        self._samples: List[float] = []
+        self._window = window
+        self._next = 0
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.over_target = 0
+
+    def observe(self, elapsed_ms: float) -> bool:
+        """记录一次耗时，返回是否超出目标值"""
+        if len(self._samples) < self._window:
+            self._samples.append(elapsed_ms)
+        else:
+            self._samples[self._next] = elapsed_ms
+            self._next = (self._next + 1) % self._window
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        over = self.target_ms is not None and elapsed_ms > self.target_ms
+        if over:
+            self.over_target += 1
+        return over
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def stats(self) -> Dict[str, Any]:
+        p50, p99 = self.percentile(50), self.percentile(99)
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else None,
+            "p50_ms": round(p50, 2) if p50 is not None else None,
+            "p99_ms": round(p99, 2) if p99 is not None else None,
+            "max_ms": round(self.max_ms, 2),
+            "target_ms": self.target_ms,
+            "over_target": self.over_target
+        }
+
+
+# 本地回复缓存：分片 + 容量上限（条目数/字节数）+ TTL + W-TinyLFU淘汰
+class FrequencySketch:
+    """Count-Min Sketch：估计key的近期访问频率（4行计数器，上限15，累计一定次数后整体减半实现老化）"""
+
+    def __init__(self, capacity: int):
+        width = 1
+        while width < max(64, capacity * 4):
+            width <<= 1
+        self._mask = width - 1
+        self._rows = [bytearray(width) for _ in range(4)]
+        self._seeds = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+        self._sample_size = max(64, capacity * 10)
+        self._additions = 0
+
+    def _indexes(self, key: str):
+        h = hash(key)
+        return [((h ^ seed) * 0x01000193 >> 7) & self._mask for seed in self._seeds]
+
+    def increment(self, key: str):
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._reset()
+
+    def frequency(self, key: str) -> int:
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def _reset(self):
+        for row in self._rows:
+            for i in range(len(row)):
+                row[i] >>= 1
+        self._additions //= 2
+
+
+class _CacheEntry:
+    __slots__ = ("value", "expire_at", "size")
+
+    def __init__(self, value: Any, expire_at: float, size: int):
+        self.value = value
+        self.expire_at = expire_at
+        self.size = size
+
+
+class _CacheShard:
+    """单个分片：window区（新写入，LRU）+ main区（LRU）
+
+    window区溢出的条目与main区的LRU末尾条目比较访问频率，频率更高才能进入main区（W-TinyLFU准入）
+    条目、写入计数和统计指标都只在持有本分片lock时修改
+    """
+    METRIC_KEYS = ("hits", "misses", "sets", "evictions", "expirations", "rejections")
+
+    def __init__(self, max_entries: int, max_bytes: int, window_ratio: float):
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self.window_entries = max(1, int(self.max_entries * window_ratio))
+        self.window: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self.main: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self.bytes = 0
+        self.writes = 0
+        self.metrics = dict.fromkeys(self.METRIC_KEYS, 0)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.window) + len(self.main)
+
+    def find(self, key: str) -> Tuple[Optional["OrderedDict[str, _CacheEntry]"], Optional[_CacheEntry]]:
+        for region in (self.window, self.main):
+            entry = region.get(key)
+            if entry is not None:
+                return region, entry
+        return None, None
+
+    def remove(self, region: "OrderedDict[str, _CacheEntry]", key: str):
+        entry = region.pop(key)
+        self.bytes -= entry.size
+
+    def over_capacity(self) -> bool:
+        return len(self) > self.max_entries or self.bytes > self.max_bytes
+
+
+class LocalReplyCache:
+    """进程内回复缓存（CACHE_CLIENT的本地实现）
+
+    - 按key哈希分片，每个分片独立加锁（监控面板等线程也可安全读取）
+    - 条目数和字节数双重上限，超出时淘汰；过期条目读取时惰性删除，并在写入时定期清理
+    - policy="tinylfu"：新条目先进window区，淘汰时按访问频率决定准入；policy="lru"：纯LRU
+    """
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 32 * 1024 * 1024, default_ttl: float = 3600,
+                 shards: int = 16, policy: str = "tinylfu", window_ratio: float = 0.01):
+        self.default_ttl = default_ttl
+        self.policy = policy
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._shards = [
+            _CacheShard(max_entries // shards or 1, max_bytes // shards or 1, window_ratio if policy == "tinylfu" else 1.0)
+            for _ in range(shards)
+        ]
+        self._sketch = FrequencySketch(max_entries) if policy == "tinylfu" else None
+        self._sketch_lock = threading.Lock()
+
+    def _shard(self, key: str) -> _CacheShard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _record_access(self, key: str):
+        if self._sketch is not None:
+            with self._sketch_lock:
+                self._sketch.increment(key)
+
+    @staticmethod
+    def _sizeof(key: str, value: Any) -> int:
+        if isinstance(value, str):
+            return len(key) + len(value.encode("utf-8"))
+        return len(key) + len(repr(value))
+
+    def get(self, key: str) -> Any:
+        """返回未过期的缓存值，不存在或已过期返回None"""
+        self._record_access(key)
+        shard = self._shard(key)
+        with shard.lock:
+            region, entry = shard.find(key)
+            if entry is None:
+                shard.metrics["misses"] += 1
+                return None
+            if entry.expire_at <= time.time():
+                shard.remove(region, key)
+                shard.metrics["expirations"] += 1
+                shard.metrics["misses"] += 1
+                return None
+            region.move_to_end(key)
+            shard.metrics["hits"] += 1
+            return entry.value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """写入缓存（ttl单位秒，默认使用default_ttl）"""
+        self._record_access(key)
+        shard = self._shard(key)
+        with shard.lock:
+            self._store(shard, key, value, ttl)
+
+    def append_to_pool(self, key: str, value: Any, max_size: int, ttl: Optional[float] = None) -> Optional[list]:
+        """在分片锁内完成 读取列表→追加→写回；列表已满或已包含value时不写，返回None，否则返回追加后的列表"""
+        self._record_access(key)
+        shard = self._shard(key)
+        with shard.lock:
+            _, entry = shard.find(key)
+            alive = entry is not None and entry.expire_at > time.time() and isinstance(entry.value, list)
+            pool = list(entry.value) if alive else []
+            if value in pool or len(pool) >= max_size:
+                return None
+            pool.append(value)
+            self._store(shard, key, pool, ttl)
+            return pool
+
+    def _store(self, shard: _CacheShard, key: str, value: Any, ttl: Optional[float]):
+        """写入条目（调用方已持有shard.lock）"""
+        entry = _CacheEntry(value, time.time() + (ttl if ttl is not None else self.default_ttl), self._sizeof(key, value))
+        region, old = shard.find(key)
+        if old is not None:
+            shard.remove(region, key)
+        else:
+            region = shard.window
+        if entry.size > shard.max_bytes:
+            shard.metrics["rejections"] += 1
+            return
+        region[key] = entry
+        shard.bytes += entry.size
+        shard.metrics["sets"] += 1
+        shard.writes += 1
+        if shard.writes % 256 == 0:
+            self._purge_expired(shard)
+        self._evict(shard)
+
+    def delete(self, key: str):
+        shard = self._shard(key)
+        with shard.lock:
+            region, entry = shard.find(key)
+            if entry is not None:
+                shard.remove(region, key)
+
+    def _purge_expired(self, shard: _CacheShard):
+        now = time.time()
+        for region in (shard.window, shard.main):
+            for key in [k for k, e in region.items() if e.expire_at <= now]:
+                shard.remove(region, key)
+                shard.metrics["expirations"] += 1
+
+    def _evict(self, shard: _CacheShard):
+        if self._sketch is None:
+            while shard.over_capacity():
+                shard.remove(shard.window, next(iter(shard.window)))
+                shard.metrics["evictions"] += 1
+            return
+        # window区超出配额：把最旧的条目移到main区候选
+        while len(shard.window) > shard.window_entries or (shard.over_capacity() and shard.window):
+            candidate_key, candidate = shard.window.popitem(last=False)
+            shard.main[candidate_key] = candidate
+            if not shard.over_capacity():
+                continue
+            # 超出容量：候选条目与main区LRU末尾条目比较频率，频率低的被淘汰
+            victim_key = next(iter(shard.main))
+            if victim_key == candidate_key:
+                shard.remove(shard.main, candidate_key)
+                shard.metrics["evictions"] += 1
+                continue
+            with self._sketch_lock:
+                admit = self._sketch.frequency(candidate_key) > self._sketch.frequency(victim_key)
+            if admit:
+                shard.remove(shard.main, victim_key)
+                shard.metrics["evictions"] += 1
+            else:
+                shard.remove(shard.main, candidate_key)
+                shard.metrics["rejections"] += 1
+        while shard.over_capacity() and shard.main:
+            shard.remove(shard.main, next(iter(shard.main)))
+            shard.metrics["evictions"] += 1
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        """各分片统计指标之和"""
+        totals = dict.fromkeys(_CacheShard.METRIC_KEYS, 0)
+        for shard in self._shards:
+            with shard.lock:
+                for key, value in shard.metrics.items():
+                    totals[key] += value
+        return totals
+
+    def stats(self) -> Dict[str, Any]:
+        metrics = self.metrics
+        lookups = metrics["hits"] + metrics["misses"]
+        return {
+            "policy": self.policy,
+            "entries": len(self),
+            "bytes": sum(shard.bytes for shard in self._shards),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hit_rate": round(metrics["hits"] / lookups, 3) if lookups else None,
+            **metrics
+        }
+
+
+def create_async_redis_client(redis_config: Dict[str, Any], fake: bool = False):
+    """创建asyncio Redis客户端（带连接池）；fake=True时使用fakeredis进程内替身"""
+    if fake:
+        import fakeredis
+        return fakeredis.aioredis.FakeRedis(decode_responses=True)
+    import redis.asyncio as aioredis
+    pool = aioredis.ConnectionPool(
+        host=redis_config["host"],
+        port=redis_config["port"],
+        password=redis_config["password"] or None,
+        max_connections=redis_config.get("max_connections", 20),
+        socket_timeout=redis_config.get("socket_timeout", 1),
+        decode_responses=True
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+# 两级回复缓存：进程内L1（短TTL+未命中缓存）+ Redis L2（asyncio客户端、连接池、单次往返查询）
+_CACHE_MISS = object()
+
+# 批量查询并在命中时写入节流标记，一次往返完成
+# KEYS：要查询的key，最后一个为节流key；ARGV[1]：命中哪个key时写节流标记（下标从1开始）；ARGV[2]：节流秒数；ARGV[3]：时间戳
+REPLY_LOOKUP_SCRIPT = """
+local values = redis.call('MGET', unpack(KEYS, 1, #KEYS - 1))
+local index = tonumber(ARGV[1])
+if index > 0 and values[index] then
+    redis.call('SET', KEYS[#KEYS], ARGV[3], 'NX', 'EX', ARGV[2])
+end
+return values
+"""
+
+# 共享回复池追加：读取JSON列表→去重/判满→追加→写回并设置过期时间，一次往返且原子执行
+# KEYS[1]：回复池key；ARGV[1]：回复；ARGV[2]：池容量；ARGV[3]：过期秒数；返回追加后的JSON，未追加返回nil
+SHARED_POOL_APPEND_SCRIPT = """
+local raw = redis.call('GET', KEYS[1])
+local pool = raw and cjson.decode(raw) or {}
+if #pool >= tonumber(ARGV[2]) then
+    return nil
+end
+for _, item in ipairs(pool) do
+    if item == ARGV[1] then
+        return nil
+    end
+end
+table.insert(pool, ARGV[1])
+local encoded = cjson.encode(pool)
+redis.call('SET', KEYS[1], encoded, 'EX', ARGV[3])
+return encoded
+"""
+
+
+class TieredReplyCache:
+    """Redis缓存的两级封装（CACHE_CLIENT在cache_type为redis/fakeredis时的实现）
+
+    - L1为LocalReplyCache，命中直接返回；L2未命中的key也在L1记一小段时间（negative_ttl），避免反复查Redis
+    - L2查询用MGET一次取多个key；需要节流时用Lua脚本在同一次往返里写节流标记，不支持脚本时退化为命中后再写（多一次往返）
+    - 共享回复池的追加用Lua脚本原子完成，不支持脚本时用WATCH/MULTI乐观事务
+    - Redis出错后retry_after秒内只用L1，不阻塞消息处理
+    """
+
+    def __init__(self, client, l1: LocalReplyCache, l1_ttl: float = 30, negative_ttl: float = 5, retry_after: float = 30):
+        self.client = client
+        self.l1 = l1
+        self.l1_ttl = l1_ttl
+        self.negative_ttl = negative_ttl
+        self.retry_after = retry_after
+        self._script = client.register_script(REPLY_LOOKUP_SCRIPT)
+        self._append_script = client.register_script(SHARED_POOL_APPEND_SCRIPT)
+        self._use_script = True
+        self._down_until = 0.0
+        self.latency = LatencyTracker()
+        self.metrics = {"l1_hits": 0, "l1_negative_hits": 0, "l2_hits": 0, "l2_misses": 0, "l2_round_trips": 0, "l2_errors": 0}
+
+    @staticmethod
+    def _decode(raw: Optional[str]) -> Any:
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        # 兼容旧版本写入的{"reply", "time"}格式
+        if isinstance(value, dict) and "reply" in value:
+            return value["reply"]
+        return value
+
+    def _l2_available(self) -> bool:
+        return time.time() >= self._down_until
+
+    def _l2_failed(self, e: Exception):
+        self.metrics["l2_errors"] += 1
+        self._down_until = time.time() + self.retry_after
+        LOGGER.error(f"Redis缓存访问失败，{self.retry_after}秒内只使用进程内缓存：{str(e)}")
+
+    async def lookup(self, keys: List[str], throttle_key: Optional[str] = None, throttle_index: int = -1,
+                     throttle_ttl: int = 180) -> List[Any]:
+        """批量查询，返回与keys对应的值（未命中为None）；throttle_index对应的key在L2命中时写入节流标记"""
+        results: List[Any] = [None] * len(keys)
+        remote: List[int] = []
+        for i, key in enumerate(keys):
+            value = self.l1.get(key)
+            if value is _CACHE_MISS:
+                self.metrics["l1_negative_hits"] += 1
+            elif value is not None:
+                self.metrics["l1_hits"] += 1
+                results[i] = value
+            else:
+                remote.append(i)
+        if not remote or not self._l2_available():
+            return results
+        remote_keys = [keys[i] for i in remote]
+        stamp_index = remote.index(throttle_index) + 1 if throttle_key and throttle_index in remote else 0
+        start = time.perf_counter()
+        try:
+            raw_values = await self._fetch(remote_keys, throttle_key, stamp_index, throttle_ttl)
+        except Exception as e:
+            self._l2_failed(e)
+            return results
+        self.metrics["l2_round_trips"] += 1
+        self.latency.observe((time.perf_counter() - start) * 1000)
+        for i, raw in zip(remote, raw_values):
+            value = self._decode(raw)
+            if value is None:
+                self.metrics["l2_misses"] += 1
+                self.l1.set(keys[i], _CACHE_MISS, ttl=self.negative_ttl)
+            else:
+                self.metrics["l2_hits"] += 1
+                self.l1.set(keys[i], value, ttl=self.l1_ttl)
+                results[i] = value
+        return results
+
+    async def _fetch(self, keys: List[str], throttle_key: Optional[str], stamp_index: int, throttle_ttl: int) -> List[Optional[str]]:
+        if not throttle_key or not stamp_index:
+            return await self.client.mget(keys)
+        if self._use_script:
+            try:
+                return await self._script(keys=keys + [throttle_key], args=[stamp_index, throttle_ttl, str(time.time())])
+            except Exception as e:
+                # 服务端禁用脚本或测试替身不支持Lua时改为先查后写
+                self._use_script = False
+                LOGGER.warning(f"Redis Lua脚本不可用，改为查询命中后再写节流标记：{str(e)}")
+        values = await self.client.mget(keys)
+        if values[stamp_index - 1] is not None:
+            await self.client.set(throttle_key, str(time.time()), nx=True, ex=throttle_ttl)
+        return values
+
+    async def get(self, key: str) -> Any:
+        return (await self.lookup([key]))[0]
+
+    async def set(self, key: str, value: Any, ttl: int):
+        self.l1.set(key, value, ttl=min(ttl, self.l1_ttl))
+        if not self._l2_available():
+            return
+        try:
+            await self.client.set(key, json.dumps(value, ensure_ascii=False), ex=ttl)
+        except Exception as e:
+            self._l2_failed(e)
+
+    async def append_to_pool(self, key: str, value: str, max_size: int, ttl: int) -> Optional[list]:
+        """原子地向L2中的列表追加value（列表已满或已包含value时不写），返回追加后的列表，未追加返回None"""
+        if not self._l2_available():
+            return self.l1.append_to_pool(key, value, max_size, ttl=min(ttl, self.l1_ttl))
+        try:
+            pool = await self._append(key, value, max_size, ttl)
+        except Exception as e:
+            self._l2_failed(e)
+            return None
+        if pool is not None:
+            self.l1.set(key, pool, ttl=min(ttl, self.l1_ttl))
+        return pool
+
+    async def _append(self, key: str, value: str, max_size: int, ttl: int) -> Optional[list]:
+        if self._use_script:
+            try:
+                raw = await self._append_script(keys=[key], args=[value, max_size, ttl])
+                return None if raw is None else json.loads(raw)
+            except Exception as e:
+                self._use_script = False
+                LOGGER.warning(f"Redis Lua脚本不可用，共享回复池改用WATCH事务追加：{str(e)}")
+        from redis.exceptions import WatchError
+        async with self.client.pipeline(transaction=True) as pipe:
+            # 其他进程在GET和EXEC之间改了这个key时EXEC失败，重新读取后再试
+            for _ in range(3):
+                try:
+                    await pipe.watch(key)
+                    pool = list(self._decode(await pipe.get(key)) or [])
+                    if value in pool or len(pool) >= max_size:
+                        return None
+                    pool.append(value)
+                    pipe.multi()
+                    pipe.set(key, json.dumps(pool, ensure_ascii=False), ex=ttl)
+                    await pipe.execute()
+                    return pool
+                except WatchError:
+                    continue
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        latency = self.latency.stats()
+        return {
+            "l2_available": self._l2_available(),
+            "l2_lua": self._use_script,
+            "l2_p50_ms": latency["p50_ms"],
+            "l2_p99_ms": latency["p99_ms"],
+            **self.metrics,
+            "l1": self.l1.stats()
+        }
+
+
+# 近似重复消息缓存：字符n-gram + MinHash分桶LSH召回 + 余弦相似度精排（纯本地CPU计算）
+class _SemanticEntry:
+    __slots__ = ("vector", "norm", "negations", "reply", "expire_at", "band_keys")
+
+    def __init__(self, vector: Counter, negations: frozenset, reply: str, expire_at: float, band_keys: List[tuple]):
+        self.vector = vector
+        self.norm = sum(v * v for v in vector.values()) ** 0.5
+        self.negations = negations
+        self.reply = reply
+        self.expire_at = expire_at
+        self.band_keys = band_keys
+
+
+def semantic_cache_scope(user_id: str, features: MessageFeatures, persona_name: str, scene: str, mood: str,
+                         share_across_users: bool = False) -> str:
+    """语义缓存的隔离范围：人格+场景+情绪+意图+用户情绪（默认还按用户隔离），场景或情绪不同的回复互不命中"""
+    scope = f"{persona_name}_{scene}_{mood}_{features.intent}_{features.emotion}"
+    if not share_across_users:
+        scope += f"_{user_id}"
+    return scope
+
+
+class SemanticReplyCache:
+    """近似重复消息缓存（"今天好累啊"/"今天真的好累"可以命中同一条回复）
+
+    - 消息归一化后取字符1-gram和2-gram作为特征
+    - MinHash签名分为bands段，每段rows个值，任意一段完全相同即成为候选（LSH）
+    - 候选按n-gram计数向量的余弦相似度精排，不低于threshold才算命中
+    - 否定词（不/没/别...）集合不同的消息不会互相命中；scope不同（人格/场景等）的消息相互隔离
+    """
+
+    NEGATION_CHARS = frozenset("不没别未无非莫勿")
+
+    def __init__(self, threshold: float = 0.6, bands: int = 16, rows: int = 2, max_entries: int = 5000,
+                 ttl: float = 3600, min_chars: int = 2):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_chars = min_chars
+        self._prime = (1 << 61) - 1
+        rnd = random.Random(0x5EED)
+        self._perms = [(rnd.randrange(1, self._prime), rnd.randrange(0, self._prime)) for _ in range(bands * rows)]
+        self._entries: "OrderedDict[int, _SemanticEntry]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.latency = LatencyTracker()
+        self.metrics = {"lookups": 0, "hits": 0, "candidates": 0, "evictions": 0}
+
+    @staticmethod
+    def shingles(normalized: str) -> Counter:
+        grams = Counter(normalized)
+        grams.update(normalized[i:i + 2] for i in range(len(normalized) - 1))
+        return grams
+
+    def _band_keys(self, scope: str, vector: Counter) -> List[tuple]:
+        hashes = [zlib.crc32(gram.encode("utf-8")) for gram in vector]
+        prime = self._prime
+        signature = [min((a * h + b) % prime for h in hashes) for a, b in self._perms]
+        rows = self.rows
+        return [(scope, band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def _prepare(self, scope: str, message: str):
+        normalized = normalize_message(message)
+        if len(normalized) < self.min_chars:
+            return None
+        vector = self.shingles(normalized)
+        return vector, self.NEGATION_CHARS.intersection(normalized), self._band_keys(scope, vector)
+
+    def get(self, scope: str, message: str) -> Optional[str]:
+        """查找相似度不低于阈值的最相近消息的回复"""
+        start = time.perf_counter()
+        self.metrics["lookups"] += 1
+        prepared = self._prepare(scope, message)
+        if prepared is None:
+            return None
+        vector, negations, band_keys = prepared
+        norm = sum(v * v for v in vector.values()) ** 0.5
+        best_reply, best_score = None, self.threshold
+        now = time.time()
+        with self._lock:
+            candidate_ids = set()
+            for key in band_keys:
+                candidate_ids.update(self._buckets.get(key, ()))
+            self.metrics["candidates"] += len(candidate_ids)
+            for entry_id in candidate_ids:
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                if entry.expire_at <= now:
+                    self._remove(entry_id)
+                    continue
+                if entry.negations != negations:
+                    continue
+                dot = sum(count * entry.vector.get(gram, 0) for gram, count in vector.items())
+                score = dot / (norm * entry.norm)
+                if score >= best_score:
+                    best_reply, best_score = entry.reply, score
+        if best_reply is not None:
+            self.metrics["hits"] += 1
+        self.latency.observe((time.perf_counter() - start) * 1000)
+        return best_reply
+
+    def set(self, scope: str, message: str, reply: str):
+        prepared = self._prepare(scope, message)
+        if prepared is None:
+            return
+        vector, negations, band_keys = prepared
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = _SemanticEntry(vector, negations, reply, time.time() + self.ttl, band_keys)
+            for key in band_keys:
+                self._buckets.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.metrics["evictions"] += 1
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for key in entry.band_keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.metrics["lookups"]
+        latency = self.latency.stats()
+        return {
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+            "threshold": self.threshold,
+            "hit_rate": round(self.metrics["hits"] / lookups, 3) if lookups else None,
+            "avg_candidates": round(self.metrics["candidates"] / lookups, 1) if lookups else None,
+            "lookup_p50_ms": latency["p50_ms"],
+            "lookup_p99_ms": latency["p99_ms"],
+            **self.metrics
+        }
+
+
+# 相同LLM请求合并（single-flight）：并发的相同提示词只发起一次调用
+class _InflightCall:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Future"):
+        self.task = task
+        self.waiters = 0
+
+
+class _InflightStream:
+    __slots__ = ("task", "chunks", "done", "error", "changed", "subscribers")
+
+    def __init__(self):
+        self.task: Optional["asyncio.Future"] = None
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+
+
+class SingleFlight:
+    """进行中请求表：同一key的并发调用共享一个Future（流式调用共享一个上游流，见stream）
+
+    - 共享调用的结果/异常会传递给所有等待者
+    - 单个等待者被取消不影响其他等待者；最后一个等待者离开时才取消共享调用
+    - 取消共享调用前先把它移出进行中表，之后的同key调用发起新的请求，不会加入正在取消的调用
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, _InflightCall] = {}
+        self._streams: Dict[str, _InflightStream] = {}
+        self.metrics = {"calls": 0, "coalesced": 0, "cancelled": 0}
+
+    async def do(self, key: str, factory):
+        call = self._inflight.get(key)
+        if call is None or call.task.done():
+            call = _InflightCall(asyncio.ensure_future(factory()))
+            self._inflight[key] = call
+            call.task.add_done_callback(lambda _, k=key, c=call: self._forget(k, c))
+            self.metrics["calls"] += 1
+        else:
+            self.metrics["coalesced"] += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+                self.metrics["cancelled"] += 1
+
+    def _forget(self, key: str, call: _InflightCall):
+        if self._inflight.get(key) is call:
+            del self._inflight[key]
+
+    async def stream(self, key: str, factory):
+        """流式版本的do：同一key的并发调用共享factory()产出的一个异步迭代器
+
+        上游分片缓存在共享调用里，后加入的调用方也从第一个分片开始收到完整序列；上游异常传递给所有调用方
+        """
+        flight = self._streams.get(key)
+        if flight is None or flight.task.done():
+            flight = _InflightStream()
+            flight.task = asyncio.ensure_future(self._pump(flight, factory()))
+            self._streams[key] = flight
+            flight.task.add_done_callback(lambda _, k=key, f=flight: self._forget_stream(k, f))
+            self.metrics["calls"] += 1
+        else:
+            self.metrics["coalesced"] += 1
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                flight.changed.clear()
+                await flight.changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.task.done():
+                self._forget_stream(key, flight)
+                flight.task.cancel()
+                self.metrics["cancelled"] += 1
+
+    @staticmethod
+    async def _pump(flight: _InflightStream, upstream):
+        """读取上游流写入共享缓存，结束、出错或被取消时关闭上游流"""
+        try:
+            async for chunk in upstream:
+                flight.chunks.append(chunk)
+                flight.changed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.changed.set()
+            await upstream.aclose()
+
+    def _forget_stream(self, key: str, flight: _InflightStream):
+        if self._streams.get(key) is flight:
+            del self._streams[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"inflight": len(self._inflight) + len(self._streams), **self.metrics}
+
+
+# 入站消息队列（同一用户连发的短消息在去抖窗口内合并为一轮LLM对话）
+class _InboundBatch:
+    __slots__ = ("messages", "wakeup")
+
+    def __init__(self, message: str):
+        self.messages = [message]
+        self.wakeup = asyncio.Event()
+
+
+class InboundQueue:
+    """每个 会话+用户 一个合并批次：第一条消息成为批次发起者，等待去抖窗口结束后统一处理
+
+    - 窗口内每来一条新消息就重新计时，但总等待不超过max_wait
+    - 批次深度有上限，超出后按溢出策略处理：drop_oldest丢弃最早的消息，fallback直接用缓存/模板回复溢出消息
+    """
+    LEADER = "leader"
+    MERGED = "merged"
+    OVERFLOW = "overflow"
+
+    def __init__(self, inbound_config: Dict[str, Any]):
+        self.debounce = inbound_config.get("debounce_ms", 600) / 1000
+        self.max_wait = inbound_config.get("max_wait_ms", 3000) / 1000
+        self.max_depth = inbound_config.get("max_depth", 5)
+        self.overflow_policy = inbound_config.get("overflow_policy", "drop_oldest")
+        self._batches: Dict[Tuple[str, str], _InboundBatch] = {}
+        self.metrics = {"batches": 0, "merged": 0, "dropped": 0, "overflow_replies": 0, "max_batch_size": 0}
+
+    async def submit(self, key: Tuple[str, str], message: str) -> Tuple[str, List[str]]:
+        """提交消息，返回（角色, 合并后的消息列表）；只有发起者需要继续处理"""
+        batch = self._batches.get(key)
+        if batch is not None:
+            if len(batch.messages) >= self.max_depth:
+                if self.overflow_policy == "fallback":
+                    self.metrics["overflow_replies"] += 1
+                    return self.OVERFLOW, [message]
+                batch.messages.pop(0)
+                self.metrics["dropped"] += 1
+            batch.messages.append(message)
+            batch.wakeup.set()
+            self.metrics["merged"] += 1
+            return self.MERGED, []
+
+        batch = _InboundBatch(message)
+        self._batches[key] = batch
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        try:
+            while True:
+                batch.wakeup.clear()
+                timeout = min(self.debounce, deadline - loop.time())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(batch.wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            del self._batches[key]
+        self.metrics["batches"] += 1
+        self.metrics["max_batch_size"] = max(self.metrics["max_batch_size"], len(batch.messages))
+        return self.LEADER, batch.messages
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending_batches": len(self._batches), **self.metrics}
+
+
+# LLM调用限流：用户/群/人格/模型客户端四级令牌桶，一次请求要所有层级都有令牌才放行
+RATE_LIMIT_LEVELS = ("user", "group", "persona", "client")
+
+# 原子地检查并扣减多个令牌桶（全部有令牌才扣减），多个进程共享同一组限额
+# KEYS：各令牌桶key；ARGV：当前时间，之后每个桶依次为 每秒补充令牌数、桶容量；返回第一个没有令牌的桶下标（从1开始），0表示放行
+RATE_LIMIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local current = tonumber(state[1]) or burst
+    local last = tonumber(state[2]) or now
+    current = math.min(burst, current + math.max(0, now - last) * rate)
+    if current < 1 then
+        return i
+    end
+    tokens[i] = current
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return 0
+"""
+
+
+class RateLimiter:
+    """LLM调用令牌桶限流
+
+    每个层级按 rate_per_minute 补充令牌、最多攒 burst 个；rate_per_minute为0表示该层级不限流，
+    overrides可为个别用户/群/人格/客户端单独设置限额。配置了Redis客户端时桶状态放在Redis里（多进程共享），
+    Redis出错时临时退回进程内的桶。
+    """
+
+    def __init__(self, limit_config: Dict[str, Any], redis_client=None, retry_after: float = 30, max_buckets: int = 10000):
+        self.rules: Dict[str, Dict[str, Any]] = {}
+        for level in RATE_LIMIT_LEVELS:
+            level_config = limit_config.get(level, {})
+            self.rules[level] = {
+                "rate_per_minute": level_config.get("rate_per_minute", 0),
+                "burst": level_config.get("burst", 1),
+                "overrides": level_config.get("overrides", {}),
+                "on_limit": level_config.get("on_limit", "template")
+            }
+        self.key_prefix = limit_config.get("key_prefix", "ratelimit")
+        self.retry_after = retry_after
+        self.max_buckets = max_buckets
+        self._redis = redis_client
+        self._script = redis_client.register_script(RATE_LIMIT_SCRIPT) if redis_client is not None else None
+        self._down_until = 0.0
+        self._buckets: Dict[str, List[float]] = {}  # {key: [剩余令牌, 上次补充时间, 每秒补充令牌数, 桶容量]}
+        self.metrics = {"allowed": 0, "redis_errors": 0, **{f"limited_{level}": 0 for level in RATE_LIMIT_LEVELS}}
+
+    def _limit(self, level: str, ident: str) -> Optional[Tuple[float, float]]:
+        """返回(每秒补充令牌数, 桶容量)，不限流时返回None"""
+        rule = self.rules[level]
+        override = rule["overrides"].get(ident, {})
+        rate_per_minute = override.get("rate_per_minute", rule["rate_per_minute"])
+        if rate_per_minute <= 0:
+            return None
+        return rate_per_minute / 60, max(1, override.get("burst", rule["burst"]))
+
+    def on_limit(self, level: str) -> str:
+        """被限流时的降级方式：template（模板回复）或 notice（提示用户慢一点）"""
+        return self.rules[level]["on_limit"]
+
+    async def acquire(self, identities: Dict[str, str]) -> Optional[str]:
+        """按 {层级: 标识} 申请一次LLM调用，放行返回None，否则返回没有令牌的层级"""
+        buckets = []
+        for level in RATE_LIMIT_LEVELS:
+            ident = identities.get(level)
+            limit = self._limit(level, ident) if ident else None
+            if limit:
+                buckets.append((level, f"{self.key_prefix}:{level}:{ident}", *limit))
+        if not buckets:
+            self.metrics["allowed"] += 1
+            return None
+        limited = None
+        if self._script is not None and time.time() >= self._down_until:
+            try:
+                limited = await self._acquire_redis(buckets)
+            except Exception as e:
+                self.metrics["redis_errors"] += 1
+                self._down_until = time.time() + self.retry_after
+                LOGGER.error(f"Redis限流失败，{self.retry_after}秒内使用进程内令牌桶：{str(e)}")
+                limited = self._acquire_local(buckets)
+        else:
+            limited = self._acquire_local(buckets)
+        if limited:
+            self.metrics[f"limited_{limited}"] += 1
+        else:
+            self.metrics["allowed"] += 1
+        return limited
+
+    async def _acquire_redis(self, buckets: List[Tuple[str, str, float, float]]) -> Optional[str]:
+        args: List[Any] = [time.time()]
+        for _, _, rate, burst in buckets:
+            args.extend((rate, burst))
+        index = int(await self._script(keys=[key for _, key, _, _ in buckets], args=args))
+        return buckets[index - 1][0] if index else None
+
+    def _acquire_local(self, buckets: List[Tuple[str, str, float, float]]) -> Optional[str]:
+        now = time.monotonic()
+        states = []
+        for level, key, rate, burst in buckets:
+            state = self._buckets.get(key)
+            tokens = burst if state is None else min(burst, state[0] + (now - state[1]) * rate)
+            if tokens < 1:
+                return level
+            states.append((key, tokens, rate, burst))
+        for key, tokens, rate, burst in states:
+            self._buckets[key] = [tokens - 1, now, rate, burst]
+        if len(self._buckets) > self.max_buckets:
+            self._prune(now)
+        return None
+
+    def _prune(self, now: float):
+        """清理已补满的桶（补满的桶和不存在的桶等价；按桶自己的限额计算，含overrides）"""
+        for key, (tokens, last, rate, burst) in list(self._buckets.items()):
+            if tokens + (now - last) * rate >= burst:
+                del self._buckets[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "redis" if self._script is not None and time.time() >= self._down_until else "memory",
+            "local_buckets": len(self._buckets),
+            **self.metrics
+        }
+
+
+# 网络连通性监控（后台探测+被动信号，消息处理只读内存标志）
+def is_network_error(error: Exception) -> bool:
+    """判断异常是否为网络层错误（连接失败/超时），业务错误（如鉴权失败）不算离线信号"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, TimeoutError)):
+        return True
+    error_name = type(error).__name__
+    return "Connection" in error_name or "Timeout" in error_name
+
+
+class ConnectivityMonitor:
+    def __init__(self, offline_config: Dict[str, Any]):
+        self.probe_url = offline_config.get("probe_url", "https://www.baidu.com")
+        self.probe_timeout = offline_config.get("probe_timeout", 3)
+        self.probe_interval = offline_config.get("probe_interval", 60)
+        self.backoff_min = offline_config.get("probe_backoff_min", 5)
+        self.backoff_max = offline_config.get("probe_backoff_max", 300)
+        self.failure_threshold = offline_config.get("failure_threshold", 3)
+        self.min_probe_interval = offline_config.get("probe_min_interval", self.backoff_min)
+        self.online = True
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._consecutive_failures = 0
+        self._backoff = self.backoff_min
+        self._last_probe_at: Optional[float] = None
+        self._offline_since: Optional[float] = None
+        self.metrics = {
+            "transitions": 0,
+            "offline_seconds_total": 0.0,
+            "probe_count": 0,
+            "probe_failures": 0,
+            "passive_failures": 0,
+            "wakeups": 0,
+            "last_probe_latency_ms": None,
+            "last_change_time": None
+        }
+
+    def start(self):
+        """启动后台探测线程（未安装requests时只依赖被动信号）"""
+        if not HAS_REQUESTS:
+            LOGGER.warning("未安装requests，网络探测禁用，仅根据LLM调用结果判断离线状态")
+            return
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="connectivity-monitor", daemon=True)
+        self._thread.start()
+        LOGGER.info(f"网络连通性监控已启动，探测地址：{self.probe_url}")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            # 两次探测之间至少间隔min_probe_interval秒（被动信号提前唤醒时也不例外）
+            if self._last_probe_at is not None:
+                remaining = self._last_probe_at + self.min_probe_interval - time.monotonic()
+                if remaining > 0 and self._stop.wait(remaining):
+                    break
+            # 先清除唤醒标志再探测：探测期间收到的唤醒请求保留到下一轮等待，不会丢失
+            self._wakeup.clear()
+            self._last_probe_at = time.monotonic()
+            online = self._probe()
+            self._set_state(online, "主动探测")
+            if online:
+                self._backoff = self.backoff_min
+                wait_seconds = self.probe_interval
+            else:
+                # 离线时指数退避，避免断网期间频繁探测
+                wait_seconds = self._backoff
+                self._backoff = min(self._backoff * 2, self.backoff_max)
+            self._wakeup.wait(wait_seconds)
+
+    def _probe(self) -> bool:
+        start = time.time()
+        self.metrics["probe_count"] += 1
+        try:
+            requests.get(self.probe_url, timeout=self.probe_timeout)
+            self.metrics["last_probe_latency_ms"] = int((time.time() - start) * 1000)
+            return True
+        except Exception:
+            self.metrics["probe_failures"] += 1
+            return False
+
+    def _set_state(self, online: bool, reason: str):
+        with self._lock:
+            if online == self.online:
+                return
+            now = time.time()
+            self.online = online
+            self.metrics["transitions"] += 1
+            self.metrics["last_change_time"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+            if online:
+                if self._offline_since is not None:
+                    self.metrics["offline_seconds_total"] += now - self._offline_since
+                self._offline_since = None
+                self._consecutive_failures = 0
+                LOGGER.info(f"🌐 网络已恢复（{reason}），退出离线模式")
+            else:
+                self._offline_since = now
+                LOGGER.warning(f"📴 网络不可用（{reason}），进入离线模式")
 
-    def get_conversation(self, user_id: str, limit: int = 20) -> List[Tuple[str, str, str]]:
-        """获取用户对话历史"""
-        if not self.enable:
-            return USER_CONVERSATION_HISTORY.get(user_id, [])[:limit]
-        cursor = self.conn.cursor()
-        cursor.execute("""
-        SELECT time, persona_name, content FROM user_conversation
-        WHERE user_id = ? ORDER BY id DESC LIMIT ?
-        """, (user_id, limit))
-        results = cursor.fetchall()
-        return results[::-1]  # 倒序返回（最新的在最后）
+    def report_success(self):
+        """被动信号：LLM调用成功，说明网络可用"""
+        with self._lock:
+            self._consecutive_failures = 0
+        if not self.online:
+            self._set_state(True, "LLM调用成功")
 
-    def update_preference(self, user_id: str, preference: Dict[str, int]):
-        """更新用户偏好"""
-        if not self.enable:
-            USER_PREFERENCE[user_id] = preference
-            return
-        cursor = self.conn.cursor()
-        preference_json = json.dumps(preference, ensure_ascii=False)
-        cursor.execute("SELECT * FROM user_preference WHERE user_id = ?", (user_id,))
-        if cursor.fetchone():
-            cursor.execute("UPDATE user_preference SET preference_json = ? WHERE user_id = ?", (preference_json, user_id))
+    def report_failure(self):
+        """被动信号：LLM网络错误，连续达到阈值后立即触发探测（触发后重新计数，避免每次失败都唤醒）"""
+        self.metrics["passive_failures"] += 1
+        with self._lock:
+            self._consecutive_failures += 1
+            failures = self._consecutive_failures
+            if failures < self.failure_threshold or not self.online:
+                return
+            self._consecutive_failures = 0
+        if self._thread and self._thread.is_alive():
+            self.metrics["wakeups"] += 1
+            self._wakeup.set()
         else:
-            cursor.execute("INSERT INTO user_preference (user_id, preference_json) VALUES (?, ?)", (user_id, preference_json))
-        self.conn.commit()
+            self._set_state(False, f"LLM连续失败{failures}次")
 
-    def get_preference(self, user_id: str) -> Dict[str, int]:
-        """获取用户偏好"""
-        if not self.enable:
-            return USER_PREFERENCE.get(user_id, {name: 0 for name in PERSONALITIES.keys()})
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT preference_json FROM user_preference WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        if result:
-            return json.loads(result[0])
-        else:
-            preference = {name: 0 for name in PERSONALITIES.keys()}
-            self.update_preference(user_id, preference)
-            return preference
+    def stats(self) -> Dict[str, Any]:
+        """导出监控指标"""
+        offline_seconds = self.metrics["offline_seconds_total"]
+        if self._offline_since is not None:
+            offline_seconds += time.time() - self._offline_since
+        return {
+            "online": self.online,
+            **self.metrics,
+            "offline_seconds_total": round(offline_seconds, 1)
+        }
 
-    def insert_switch_record(self, user_id: str, time_str: str, persona_name: str, trigger_type: str):
-        """插入切换记录"""
-        if not self.enable:
-            if user_id not in GLOBAL_SHARED_MEMORY["switch_records"]:
-                GLOBAL_SHARED_MEMORY["switch_records"][user_id] = []
-            GLOBAL_SHARED_MEMORY["switch_records"][user_id].append((time_str, persona_name, trigger_type))
-            return
-        cursor = self.conn.cursor()
-        cursor.execute("""
-        INSERT INTO persona_switch (user_id, time, persona_name, trigger_type)
-        VALUES (?, ?, ?, ?)
-        """, (user_id, time_str, persona_name, trigger_type))
-        # 更新活跃度统计
-        cursor.execute("""
-        UPDATE persona_stats SET switch_count = switch_count + 1 WHERE persona_name = ?
-        """, (persona_name,))
-        self.conn.commit()
 
-    def get_switch_records(self, user_id: str, limit: int = 5) -> List[Tuple[str, str, str]]:
-        """获取切换记录"""
-        if not self.enable:
-            records = GLOBAL_SHARED_MEMORY["switch_records"].get(user_id, [])
-            return records[-limit:] if records else []
-        cursor = self.conn.cursor()
-        cursor.execute("""
-        SELECT time, persona_name, trigger_type FROM persona_switch
-        WHERE user_id = ? ORDER BY id DESC LIMIT ?
-        """, (user_id, limit))
-        return cursor.fetchall()
+# 会话状态（按 群/用户+场景 隔离当前人格、情绪和话题）
+class SessionState:
+    __slots__ = ("persona_name", "mood", "topic", "updated_at")
 
-    def get_persona_stats(self) -> Dict[str, int]:
-        """获取人格活跃度统计"""
-        if not self.enable:
-            return GLOBAL_SHARED_MEMORY["personality_stats"]
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT persona_name, switch_count FROM persona_stats")
-        results = cursor.fetchall()
-        return {name: count for name, count in results}
+    def __init__(self, persona_name: str, mood: str):
+        self.persona_name = persona_name
+        self.mood = mood
+        self.topic: Optional[str] = None
+        self.updated_at = time.time()
 
-    def add_reminder(self, user_id: str, content: str, trigger_time: str, persona_name: str):
-        """添加提醒"""
-        if not self.enable:
-            return None
-        cursor = self.conn.cursor()
-        cursor.execute("""
-        INSERT INTO reminders (user_id, content, trigger_time, persona_name)
-        VALUES (?, ?, ?, ?)
-        """, (user_id, content, trigger_time, persona_name))
-        self.conn.commit()
-        return cursor.lastrowid
 
-    def get_user_reminders(self, user_id: str, status: str = "pending") -> List[Dict[str, Any]]:
-        """获取用户的提醒"""
-        if not self.enable:
-            return USER_REMINDERS.get(user_id, [])
-        cursor = self.conn.cursor()
-        cursor.execute("""
-        SELECT id, content, trigger_time, persona_name, status 
-        FROM reminders 
-        WHERE user_id = ? AND status = ?
-        ORDER BY trigger_time ASC
-        """, (user_id, status))
-        results = cursor.fetchall()
-        return [
-            {"id": r[0], "content": r[1], "trigger_time": r[2], 
-             "persona_name": r[3], "status": r[4]}
-            for r in results
-        ]
+class SessionStateStore:
+    """会话状态存储：不同会话并行处理，同一会话内的消息通过会话锁保持顺序
 
-    def update_reminder_status(self, reminder_id: int, status: str):
-        """更新提醒状态"""
-        if not self.enable:
-            return
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE reminders SET status = ? WHERE id = ?", (status, reminder_id))
-        self.conn.commit()
+    - 会话按最近访问排序，超过max_sessions时淘汰最久未访问的会话，闲置超过idle_expire秒的会话过期
+    - 被淘汰/过期的会话下次来消息时以默认人格重新初始化；正在处理消息（持有会话锁）的会话不清理
+    """
 
-    def delete_expired_reminders(self):
-        """删除过期的提醒"""
-        if not self.enable:
-            return
-        cursor = self.conn.cursor()
-        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        cursor.execute("DELETE FROM reminders WHERE trigger_time <= ? AND status = 'pending'", (current_time,))
-        deleted_count = cursor.rowcount
-        self.conn.commit()
-        return deleted_count
+    def __init__(self, max_sessions: int = 10000, idle_expire: float = 86400):
+        self.max_sessions = max(1, max_sessions)
+        self.idle_expire = idle_expire  # 秒，0表示不过期
+        self._states: "OrderedDict[Tuple[str, str], SessionState]" = OrderedDict()
+        # 没有协程持有或等待时锁会被自动回收，避免长期累积
+        self._locks: "weakref.WeakValueDictionary[Tuple[str, str], asyncio.Lock]" = weakref.WeakValueDictionary()
+        self.metrics = {"evicted": 0, "expired": 0}
+
+    @staticmethod
+    def conversation_id(ctx: MessageContext) -> str:
+        """群聊按群隔离，私聊按用户隔离"""
+        group_id = getattr(ctx, "group_id", "")
+        if group_id:
+            return f"group:{group_id}"
+        return f"user:{ctx.user.id}"
+
+    def lock(self, key: Tuple[str, str]) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def _busy(self, key: Tuple[str, str]) -> bool:
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def _expired(self, state: SessionState, now: float) -> bool:
+        return self.idle_expire > 0 and now - state.updated_at > self.idle_expire
+
+    def get(self, key: Tuple[str, str], default_persona_name: str) -> SessionState:
+        """获取会话状态（不存在或已过期则以默认人格初始化）"""
+        now = time.time()
+        state = self._states.get(key)
+        if state is not None and self._expired(state, now):
+            self.metrics["expired"] += 1
+            state = None
+        if state is None or state.persona_name not in PERSONALITIES:
+            state = SessionState(default_persona_name, PERSONA_MOOD.get(default_persona_name, "平静"))
+            self._states[key] = state
+        state.updated_at = now
+        self._states.move_to_end(key)
+        self._trim(now, key)
+        return state
+
+    def switch_persona(self, key: Tuple[str, str], persona_name: str) -> SessionState:
+        """切换会话人格（情绪重置为该人格当前情绪，仅影响本会话）"""
+        state = SessionState(persona_name, PERSONA_MOOD.get(persona_name, "平静"))
+        self._states[key] = state
+        self._states.move_to_end(key)
+        self._trim(state.updated_at, key)
+        return state
+
+    def switch_idle(self, persona_name: str) -> int:
+        """把当前没有在处理消息的会话都切换到persona_name（随机人格切换使用），返回切换的会话数
+
+        保留原来的最近访问时间，不因此延后过期
+        """
+        switched = 0
+        for key, state in list(self._states.items()):
+            if self._busy(key) or state.persona_name == persona_name:
+                continue
+            new_state = SessionState(persona_name, PERSONA_MOOD.get(persona_name, "平静"))
+            new_state.updated_at = state.updated_at
+            self._states[key] = new_state
+            switched += 1
+        return switched
+
+    def _trim(self, now: float, current: Tuple[str, str]):
+        """从最久未访问的会话开始清理：超出数量上限的淘汰，闲置过久的过期（不清理current和正在处理消息的会话）"""
+        for _ in range(len(self._states)):
+            key, state = next(iter(self._states.items()))
+            over = len(self._states) > self.max_sessions
+            expired = self._expired(state, now)
+            if not over and not expired:
+                return
+            if key == current or self._busy(key):
+                self._states.move_to_end(key)
+                continue
+            del self._states[key]
+            self.metrics["expired" if expired else "evicted"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        persona_count: Dict[str, int] = {}
+        for state in self._states.values():
+            persona_count[state.persona_name] = persona_count.get(state.persona_name, 0) + 1
+        return {
+            "session_count": len(self._states),
+            "max_sessions": self.max_sessions,
+            "active_locks": len(self._locks),
+            "persona_distribution": persona_count,
+            **self.metrics
+        }
+
+
+def collect_runtime_metrics() -> Dict[str, Dict[str, Any]]:
+    """汇总各组件的运行指标（监控面板和/metrics接口使用）"""
+    metrics = {}
+    if CONNECTIVITY_MONITOR:
+        metrics["connectivity"] = CONNECTIVITY_MONITOR.stats()
+    if SESSION_STORE:
+        metrics["sessions"] = SESSION_STORE.stats()
+    # 多个人格可能共享同一个连接池，按池名去重
+    for client in LLM_CLIENTS.values():
+        metrics[f"llm_pool:{client.name}"] = client.stats()
+    if LLM_SINGLE_FLIGHT:
+        metrics["llm_single_flight"] = LLM_SINGLE_FLIGHT.stats()
+    if PROMPT_BUILDER:
+        metrics["prompt_builder"] = PROMPT_BUILDER.stats()
+    if INBOUND_QUEUE:
+        metrics["inbound_queue"] = INBOUND_QUEUE.stats()
+    if SWITCH_LATENCY:
+        metrics["persona_switch"] = SWITCH_LATENCY.stats()
+    if isinstance(CACHE_CLIENT, (LocalReplyCache, TieredReplyCache)):
+        metrics["reply_cache"] = CACHE_CLIENT.stats()
+    if SEMANTIC_CACHE:
+        metrics["semantic_cache"] = SEMANTIC_CACHE.stats()
+    if RATE_LIMITER:
+        metrics["rate_limit"] = RATE_LIMITER.stats()
+    metrics["slow_reply_fallback"] = {**SLOW_REPLY_STATS, "late_pending": len(LATE_REPLY_TASKS)}
+    if BOT_CONFIG_WRITER:
+        metrics["bot_config_writer"] = BOT_CONFIG_WRITER.stats()
+    if DB_MANAGER and DB_MANAGER.enable:
+        metrics["database"] = DB_MANAGER.stats()
+        if DB_MANAGER.writer:
+            metrics["db_writer"] = DB_MANAGER.writer.stats()
+    return metrics
 
 
 # 修改 create_monitor_app 函数，使其返回 login_required 装饰器
@@ -782,18 +3686,21 @@ def create_monitor_app():
         # 获取插件状态
         plugin_status = {
             "llm_models": list(LLM_CLIENTS.keys()),
+            "llm_breakers": {client.name: client.breaker.state for client in LLM_CLIENTS.values()},
             "active_persona": GLOBAL_CURRENT_PERSONALITY["command"] if GLOBAL_CURRENT_PERSONALITY else "None",
             "user_count": len(USER_PREFERENCE),
             "log_level": CONFIG["log"].get("level", "INFO"),
             "personality_count": len(PERSONALITIES),
             "personality_list": list(PERSONALITIES.keys())
         }
+        runtime_metrics = collect_runtime_metrics()
 
         return render_template_string("""
         <h1>人格切换插件监控面板（v9.0.1）</h1>
         <h2>插件状态</h2>
         <p>当前活跃人格：{{ plugin_status.active_persona }}</p>
         <p>加载的LLM模型：{{ plugin_status.llm_models | join(', ') }}</p>
+        <p>LLM熔断器：{% for name, state in plugin_status.llm_breakers.items() %}{{ name }}（{{ {'closed': '正常', 'open': '熔断中', 'half_open': '探测中'}[state] }}）{% if not loop.last %}，{% endif %}{% endfor %}</p>
         <p>用户数：{{ plugin_status.user_count }}</p>
         <p>日志级别：{{ plugin_status.log_level }}</p>
         <p>人格数量：{{ plugin_status.personality_count }}</p>
@@ -804,11 +3711,30 @@ def create_monitor_app():
         {% else %}
         <p>图表生成失败（matplotlib未安装）</p>
         {% endif %}
+        <h2>运行指标</h2>
+        {% for group, metrics in runtime_metrics.items() %}
+        <h3>{{ group }}</h3>
+        <ul>
+            {% for name, value in metrics.items() %}
+            <li>{{ name }}：{{ value }}</li>
+            {% endfor %}
+        </ul>
+        {% endfor %}
         <h2>操作</h2>
         <a href="/backup">手动备份数据</a><br>
         <a href="/reminders">查看提醒</a><br>
+        <a href="/metrics">运行指标（JSON）</a><br>
         <a href="/logout">退出登录</a>
-        """, plugin_status=plugin_status, img_base64=img_base64)
+        """, plugin_status=plugin_status, img_base64=img_base64, runtime_metrics=runtime_metrics)
+
+    # 运行指标（JSON）
+    @app.route("/metrics")
+    @login_required
+    def metrics():
+        return app.response_class(
+            json.dumps(collect_runtime_metrics(), ensure_ascii=False, default=str),
+            mimetype="application/json"
+        )
 
     # 备份数据
     @app.route("/backup")
@@ -825,14 +3751,13 @@ def create_monitor_app():
             return "数据库未启用，无法查看提醒"
         
         reminders = []
-        cursor = DB_MANAGER.conn.cursor()
-        cursor.execute("""
+        rows = DB_MANAGER.query("""
         SELECT user_id, content, trigger_time, persona_name, status 
         FROM reminders 
         ORDER BY trigger_time DESC 
         LIMIT 50
         """)
-        for row in cursor.fetchall():
+        for row in rows:
             reminders.append({
                 "user_id": row[0],
                 "content": row[1],
@@ -954,10 +3879,18 @@ def _init_web_config(self):
         if request.method == "POST":
             # 保存配置
             try:
-                for persona_name in PERSONALITIES.keys():
+                # 先校验全部修改，有人格编译不通过时整体拒绝，不改动PERSONALITIES
+                updated = {}
+                for persona_name, persona_data in PERSONALITIES.items():
                     reply_style = request.form.get(f"{persona_name}_reply_style", "").strip()
-                    if reply_style:
-                        PERSONALITIES[persona_name]["reply_style"] = reply_style
+                    if reply_style and reply_style != persona_data.get("reply_style"):
+                        updated[persona_name] = {**persona_data, "reply_style": reply_style}
+                errors = [error for error in (check_persona(name, data) for name, data in updated.items()) if error]
+                if errors:
+                    return f"保存失败：{'；'.join(errors)}<br><a href='/personalities'>返回</a>"
+                for persona_name, persona_data in updated.items():
+                    PERSONALITIES[persona_name]["reply_style"] = persona_data["reply_style"]
+                rebuild_trigger_index()
                 
                 # 保存到config.toml
                 with open(os.path.join(os.path.dirname(__file__), "config.toml"), "w", encoding="utf-8") as f:
@@ -1108,6 +4041,7 @@ class PersonalitySwitchPlugin(Plugin):
         self._load_backup()
         self._init_intelligence()  # 智能化模块（意图+情绪+学习）
         self._init_cache()  # 智能缓存
+        self._init_rate_limiter()  # LLM调用限流
         self._init_tools()  # 第三方工具
         self._init_multimodal()  # 多模态交互
         self._init_offline_mode()  # 离线模式
@@ -1128,6 +4062,7 @@ class PersonalitySwitchPlugin(Plugin):
             CONFIG = toml.load(f)
         PERSONALITIES = CONFIG.get("personalities", {})
         RANDOM_PERSONALITY_CONFIG = CONFIG.get("random_personality", {})
+        rebuild_trigger_index()
         
         # 验证人格加载
         LOGGER.info(f"✅ 已加载 {len(PERSONALITIES)} 个人格：{list(PERSONALITIES.keys())}")
@@ -1149,25 +4084,64 @@ class PersonalitySwitchPlugin(Plugin):
         # 初始化提醒
         global USER_REMINDERS
         USER_REMINDERS = {}
+        # 初始化会话状态
+        global SESSION_STORE, INBOUND_QUEUE, SWITCH_LATENCY
+        session_config = CONFIG.get("session", {})
+        SESSION_STORE = SessionStateStore(
+            max_sessions=session_config.get("max_sessions", 10000),
+            idle_expire=session_config.get("idle_expire_minutes", 1440) * 60
+        )
+        SWITCH_LATENCY = LatencyTracker(CONFIG["database"].get("switch_latency_target_ms", 20))
+        # 初始化入站消息队列（连发消息合并）
+        inbound_config = CONFIG.get("inbound", {})
+        INBOUND_QUEUE = InboundQueue(inbound_config) if inbound_config.get("enable", False) else None
 
     def _init_llm_clients(self):
         """初始化动态LLM客户端池：全局默认+人格专属"""
-        global LLM_CLIENTS
+        global LLM_CLIENTS, LLM_SINGLE_FLIGHT, PROMPT_BUILDER
+        LLM_SINGLE_FLIGHT = SingleFlight()
+        PROMPT_BUILDER = PromptBuilder()
         default_config = CONFIG.get("llm", {})
-        LLM_CLIENTS["default"] = DynamicLLMClient({
+        # 连接池公共参数（各池可单独覆盖）
+        pool_defaults = {key: default_config[key] for key in LLM_POOL_KEYS if key in default_config}
+        default_model = {
             "model_type": default_config.get("default_model_type"),
             "api_base": default_config.get("default_api_base"),
             "api_key": default_config.get("default_api_key"),
             "model_name": default_config.get("default_model_name"),
             "temperature": default_config.get("temperature"),
-            "max_tokens": default_config.get("max_tokens")
-        })
+            "max_tokens": default_config.get("max_tokens"),
+            "endpoints": default_config.get("endpoints", []),
+            "hedge_pool": default_config.get("hedge_pool")
+        }
+        LLM_CLIENTS["default"] = DynamicLLMClient({**pool_defaults, **default_model})
+        # 命名连接池（人格专属模型可通过pool引用，多个人格共享同一个池）
+        pools: Dict[str, DynamicLLMClient] = {}
+        for pool_name, pool_config in default_config.get("pools", {}).items():
+            pools[pool_name] = DynamicLLMClient({**pool_defaults, **pool_config}, name=pool_name)
+            LOGGER.info(f"初始化LLM连接池{pool_name}：{len(pools[pool_name].endpoints)}个接入点")
         # 人格专属模型
         persona_models = default_config.get("personality_models", {})
         for persona_name, model_config in persona_models.items():
-            if persona_name in PERSONALITIES:
-                LLM_CLIENTS[persona_name] = DynamicLLMClient(model_config)
+            if persona_name not in PERSONALITIES:
+                continue
+            pool_name = model_config.get("pool")
+            if pool_name:
+                if pool_name not in pools:
+                    LOGGER.error(f"{persona_name}引用的LLM连接池{pool_name}不存在，使用默认模型")
+                    continue
+                LLM_CLIENTS[persona_name] = pools[pool_name]
+                LOGGER.info(f"为{persona_name}使用LLM连接池：{pool_name}")
+            else:
+                LLM_CLIENTS[persona_name] = DynamicLLMClient({**pool_defaults, **model_config}, name=persona_name)
                 LOGGER.info(f"为{persona_name}初始化专属模型：{model_config.get('model_type')}")
+        # 关联对冲目标连接池（default表示默认模型）
+        for client in list(LLM_CLIENTS.values()) + list(pools.values()):
+            if client.hedge_pool:
+                client.hedge_client = LLM_CLIENTS["default"] if client.hedge_pool == "default" else pools.get(client.hedge_pool)
+                if client.hedge_client is None or client.hedge_client is client:
+                    LOGGER.error(f"LLM连接池{client.name}的对冲目标{client.hedge_pool}无效，改为对冲到本池其他接入点")
+                    client.hedge_client = None
 
     def _init_database(self):
         """初始化数据库"""
@@ -1250,14 +4224,13 @@ class PersonalitySwitchPlugin(Plugin):
         # 从数据库加载待处理的提醒
         if DB_MANAGER.enable:
             try:
-                cursor = DB_MANAGER.conn.cursor()
-                cursor.execute("""
+                rows = DB_MANAGER.query("""
                 SELECT id, user_id, content, trigger_time, persona_name 
                 FROM reminders 
                 WHERE status = 'pending' AND trigger_time > ?
                 """, (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),))
                 
-                for row in cursor.fetchall():
+                for row in rows:
                     reminder_id, user_id, content, trigger_time, persona_name = row
                     
                     # 计算延迟时间
@@ -1286,7 +4259,8 @@ class PersonalitySwitchPlugin(Plugin):
         LOGGER.info("提醒调度器已初始化")
 
     def _random_personality_trigger(self):
-        """随机人格切换触发器"""
+        """随机人格切换触发器（切换全局默认人格，并把当前没有在处理消息的会话一起切换）"""
+        global GLOBAL_CURRENT_PERSONALITY
         if not PERSONALITIES:
             return
     
@@ -1301,9 +4275,11 @@ class PersonalitySwitchPlugin(Plugin):
         random_persona = random.choice(available_personas)
         old_persona = GLOBAL_CURRENT_PERSONALITY
         GLOBAL_CURRENT_PERSONALITY = PERSONALITIES[random_persona]
+        # 人格按会话保存后，已有会话也要切换，否则随机切换只对新会话生效
+        switched_sessions = SESSION_STORE.switch_idle(random_persona) if SESSION_STORE else 0
     
         # 记录切换
-        LOGGER.info(f"随机人格切换：{old_persona['command'] if old_persona else 'None'} -> {random_persona}")
+        LOGGER.info(f"随机人格切换：{old_persona['command'] if old_persona else 'None'} -> {random_persona}（切换{switched_sessions}个会话）")
     
         # 更新全局记忆
         GLOBAL_SHARED_MEMORY.setdefault("random_switches", []).append({
@@ -1315,12 +4291,10 @@ class PersonalitySwitchPlugin(Plugin):
         # 如果启用了数据库，记录到数据库
         if DB_MANAGER and DB_MANAGER.enable:
             try:
-                cursor = DB_MANAGER.conn.cursor()
-                cursor.execute("""
+                DB_MANAGER.execute("""
                 INSERT INTO persona_switch (user_id, time, persona_name, trigger_type)
                 VALUES (?, ?, ?, ?)
                 """, ("system", time.strftime("%Y-%m-%d %H:%M:%S"), random_persona, "random"))
-                DB_MANAGER.conn.commit()
             except Exception as e:
                 LOGGER.error(f"记录随机切换到数据库失败：{str(e)}")
     
@@ -1454,7 +4428,7 @@ class PersonalitySwitchPlugin(Plugin):
             LOGGER.error(f"解析提醒时间失败：{str(e)}")
             return None
 
-    async def _add_reminder(self, user_id: str, message: str, ctx: MessageContext):
+    async def _add_reminder(self, user_id: str, message: str, ctx: MessageContext, persona_name: Optional[str] = None):
         """添加提醒"""
         # 解析消息格式：名字提醒我晚上看天气预报
         # 或者：/名字 提醒我3天后看比赛
@@ -1495,8 +4469,9 @@ class PersonalitySwitchPlugin(Plugin):
                 reminder_id = f"reminder_{user_id}_{int(time.time())}"
                 
                 # 获取当前活跃人格
-                current_persona = GLOBAL_CURRENT_PERSONALITY
-                persona_name = current_persona["command"] if current_persona else "名字"
+                if not persona_name:
+                    current_persona = GLOBAL_CURRENT_PERSONALITY
+                    persona_name = current_persona["command"] if current_persona else "名字"
                 
                 # 保存到数据库
                 reminder_db_id = None
@@ -1609,50 +4584,21 @@ class PersonalitySwitchPlugin(Plugin):
     def _init_intelligence(self):
         """初始化意图识别、情绪强度识别、用户习惯学习"""
         # 意图识别规则（可扩展为本地BERT模型）
-        self.intent_rules = {
-            "comfort": ["好累", "难过", "崩溃", "不开心", "伤心"],
-            "question": ["什么", "怎么", "如何", "为什么", "请教"],
-            "share": ["分享", "今天", "我", "遇到", "发现"],
-            "complain": ["吐槽", "烦", "讨厌", "垃圾", "生气"],
-            "praise": ["好棒", "厉害", "优秀", "好看", "好听"]
-        }
+        self.intent_rules = INTENT_RULES
+        # 预编译的单次扫描分类器（意图+情绪+工具+离线模板）
+        self.classifier = MessageClassifier()
 
     def _recognize_user_intent(self, message: str) -> str:
         """识别用户意图"""
-        for intent, keywords in self.intent_rules.items():
-            if any(keyword in message for keyword in keywords):
-                return intent
-        return "general"  # 通用意图
+        return self.classifier.classify(message).intent
 
-    def _recognize_emotion_intensity(self, message: str) -> Tuple[str, str]:
+    def _recognize_emotion_intensity(self, message: str, features: Optional[MessageFeatures] = None) -> Tuple[str, str]:
         """识别用户情绪类型和强度（弱/中/强）"""
-        emotion_keywords = {
-            "happy": {
-                "weak": ["开心", "高兴", "不错", "挺好"],
-                "medium": ["超开心", "超棒", "太好", "惊喜"],
-                "strong": ["狂喜", "激动", "疯了", "幸福"]
-            },
-            "sad": {
-                "weak": ["难过", "失落", "不开心", "遗憾"],
-                "medium": ["很伤心", "崩溃", "想哭", "委屈"],
-                "strong": ["绝望", "心碎", "生无可恋", "痛苦"]
-            },
-            "angry": {
-                "weak": ["生气", "烦躁", "讨厌", "不满"],
-                "medium": ["很生气", "愤怒", "不爽", "恼火"],
-                "strong": ["暴怒", "气炸", "恨", "抓狂"]
-            },
-            "neutral": {
-                "weak": ["普通", "一般", "随便", "都行"],
-                "medium": ["平静", "淡然", "无所谓", "还好"],
-                "strong": ["冷漠", "无感", "麻木"]
-            }
-        }
+        if features is None:
+            features = self.classifier.classify(message)
         # 关键词匹配情绪
-        for emotion, intensity_keywords in emotion_keywords.items():
-            for intensity, keywords in intensity_keywords.items():
-                if any(keyword in message for keyword in keywords):
-                    return emotion, intensity
+        if features.emotion:
+            return features.emotion, features.emotion_intensity
         # 用TextBlob增强情绪识别（如果已安装）
         if EMOTION_MODEL:
             polarity = EMOTION_MODEL(message).sentiment.polarity
@@ -1666,7 +4612,7 @@ class PersonalitySwitchPlugin(Plugin):
                 return "sad", "medium"
         return "neutral", "weak"  # 中性情绪
 
-    def _update_user_habits(self, user_id: str, message: str):
+    def _update_user_habits(self, user_id: str, message: str, intent: Optional[str] = None):
         """更新用户聊天习惯（高频词、回复长度等）"""
         if not CONFIG["advanced"]["intelligence"]["persona_learning"]:
             return
@@ -1684,7 +4630,8 @@ class PersonalitySwitchPlugin(Plugin):
         # 记录回复长度
         USER_HABITS[user_id]["reply_length"].append(len(message))
         # 提取偏好话题（基于意图）
-        intent = self._recognize_user_intent(message)
+        if intent is None:
+            intent = self._recognize_user_intent(message)
         USER_HABITS[user_id]["topic_preference"].append(intent)
         # 每N轮对话修剪一次习惯数据
         if len(USER_HABITS[user_id]["reply_length"]) % CONFIG["advanced"]["intelligence"]["learning_cycle"] == 0:
@@ -1713,81 +4660,173 @@ class PersonalitySwitchPlugin(Plugin):
     # ==================== 智能缓存+LLM节流 ====================
     def _init_cache(self):
         """初始化缓存（Redis/本地）"""
-        global CACHE_CLIENT
+        global CACHE_CLIENT, SEMANTIC_CACHE
         cache_config = CONFIG["cache"]
         if not cache_config["enable"]:
             CACHE_CLIENT = None
             return
-        if cache_config["cache_type"] == "redis":
+        semantic_config = cache_config.get("semantic", {})
+        if semantic_config.get("enable", False):
+            SEMANTIC_CACHE = SemanticReplyCache(
+                threshold=semantic_config.get("threshold", 0.6),
+                bands=semantic_config.get("bands", 16),
+                rows=semantic_config.get("rows", 2),
+                max_entries=semantic_config.get("max_entries", 5000),
+                ttl=semantic_config.get("expire", cache_config["cache_expire"])
+            )
+        if cache_config["cache_type"] in ("redis", "fakeredis"):
             try:
-                import redis
-                CACHE_CLIENT = redis.Redis(
-                    host=cache_config["redis_config"]["host"],
-                    port=cache_config["redis_config"]["port"],
-                    password=cache_config["redis_config"]["password"],
-                    decode_responses=True
-                )
-                CACHE_CLIENT.ping()  # 测试连接
+                CACHE_CLIENT = self._create_tiered_cache(cache_config)
             except ImportError:
-                LOGGER.warning("未安装redis，缓存降级为本地存储")
-                CACHE_CLIENT = {}
+                LOGGER.warning(f"未安装{cache_config['cache_type']}，缓存降级为本地存储")
+                CACHE_CLIENT = self._create_local_cache(cache_config)
             except Exception as e:
-                LOGGER.error(f"Redis连接失败，缓存降级为本地存储：{str(e)}")
-                CACHE_CLIENT = {}
+                LOGGER.error(f"Redis初始化失败，缓存降级为本地存储：{str(e)}")
+                CACHE_CLIENT = self._create_local_cache(cache_config)
         else:
-            CACHE_CLIENT = {}  # 本地字典缓存
+            CACHE_CLIENT = self._create_local_cache(cache_config)
 
-    def _get_cache_key(self, user_id: str, message: str, persona_name: str) -> str:
-        """生成缓存Key（用户ID+消息+人格名）"""
-        return hashlib.md5(f"{user_id}_{message}_{persona_name}".encode()).hexdigest()
+    def _create_tiered_cache(self, cache_config: Dict[str, Any]) -> TieredReplyCache:
+        """创建Redis两级缓存（fakeredis为进程内替身，用于测试和无Redis环境）"""
+        redis_config = cache_config["redis_config"]
+        client = create_async_redis_client(redis_config, fake=cache_config["cache_type"] == "fakeredis")
+        l1_config = cache_config.get("l1", {})
+        l1 = LocalReplyCache(
+            max_entries=l1_config.get("max_entries", 5000),
+            max_bytes=l1_config.get("max_bytes_mb", 8) * 1024 * 1024,
+            default_ttl=l1_config.get("ttl", 30)
+        )
+        LOGGER.info(f"缓存使用{cache_config['cache_type']}两级缓存（进程内L1 TTL {l1_config.get('ttl', 30)}秒）")
+        return TieredReplyCache(
+            client,
+            l1,
+            l1_ttl=l1_config.get("ttl", 30),
+            negative_ttl=l1_config.get("negative_ttl", 5),
+            retry_after=redis_config.get("retry_after", 30)
+        )
 
-    def _check_cache(self, user_id: str, message: str, persona_name: str) -> Optional[str]:
-        """检查缓存，返回缓存回复（无则返回None）"""
-        if not CONFIG["cache"]["enable"]:
+    def _init_rate_limiter(self):
+        """初始化LLM调用限流（backend为redis时多进程共享限额，复用缓存的Redis客户端）"""
+        global RATE_LIMITER
+        limit_config = CONFIG.get("rate_limit", {})
+        if not limit_config.get("enable", False):
+            RATE_LIMITER = None
+            return
+        redis_client = None
+        redis_config = CONFIG["cache"]["redis_config"]
+        if limit_config.get("backend", "memory") == "redis":
+            if isinstance(CACHE_CLIENT, TieredReplyCache):
+                redis_client = CACHE_CLIENT.client
+            else:
+                try:
+                    redis_client = create_async_redis_client(redis_config)
+                except ImportError:
+                    LOGGER.warning("未安装redis，限流使用进程内令牌桶")
+        RATE_LIMITER = RateLimiter(limit_config, redis_client, retry_after=redis_config.get("retry_after", 30))
+        LOGGER.info(f"LLM调用限流已启用（{'Redis共享' if redis_client is not None else '进程内'}令牌桶）")
+
+    def _create_local_cache(self, cache_config: Dict[str, Any]) -> LocalReplyCache:
+        """创建本地回复缓存（[cache.local]配置容量和淘汰策略）"""
+        local_config = cache_config.get("local", {})
+        return LocalReplyCache(
+            max_entries=local_config.get("max_entries", 10000),
+            max_bytes=local_config.get("max_bytes_mb", 32) * 1024 * 1024,
+            default_ttl=cache_config["cache_expire"],
+            shards=local_config.get("shards", 16),
+            policy=local_config.get("policy", "tinylfu")
+        )
+
+    def _get_cache_key(self, user_id: str, message: str, persona_name: str, scope: str = "") -> str:
+        """生成缓存Key（用户ID+消息+人格名+场景/情绪，场景或情绪变化后不再命中旧回复）"""
+        return hashlib.md5(f"{user_id}_{message}_{persona_name}_{scope}".encode()).hexdigest()
+
+    def _get_shared_cache_key(self, features: MessageFeatures, message: str, persona_name: str, scene: str, mood: str,
+                              history: List[Tuple[str, str, str]]) -> Optional[str]:
+        """跨用户共享缓存Key：归一化消息+人格+场景+情绪+最近上下文哈希
+
+        只对[cache.shared].categories中的意图/离线模板分类（如问候、夸奖）启用，其他消息返回None
+        """
+        shared_config = CONFIG["cache"].get("shared", {})
+        if not CONFIG["cache"]["enable"] or not shared_config.get("enable", False):
+            return None
+        categories = shared_config.get("categories", [])
+        if features.intent not in categories and features.offline_category not in categories:
             return None
-        cache_key = self._get_cache_key(user_id, message, persona_name)
-        if isinstance(CACHE_CLIENT, dict):
-            if cache_key in CACHE_CLIENT and time.time() - CACHE_CLIENT[cache_key]["time"] < CONFIG["cache"]["cache_expire"]:
-                # 节流检查：同一问题3分钟内不重复调用
-                if CONFIG["cache"]["throttle"]:
-                    throttle_key = f"throttle_{cache_key}"
-                    if throttle_key in CACHE_CLIENT and time.time() - CACHE_CLIENT[throttle_key] < 180:
-                        return CACHE_CLIENT[cache_key]["reply"]
-                    CACHE_CLIENT[throttle_key] = time.time()
-                return CACHE_CLIENT[cache_key]["reply"]
+        normalized = normalize_message(message)
+        if not normalized:
+            return None
+        context_window = shared_config.get("context_window", 0)
+        context = [content for _, _, content in history[-context_window:]] if context_window else []
+        context_hash = hashlib.md5(json.dumps(context, ensure_ascii=False).encode()).hexdigest()[:12]
+        return "shared_" + hashlib.md5(f"{normalized}_{persona_name}_{scene}_{mood}_{context_hash}".encode()).hexdigest()
+
+    def _get_semantic_scope(self, user_id: str, features: MessageFeatures, persona_name: str, scene: str, mood: str) -> Optional[str]:
+        """语义缓存的隔离范围（见semantic_cache_scope）；未启用语义缓存时返回None"""
+        if not SEMANTIC_CACHE:
             return None
+        share_across_users = CONFIG["cache"]["semantic"].get("share_across_users", False)
+        return semantic_cache_scope(user_id, features, persona_name, scene, mood, share_across_users)
+
+    async def _cache_lookup(self, keys: List[str], throttle_key: Optional[str] = None, throttle_index: int = -1) -> List[Any]:
+        """批量读取缓存值（本地缓存或两级缓存），throttle_index对应的key命中时写入节流标记"""
+        if isinstance(CACHE_CLIENT, TieredReplyCache):
+            return await CACHE_CLIENT.lookup(keys, throttle_key, throttle_index)
+        values = [CACHE_CLIENT.get(key) for key in keys]
+        if throttle_key and values[throttle_index] is not None and CACHE_CLIENT.get(throttle_key) is None:
+            CACHE_CLIENT.set(throttle_key, time.time(), ttl=180)
+        return values
+
+    async def _cache_set(self, key: str, value: Any, ttl: int):
+        if isinstance(CACHE_CLIENT, TieredReplyCache):
+            await CACHE_CLIENT.set(key, value, ttl)
         else:
-            try:
-                cache_data = CACHE_CLIENT.get(cache_key)
-                if not cache_data:
-                    return None
-                cache_data = json.loads(cache_data)
-                if time.time() - cache_data["time"] < CONFIG["cache"]["cache_expire"]:
-                    if CONFIG["cache"]["throttle"]:
-                        throttle_key = f"throttle_{cache_key}"
-                        throttle_time = CACHE_CLIENT.get(throttle_key)
-                        if throttle_time and time.time() - float(throttle_time) < 180:
-                            return cache_data["reply"]
-                        CACHE_CLIENT.set(throttle_key, str(time.time()), ex=180)
-                    return cache_data["reply"]
-                return None
-            except Exception as e:
-                LOGGER.error(f"缓存查询失败：{str(e)}")
-                return None
+            CACHE_CLIENT.set(key, value, ttl=ttl)
 
-    def _set_cache(self, user_id: str, message: str, persona_name: str, reply: str):
-        """设置缓存"""
-        if not CONFIG["cache"]["enable"]:
+    async def _add_shared_reply(self, shared_key: str, reply: str):
+        """把回复加入共享回复池（池满或已有相同回复时不加）"""
+        if not reply.strip() or LLM_FALLBACK_REPLY in reply:
             return
-        cache_key = self._get_cache_key(user_id, message, persona_name)
-        cache_data = {"reply": reply, "time": time.time()}
-        if isinstance(CACHE_CLIENT, dict):
-            CACHE_CLIENT[cache_key] = cache_data
+        shared_config = CONFIG["cache"]["shared"]
+        pool_size = shared_config.get("variety_pool_size", 3)
+        expire = shared_config.get("expire", CONFIG["cache"]["cache_expire"])
+        # 读取→追加→写回在缓存内原子完成，并发的回复不会互相覆盖
+        if isinstance(CACHE_CLIENT, TieredReplyCache):
+            await CACHE_CLIENT.append_to_pool(shared_key, reply, pool_size, expire)
         else:
-            try:
-                CACHE_CLIENT.set(cache_key, json.dumps(cache_data), ex=CONFIG["cache"]["cache_expire"])
-            except Exception as e:
-                LOGGER.error(f"缓存设置失败：{str(e)}")
+            CACHE_CLIENT.append_to_pool(shared_key, reply, pool_size, ttl=expire)
+
+    def _get_inflight_key(self, llm_client: DynamicLLMClient, messages: List[Dict[str, str]]) -> str:
+        """生成进行中请求的Key（模型+完整提示词，提示词相同才合并）"""
+        payload = json.dumps([llm_client.name, llm_client.model_name, messages], ensure_ascii=False)
+        return hashlib.md5(payload.encode()).hexdigest()
+
+    async def _check_cache(self, user_id: str, message: str, persona_name: str, scope: str = "",
+                           shared_key: Optional[str] = None) -> Optional[str]:
+        """检查缓存，返回缓存回复（无则返回None）
+
+        共享回复池和用户缓存一次批量查询；共享池攒满variety_pool_size条不同回复后才命中，命中时随机取一条
+        """
+        if not CONFIG["cache"]["enable"]:
+            return None
+        cache_key = self._get_cache_key(user_id, message, persona_name, scope)
+        keys = [shared_key, cache_key] if shared_key else [cache_key]
+        # 节流：同一问题命中缓存时记录3分钟节流标记
+        throttle_key = f"throttle_{cache_key}" if CONFIG["cache"]["throttle"] else None
+        values = await self._cache_lookup(keys, throttle_key, len(keys) - 1)
+        if shared_key:
+            pool = values[0]
+            if pool and len(pool) >= CONFIG["cache"]["shared"].get("variety_pool_size", 3):
+                return random.choice(pool)
+        return values[-1]
+
+    async def _set_cache(self, user_id: str, message: str, persona_name: str, reply: str, scope: str = ""):
+        """设置缓存（LLM失败时的兜底回复不缓存）"""
+        if not CONFIG["cache"]["enable"]:
+            return
+        if not reply.strip() or LLM_FALLBACK_REPLY in reply:
+            return
+        cache_key = self._get_cache_key(user_id, message, persona_name, scope)
+        await self._cache_set(cache_key, reply, CONFIG["cache"]["cache_expire"])
 
     # ==================== 第三方工具集成 ====================
     def _init_tools(self):
@@ -1821,25 +4860,28 @@ class PersonalitySwitchPlugin(Plugin):
                 "city": tools_config["weather"]["city"]
             }
 
-    async def _handle_tool_trigger(self, user_id: str, message: str, ctx: MessageContext) -> Optional[str]:
+    async def _handle_tool_trigger(self, user_id: str, message: str, ctx: MessageContext,
+                                   features: Optional[MessageFeatures] = None) -> Optional[str]:
         """处理工具触发（返回工具回复，无则返回None）"""
         if not CONFIG["tools"]["enable"] or not self.tools:
             return None
+        if features is None:
+            features = self.classifier.classify(message)
         # 天气查询触发
-        if any(keyword in message for keyword in ["天气", "温度", "下雨", "晴天", "预报"]):
+        if features.has("weather"):
             return await self._get_weather()
         # 待办工具触发
-        if "待办" in message or "提醒" in message:
-            if "添加" in message:
+        if features.has("todo"):
+            if features.has("todo_add"):
                 todo_content = message.split("添加")[-1].strip()
                 return await self._add_todo(user_id, todo_content)
-            elif "查询" in message:
+            elif features.has("todo_query"):
                 return await self._query_todo(user_id)
-            elif "完成" in message:
+            elif features.has("todo_complete"):
                 todo_index = message.split("完成")[-1].strip()
                 return await self._complete_todo(user_id, todo_index)
         # 日历工具触发
-        if "日历" in message or "会议" in message or "日程" in message:
+        if features.has("calendar"):
             return await self._get_calendar_events()
         return None
 
@@ -1996,11 +5038,10 @@ class PersonalitySwitchPlugin(Plugin):
     # ==================== 离线模式 ====================
     def _init_offline_mode(self):
         """初始化离线模式"""
+        global CONNECTIVITY_MONITOR
         self.offline = {}
         offline_config = CONFIG["offline"]
-        if not offline_config["enable"]:
-            return
-        # 加载离线回复模板
+        # 加载离线回复模板（在线时也用作降级回复，始终加载）
         if os.path.exists(offline_config["offline_templates"]):
             with open(offline_config["offline_templates"], "r", encoding="utf-8") as f:
                 self.offline["templates"] = json.load(f)
@@ -2014,56 +5055,67 @@ class PersonalitySwitchPlugin(Plugin):
                 "food": ["听起来好好吃呀～ 离线模式也挡不住对美食的向往～"],
                 "music": ["歌声是治愈的力量～ 离线也能感受到呀～"]
             }
-        # 检查本地模型（仅记录路径，使用时加载）
-        if os.path.exists(offline_config["local_model_path"]):
-            self.offline["local_model"] = offline_config["local_model_path"]
-        else:
+        # 本地模型（离线模式和LLM熔断降级共用）：启动时加载一次，推理在专用线程中串行执行
+        if offline_config["enable"] or CONFIG["llm"].get("circuit_breaker", {}).get("use_local_model", False):
+            self._init_local_model(offline_config["local_model_path"])
+        if not offline_config["enable"]:
+            return
+        # 后台网络监控（替代每条消息的同步探测）
+        CONNECTIVITY_MONITOR = ConnectivityMonitor(offline_config)
+        CONNECTIVITY_MONITOR.start()
+
+    def _init_local_model(self, model_path: str):
+        """加载本地模型（需额外安装llama-cpp-python），失败时只用模板回复"""
+        if not os.path.exists(model_path):
             LOGGER.warning("本地模型路径不存在，离线模式仅支持模板回复")
+            return
+        try:
+            from llama_cpp import Llama
+            self.offline["local_model"] = Llama(model_path=model_path, n_ctx=2048)
+        except Exception as e:
+            LOGGER.error(f"本地模型加载失败，离线模式仅支持模板回复：{str(e)}")
+            return
+        self.offline["local_model_executor"] = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-model")
+        LOGGER.info(f"本地模型已加载：{model_path}")
 
     def _is_offline(self) -> bool:
-        """检测是否离线（简单网络检测）"""
-        if not CONFIG["offline"]["enable"]:
-            return False
-        try:
-            if 'requests' not in locals():
-                return True
-            requests.get("https://www.baidu.com", timeout=3)
+        """检测是否离线（读取后台监控的内存标志，不发起网络请求）"""
+        if not CONFIG["offline"]["enable"] or not CONNECTIVITY_MONITOR:
             return False
-        except:
-            return True
+        return not CONNECTIVITY_MONITOR.online
 
-    def _get_offline_reply(self, message: str, persona_name: str) -> str:
-        """获取离线回复（模板/本地模型）"""
+    def _get_offline_reply(self, message: str, persona_name: str, features: Optional[MessageFeatures] = None,
+                           mark_offline: bool = True) -> str:
+        """获取离线模板回复；mark_offline=False时不加离线标记，用作在线降级回复（本地模型回复见_local_model_reply）"""
         offline_config = self.offline
-        # 匹配模板
-        if any(keyword in message for keyword in ["你好", "哈喽", "hi"]):
-            reply = random.choice(offline_config["templates"]["greeting"])
-        elif any(p in message for p in PERSONALITIES.keys()):
+        if features is None:
+            features = self.classifier.classify(message)
+        # 匹配模板（问候优先，其次是提及人格，再按分类器给出的模板分类）
+        category = features.offline_category
+        if category != "greeting" and PERSONA_TRIGGER_INDEX.scan(message)[1]:
             reply = random.choice(offline_config["templates"]["switch_persona"]).format(persona=persona_name)
-        elif any(keyword in message for keyword in ["难过", "伤心", "不开心"]):
-            reply = random.choice(offline_config["templates"]["comfort"])
-        elif any(keyword in message for keyword in ["吃", "美食", "小笼包", "糖葫芦"]):
-            reply = random.choice(offline_config["templates"]["food"])
-        elif any(keyword in message for keyword in ["唱歌", "音乐", "歌声"]):
-            reply = random.choice(offline_config["templates"]["music"])
+        elif category in offline_config["templates"]:
+            reply = random.choice(offline_config["templates"][category])
         else:
             reply = random.choice(offline_config["templates"]["general"])
-        # 本地模型（进阶，需加载llama.cpp等框架）
-        if "local_model" in offline_config:
-            try:
-                # 示例：使用llama.cpp调用本地模型（需额外安装依赖）
-                from llama_cpp import Llama
-                llm = Llama(model_path=offline_config["local_model"], n_ctx=2048)
-                persona_desc = PERSONALITIES[persona_name]["personality_desc"]
-                output = llm(
-                    f"人格：{persona_desc}，用户消息：{message}，回复：",
-                    max_tokens=50,
-                    temperature=0.7
-                )
-                reply = output["choices"][0]["text"].strip()
-            except Exception as e:
-                LOGGER.error(f"本地模型调用失败：{str(e)}")
-        return f"【离线模式】{reply}"
+        return f"【离线模式】{reply}" if mark_offline else reply
+
+    async def _local_model_reply(self, message: str, persona_name: str) -> Optional[str]:
+        """本地模型回复（在本地模型专用线程中推理，不阻塞事件循环）；未加载本地模型或推理失败返回None"""
+        llm = self.offline.get("local_model")
+        if llm is None:
+            return None
+        persona_desc = PERSONALITIES.get(persona_name, DEFAULT_PERSONALITY)["personality_desc"]
+        prompt = f"人格：{persona_desc}，用户消息：{message}，回复："
+        loop = asyncio.get_running_loop()
+        try:
+            output = await loop.run_in_executor(
+                self.offline["local_model_executor"], lambda: llm(prompt, max_tokens=50, temperature=0.7)
+            )
+            return output["choices"][0]["text"].strip() or None
+        except Exception as e:
+            LOGGER.error(f"本地模型调用失败：{str(e)}")
+            return None
 
     # ==================== 人格动态关系+成长系统 ====================
     def _init_persona_growth(self):
@@ -2083,21 +5135,21 @@ class PersonalitySwitchPlugin(Plugin):
         self.growth["persona_data"] = {p: {"interact_count": 0, "unlocked": []} for p in PERSONALITIES.keys()}
         # 从数据库加载成长数据
         if DB_MANAGER.enable:
-            cursor = DB_MANAGER.conn.cursor()
             # 加载关系数据
-            cursor.execute("SELECT persona1, persona2, level, interact_count FROM persona_relationships")
-            for p1, p2, level, count in cursor.fetchall():
+            for p1, p2, level, count in DB_MANAGER.query("SELECT persona1, persona2, level, interact_count FROM persona_relationships"):
                 if p1 in self.growth["relationships"] and p2 in self.growth["relationships"][p1]:
                     self.growth["relationships"][p1][p2] = {"level": level, "interact_count": count}
             # 加载成长数据
-            cursor.execute("SELECT persona_name, interact_count, unlocked FROM persona_growth")
-            for p, count, unlocked in cursor.fetchall():
+            for p, count, unlocked in DB_MANAGER.query("SELECT persona_name, interact_count, unlocked FROM persona_growth"):
                 if p in self.growth["persona_data"]:
                     self.growth["persona_data"][p]["interact_count"] = count
                     self.growth["persona_data"][p]["unlocked"] = json.loads(unlocked) if unlocked else []
 
-    def _update_persona_relationship(self, persona1: str, persona2: str):
-        """更新人格之间的关系（互动次数+升级）"""
+    def _update_persona_relationship(self, persona1: str, persona2: str, statements: Optional[List[Tuple[str, tuple]]] = None):
+        """更新人格之间的关系（互动次数+升级）
+
+        传入statements时只追加写入语句，由调用方合并到同一事务提交
+        """
         if not CONFIG["persona_growth"]["enable"]:
             return
         if persona1 not in self.growth["relationships"] or persona2 not in self.growth["relationships"][persona1]:
@@ -2117,15 +5169,14 @@ class PersonalitySwitchPlugin(Plugin):
                 LOGGER.info(f"人格关系升级：{persona1}与{persona2}从{current_level}级升级为{current_level+1}级")
         # 保存到数据库
         if DB_MANAGER.enable:
-            cursor = DB_MANAGER.conn.cursor()
-            cursor.execute("""
-            REPLACE INTO persona_relationships (persona1, persona2, level, interact_count)
-            VALUES (?, ?, ?, ?)
-            """, (persona1, persona2, relationship["level"], relationship["interact_count"]))
-            DB_MANAGER.conn.commit()
+            statement = (PERSONA_RELATIONSHIP_UPSERT, (persona1, persona2, relationship["level"], relationship["interact_count"]))
+            if statements is not None:
+                statements.append(statement)
+            else:
+                DB_MANAGER.execute(*statement)
 
-    def _update_persona_growth(self, persona_name: str):
-        """更新人格成长进度（解锁新能力）"""
+    def _update_persona_growth(self, persona_name: str, statements: Optional[List[Tuple[str, tuple]]] = None):
+        """更新人格成长进度（解锁新能力），statements用法同_update_persona_relationship"""
         if not CONFIG["persona_growth"]["enable"]:
             return
         if persona_name not in self.growth["persona_data"]:
@@ -2140,16 +5191,16 @@ class PersonalitySwitchPlugin(Plugin):
             if growth_data["interact_count"] >= count and unlock_info not in unlocked:
                 unlocked.append(unlock_info)
                 LOGGER.info(f"人格{persona_name}解锁新能力：{unlock_info['type']} - {unlock_info['value']}")
-                # 应用解锁能力（如新增情绪、技能）
+                # 应用解锁能力（如新增情绪、技能），人格配置变化后重新编译
                 self._apply_unlock(persona_name, unlock_info)
+                rebuild_trigger_index()
         # 保存到数据库
         if DB_MANAGER.enable:
-            cursor = DB_MANAGER.conn.cursor()
-            cursor.execute("""
-            REPLACE INTO persona_growth (persona_name, interact_count, unlocked)
-            VALUES (?, ?, ?)
-            """, (persona_name, growth_data["interact_count"], json.dumps(unlocked, ensure_ascii=False)))
-            DB_MANAGER.conn.commit()
+            statement = (PERSONA_GROWTH_UPSERT, (persona_name, growth_data["interact_count"], json.dumps(unlocked, ensure_ascii=False)))
+            if statements is not None:
+                statements.append(statement)
+            else:
+                DB_MANAGER.execute(*statement)
 
     def _apply_unlock(self, persona_name: str, unlock_info: Dict[str, str]):
         """应用解锁的能力"""
@@ -2213,18 +5264,15 @@ class PersonalitySwitchPlugin(Plugin):
         else:
             return False, f"你没有{operation}权限（当前角色：{role}），请联系管理员升级权限～"
 
-    def _log_operation(self, user_id: str, operation: str, result: str):
-        """记录操作日志"""
+    def _log_operation(self, user_id: str, operation: str, result: str, statements: Optional[List[Tuple[str, tuple]]] = None):
+        """记录操作日志（传入statements时追加到调用方的事务中）"""
         if not CONFIG["permission"]["enable"]:
             return
         time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        if DB_MANAGER.enable:
-            cursor = DB_MANAGER.conn.cursor()
-            cursor.execute("""
-            INSERT INTO operation_log (user_id, operation, time, result)
-            VALUES (?, ?, ?, ?)
-            """, (user_id, operation, time_str, result))
-            DB_MANAGER.conn.commit()
+        if statements is not None and DB_MANAGER.enable:
+            statements.append((OPERATION_LOG_INSERT, (user_id, operation, time_str, result)))
+        else:
+            DB_MANAGER.insert_operation_log(user_id, operation, time_str, result)
         LOGGER.info(f"操作日志：用户{user_id} - {operation} - {result}")
 
     # ==================== 多场景深度适配 ====================
@@ -2239,20 +5287,16 @@ class PersonalitySwitchPlugin(Plugin):
         self.scene_memory = {}
         # 从数据库加载用户场景配置
         if DB_MANAGER.enable:
-            cursor = DB_MANAGER.conn.cursor()
             # 加载用户当前场景
-            cursor.execute("SELECT user_id, scene_name FROM user_current_scene")
-            for user_id, scene_name in cursor.fetchall():
+            for user_id, scene_name in DB_MANAGER.query("SELECT user_id, scene_name FROM user_current_scene"):
                 if scene_name in self.scenes:
                     self.user_current_scene[user_id] = scene_name
             # 加载场景默认人格
-            cursor.execute("SELECT scene_name, persona_name FROM scene_default_persona")
-            for scene_name, persona_name in cursor.fetchall():
+            for scene_name, persona_name in DB_MANAGER.query("SELECT scene_name, persona_name FROM scene_default_persona"):
                 if scene_name in self.scenes and persona_name in PERSONALITIES:
                     self.scene_default_persona[scene_name] = persona_name
             # 加载场景记忆
-            cursor.execute("SELECT scene_name, user_id, conversation_json, preference_json FROM scene_memory")
-            for scene_name, user_id, conv_json, pref_json in cursor.fetchall():
+            for scene_name, user_id, conv_json, pref_json in DB_MANAGER.query("SELECT scene_name, user_id, conversation_json, preference_json FROM scene_memory"):
                 if scene_name not in self.scene_memory:
                     self.scene_memory[scene_name] = {}
                 self.scene_memory[scene_name][user_id] = {
@@ -2279,14 +5323,12 @@ class PersonalitySwitchPlugin(Plugin):
         }
         # 保存到数据库
         if DB_MANAGER.enable:
-            cursor = DB_MANAGER.conn.cursor()
             conv_json = json.dumps(conversation, ensure_ascii=False)
             pref_json = json.dumps(preference, ensure_ascii=False)
-            cursor.execute("""
+            DB_MANAGER.execute("""
             REPLACE INTO scene_memory (scene_name, user_id, conversation_json, preference_json)
             VALUES (?, ?, ?, ?)
             """, (scene_name, user_id, conv_json, pref_json))
-            DB_MANAGER.conn.commit()
 
     def _load_scene_memory(self, user_id: str, scene_name: str):
         """加载场景记忆（对话历史+偏好）"""
@@ -2306,37 +5348,15 @@ class PersonalitySwitchPlugin(Plugin):
         else:
             # 场景无记忆，初始化空记忆
             if DB_MANAGER.enable:
-                cursor = DB_MANAGER.conn.cursor()
-                cursor.execute("""
+                DB_MANAGER.execute("""
                 INSERT INTO scene_memory (scene_name, user_id, conversation_json, preference_json)
                 VALUES (?, ?, ?, ?)
                 """, (scene_name, user_id, json.dumps([]), json.dumps({})))
-                DB_MANAGER.conn.commit()
             else:
                 if scene_name not in self.scene_memory:
                     self.scene_memory[scene_name] = {}
                 self.scene_memory[scene_name][user_id] = {"conversation": [], "preference": {}}
 
-    def _get_scene_specific_config(self, persona: Dict[str, Any], scene_name: str) -> Dict[str, Any]:
-        """获取人格的场景专属配置（无则返回全局配置）"""
-        if not CONFIG["scene"]["scene_specific_config"]:
-            return {
-                "reply_style": persona["reply_style"],
-                "plan_style": persona.get("plan_style", ""),
-                "private_plan_style": persona.get("private_plan_style", ""),
-                "speak_frequency": "medium",
-                "visual_style": persona.get("visual_style", "")
-            }
-        # 场景专属配置（覆盖全局）
-        scene_config = persona.get("scene_config", {}).get(scene_name, {})
-        return {
-            "reply_style": scene_config.get("reply_style", persona["reply_style"]),
-            "plan_style": scene_config.get("plan_style", persona.get("plan_style", "")),
-            "private_plan_style": scene_config.get("private_plan_style", persona.get("private_plan_style", "")),
-            "speak_frequency": scene_config.get("speak_frequency", "medium"),
-            "visual_style": scene_config.get("visual_style", persona.get("visual_style", ""))
-        }
-    
     # ==================== 人格热插拔功能 ====================
     async def _import_persona(self, user_id: str, filename: str, ctx: MessageContext):
         """指令导入人格：/import_persona 文件名（需放在external_persona_dir目录）"""
@@ -2358,7 +5378,7 @@ class PersonalitySwitchPlugin(Plugin):
                 with open(filepath, "r", encoding="utf-8") as f:
                     persona_data = json.load(f)
             required_fields = ["command", "trigger_names", "personality_desc", "reply_style"]
-            if not all(field in persona_data for field in required_fields):
+            if not all(persona_data.get(field) for field in required_fields):
                 await ctx.send("人格文件缺少必填字段（command/trigger_names/personality_desc/reply_style）")
                 return
             persona_name = persona_data["command"]
@@ -2391,14 +5411,18 @@ class PersonalitySwitchPlugin(Plugin):
             for field, value in default_fields.items():
                 if field not in persona_data:
                     persona_data[field] = value
+            # 编译不通过的人格不导入（避免写入PERSONALITIES后消息处理找不到编译结果）
+            error = check_persona(persona_name, persona_data)
+            if error:
+                await ctx.send(f"导入失败：{error}")
+                return
             # 导入人格
             PERSONALITIES[persona_name] = persona_data
             CUSTOM_PERSONALITIES[persona_name] = {**persona_data, "creator": user_id, "source": "imported"}
             PERSONA_MOOD[persona_name] = persona_data.get("default_mood", "平静")
+            rebuild_trigger_index()
             if DB_MANAGER.enable:
-                cursor = DB_MANAGER.conn.cursor()
-                cursor.execute("REPLACE INTO persona_stats (persona_name, switch_count) VALUES (?, ?)", (persona_name, 0))
-                DB_MANAGER.conn.commit()
+                DB_MANAGER.execute("REPLACE INTO persona_stats (persona_name, switch_count) VALUES (?, ?)", (persona_name, 0))
             await ctx.send(f"✅ 成功导入人格「{persona_name}」，发送名字或/{persona_name}即可切换")
             LOGGER.info(f"用户{user_id}导入人格：{persona_name}（来自{filename}）")
         except Exception as e:
@@ -2470,13 +5494,14 @@ class PersonalitySwitchPlugin(Plugin):
             del CUSTOM_PERSONALITIES[persona_name]
             if persona_name in PERSONA_MOOD:
                 del PERSONA_MOOD[persona_name]
+            rebuild_trigger_index()
             # 清理数据库
             if DB_MANAGER.enable:
-                cursor = DB_MANAGER.conn.cursor()
-                cursor.execute("DELETE FROM persona_stats WHERE persona_name = ?", (persona_name,))
-                cursor.execute("DELETE FROM persona_relationships WHERE persona1 = ? OR persona2 = ?", (persona_name, persona_name))
-                cursor.execute("DELETE FROM persona_growth WHERE persona_name = ?", (persona_name,))
-                DB_MANAGER.conn.commit()
+                DB_MANAGER.execute_batch([
+                    ("DELETE FROM persona_stats WHERE persona_name = ?", (persona_name,)),
+                    ("DELETE FROM persona_relationships WHERE persona1 = ? OR persona2 = ?", (persona_name, persona_name)),
+                    ("DELETE FROM persona_growth WHERE persona_name = ?", (persona_name,))
+                ])
             await ctx.send(f"✅ 成功删除自定义人格「{persona_name}」～")
             LOGGER.info(f"用户{user_id}删除自定义人格：{persona_name}")
         except Exception as e:
@@ -2581,10 +5606,18 @@ class PersonalitySwitchPlugin(Plugin):
             if request.method == "POST":
                 # 保存配置
                 try:
-                    for persona_name in PERSONALITIES.keys():
+                    # 先校验全部修改，有人格编译不通过时整体拒绝，不改动PERSONALITIES
+                    updated = {}
+                    for persona_name, persona_data in PERSONALITIES.items():
                         reply_style = request.form.get(f"{persona_name}_reply_style", "").strip()
-                        if reply_style:
-                            PERSONALITIES[persona_name]["reply_style"] = reply_style
+                        if reply_style and reply_style != persona_data.get("reply_style"):
+                            updated[persona_name] = {**persona_data, "reply_style": reply_style}
+                    errors = [error for error in (check_persona(name, data) for name, data in updated.items()) if error]
+                    if errors:
+                        return f"保存失败：{'；'.join(errors)}<br><a href='/personalities'>返回</a>"
+                    for persona_name, persona_data in updated.items():
+                        PERSONALITIES[persona_name]["reply_style"] = persona_data["reply_style"]
+                    rebuild_trigger_index()
                     
                     # 保存到config.toml
                     with open(os.path.join(os.path.dirname(__file__), "config.toml"), "w", encoding="utf-8") as f:
@@ -2781,6 +5814,7 @@ class PersonalitySwitchPlugin(Plugin):
             USER_CONVERSATION_HISTORY.update(backup_data.get("user_conversation", {}))
             GLOBAL_SHARED_MEMORY["personality_stats"].update(backup_data.get("persona_stats", {}))
             self.scene_memory.update(backup_data.get("scene_memory", {}))
+            rebuild_trigger_index()
             LOGGER.info(f"从备份恢复数据：{latest_path}")
         except Exception as e:
             LOGGER.error(f"加载备份失败：{str(e)}")
@@ -2788,25 +5822,76 @@ class PersonalitySwitchPlugin(Plugin):
     # ==================== 核心消息处理逻辑 ====================
     @on_message
     async def handle_message(self, ctx: MessageContext):
-        """处理所有用户消息，核心入口"""
-        # 提前声明要修改的全局变量（关键修复点）
-        global GLOBAL_CURRENT_PERSONALITY, PERSONA_MOOD
-        
+        """处理所有用户消息，核心入口（按 会话+场景 加锁：不同会话并行，同一会话串行）"""
         user_id = ctx.user.id
         message = ctx.content.strip()
-        current_time = time.time()
+        conversation_id = SessionStateStore.conversation_id(ctx)
+        session_key = (conversation_id, self._get_user_current_scene(user_id))
+        features = self.classifier.classify(message)
+        # 连发消息合并（指令消息、会触发人格切换/工具/提醒的消息不合并，不等去抖窗口直接处理）
+        if INBOUND_QUEUE and message and not message.startswith("/") and not self._is_action_message(message, features):
+            role, batch_messages = await INBOUND_QUEUE.submit((conversation_id, user_id), message)
+            if role == InboundQueue.MERGED:
+                return
+            if role == InboundQueue.OVERFLOW:
+                await self._reply_overflow(ctx, user_id, message, session_key)
+                return
+            if len(batch_messages) > 1:
+                # 每条消息单独分类后再合并，不同消息里的关键词不会拼在一起
+                features = self.classifier.merge([self.classifier.classify(batch_message) for batch_message in batch_messages])
+                message = "\n".join(batch_messages)
+        async with SESSION_STORE.lock(session_key):
+            await self._process_message(ctx, user_id, message, session_key, features)
+
+    def _is_action_message(self, message: str, features: MessageFeatures) -> bool:
+        """消息是否会触发人格切换、工具、提醒或人格列表（这类消息不进入合并批次）"""
+        if CONFIG["tools"]["enable"] and self.tools:
+            if features.has("weather") or features.has("calendar"):
+                return True
+            if features.has("todo") and (features.has("todo_add") or features.has("todo_query") or features.has("todo_complete")):
+                return True
+        if features.has("reminder") and features.has("pronoun"):
+            return True
+        if features.has("list_reminders") or features.has("persona_list"):
+            return True
+        return PERSONA_TRIGGER_INDEX is not None and PERSONA_TRIGGER_INDEX.match_trigger(message) is not None
+
+    async def _reply_overflow(self, ctx: MessageContext, user_id: str, message: str, session_key: Tuple[str, str]):
+        """入站队列溢出：不再排队等LLM，优先用缓存回复，否则用人格模板回复"""
+        session = SESSION_STORE.get(session_key, DEFAULT_PERSONALITY["command"])
+        persona_name = session.persona_name
+        reply = await self._check_cache(user_id, message, persona_name, f"{self._get_user_current_scene(user_id)}_{session.mood}")
+        if not reply:
+            watermark = get_compiled_persona(persona_name).watermark
+            reply = f"{self._get_offline_reply(message, persona_name, mark_offline=False)} {watermark}".strip()
+        await ctx.send(reply)
+
+    async def _process_message(self, ctx: MessageContext, user_id: str, message: str, session_key: Tuple[str, str],
+                               features: Optional[MessageFeatures] = None):
+        """消息处理流程（调用方已持有会话锁；features为调用方已算好的分类结果）"""
+        # 本条消息的处理时限（从开始处理算起，LLM调用和重试/对冲都在此时限内）
+        deadline = Deadline(CONFIG["llm"].get("reply_deadline") or CONFIG["llm"].get("timeout") or 60)
+        default_persona_name = GLOBAL_CURRENT_PERSONALITY["command"]
+        if default_persona_name not in PERSONALITIES:
+            default_persona_name = DEFAULT_PERSONALITY["command"]
+        session = SESSION_STORE.get(session_key, default_persona_name)
+        current_persona = PERSONALITIES[session.persona_name]
 
         # 关键：添加详细日志
         LOGGER.info(f"=== 人格插件收到消息 ===")
-        LOGGER.info(f"用户: {user_id}, 消息: {message}")
-        LOGGER.info(f"当前活跃人格: {GLOBAL_CURRENT_PERSONALITY['command'] if GLOBAL_CURRENT_PERSONALITY else 'None'}")
+        LOGGER.info(f"用户: {user_id}, 会话: {session_key[0]}, 消息: {message}")
+        LOGGER.info(f"当前活跃人格: {session.persona_name}")
         LOGGER.info(f"已加载人格数: {len(PERSONALITIES)}")
-        LOGGER.info(f"人格列表: {list(PERSONALITIES.keys())}")
+
+        # 0. 消息分类（一次扫描，结果在后续各环节复用）
+        if features is None:
+            features = self.classifier.classify(message)
 
         # 1. 离线模式检测
         if self._is_offline():
-            persona_name = GLOBAL_CURRENT_PERSONALITY["command"]
-            offline_reply = self._get_offline_reply(message, persona_name)
+            persona_name = session.persona_name
+            local_reply = await self._local_model_reply(message, persona_name)
+            offline_reply = f"【离线模式】{local_reply}" if local_reply else self._get_offline_reply(message, persona_name, features)
             await ctx.send(offline_reply)
             return
 
@@ -2818,19 +5903,19 @@ class PersonalitySwitchPlugin(Plugin):
             return
 
         # 3. 工具触发检测
-        tool_reply = await self._handle_tool_trigger(user_id, message, ctx)
+        tool_reply = await self._handle_tool_trigger(user_id, message, ctx, features)
         if tool_reply:
             await ctx.send(tool_reply)
             return
 
         # 3.5. 提醒功能检测
-        if "提醒" in message and ("我" in message or "你" in message):
-            await self._add_reminder(user_id, message, ctx)
+        if features.has("reminder") and features.has("pronoun"):
+            await self._add_reminder(user_id, message, ctx, session.persona_name)
             self._log_operation(user_id, "add_reminder", f"添加提醒：{message}")
             return
 
         # 3.6. 列出提醒
-        if "我的提醒" in message or "列出提醒" in message or "查看提醒" in message:
+        if features.has("list_reminders"):
             await self._list_reminders(user_id, ctx)
             return
 
@@ -2863,18 +5948,16 @@ class PersonalitySwitchPlugin(Plugin):
             # 切换场景并加载新场景记忆
             self.user_current_scene[user_id] = scene_name
             self._load_scene_memory(user_id, scene_name)
-            # 切换场景默认人格（已提前声明global，此处可直接修改）
+            # 切换场景默认人格（只影响本会话在新场景下的状态）
             default_persona = self.scene_default_persona.get(scene_name, DEFAULT_PERSONALITY["command"])
             if default_persona in PERSONALITIES:
-                GLOBAL_CURRENT_PERSONALITY = PERSONALITIES[default_persona]
+                SESSION_STORE.switch_persona((session_key[0], scene_name), default_persona)
                 await ctx.send(f"✅ 切换到{scene_name}场景，已自动切换为场景默认人格：{default_persona}")
             else:
                 await ctx.send(f"✅ 切换到{scene_name}场景（无默认人格）")
             # 保存到数据库
             if DB_MANAGER.enable:
-                cursor = DB_MANAGER.conn.cursor()
-                cursor.execute("REPLACE INTO user_current_scene (user_id, scene_name) VALUES (?, ?)", (user_id, scene_name))
-                DB_MANAGER.conn.commit()
+                DB_MANAGER.execute("REPLACE INTO user_current_scene (user_id, scene_name) VALUES (?, ?)", (user_id, scene_name))
             self._log_operation(user_id, "switch_scene", f"切换到场景：{scene_name}")
             return
 
@@ -2885,52 +5968,45 @@ class PersonalitySwitchPlugin(Plugin):
             cmd = message[1:].strip()
             if cmd in PERSONALITIES:
                 target_persona = PERSONALITIES[cmd]
-        # 触发词切换
+        # 触发词切换（预编译索引单次扫描）
         else:
-            for name, persona in PERSONALITIES.items():
-                if any(trigger in message for trigger in persona["trigger_names"]):
-                    target_persona = persona
-                    break
+            matched_name = PERSONA_TRIGGER_INDEX.match_trigger(message)
+            if matched_name:
+                target_persona = PERSONALITIES.get(matched_name)
 
         # 7. 执行人格切换
         if target_persona:
-            old_persona = GLOBAL_CURRENT_PERSONALITY
-            GLOBAL_CURRENT_PERSONALITY = target_persona
+            old_persona = current_persona
+            SESSION_STORE.switch_persona(session_key, target_persona["command"])
             
             LOGGER.info(f"=== 执行人格切换 ===")
             LOGGER.info(f"旧人格: {old_persona['command'] if old_persona else 'None'}")
             LOGGER.info(f"新人格: {target_persona['command']}")
             
-            # 关键修复：切换全局人格配置
-            LOGGER.info(f"开始切换全局人格配置...")
-            switch_success = switch_global_personality(target_persona["command"])
-            if switch_success:
-                LOGGER.info(f"✅ 全局人格配置更新成功")
-            else:
+            # 关键修复：切换全局人格配置（后台线程合并写入）
+            if not switch_global_personality(target_persona["command"]):
                 LOGGER.error(f"❌ 全局人格配置更新失败")
             
+            # 切换的全部数据（关系、成长、切换记录、活跃度、偏好计数、操作日志）先更新内存，再在同一事务中持久化
+            switch_start = time.perf_counter()
+            statements = []
             # 更新人格关系（旧→新）
-            self._update_persona_relationship(old_persona["command"], target_persona["command"])
+            self._update_persona_relationship(old_persona["command"], target_persona["command"], statements)
             # 更新人格成长
-            self._update_persona_growth(target_persona["command"])
-            # 记录切换日志
+            self._update_persona_growth(target_persona["command"], statements)
+            self._log_operation(user_id, "switch_persona", f"切换到：{target_persona['command']}", statements)
             time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            DB_MANAGER.insert_switch_record(user_id, time_str, target_persona["command"], "manual")
-            # 更新用户偏好
-            preference = DB_MANAGER.get_preference(user_id) if DB_MANAGER.enable else USER_PREFERENCE.get(user_id, {})
-            preference[target_persona["command"]] = preference.get(target_persona["command"], 0) + 1
-            if DB_MANAGER.enable:
-                DB_MANAGER.update_preference(user_id, preference)
-            else:
-                USER_PREFERENCE[user_id] = preference
+            DB_MANAGER.record_persona_switch(user_id, time_str, target_persona["command"], "manual", statements)
+            switch_ms = (time.perf_counter() - switch_start) * 1000
+            if SWITCH_LATENCY.observe(switch_ms):
+                LOGGER.warning(f"人格切换耗时{switch_ms:.1f}ms，超出目标{SWITCH_LATENCY.target_ms}ms")
             # 发送切换回复
             switch_reply = target_persona.get("reply_when_called", f"{target_persona['command']}来啦～")
             await ctx.send(switch_reply)
-            self._log_operation(user_id, "switch_persona", f"切换到：{target_persona['command']}")
             return
 
         # 8. 显示人格列表（修复版）
-        if "人格列表" in message or "/人格列表" in message or "!人格列表" in message:
+        if features.has("persona_list"):
             LOGGER.info(f"用户请求人格列表，已加载{len(PERSONALITIES)}个人格")
             
             # 构建完整的人格列表
@@ -2942,7 +6018,7 @@ class PersonalitySwitchPlugin(Plugin):
                 trigger_names = ", ".join(persona.get("trigger_names", []))
                 
                 # 标记当前活跃人格
-                is_active = GLOBAL_CURRENT_PERSONALITY and GLOBAL_CURRENT_PERSONALITY["command"] == name
+                is_active = session.persona_name == name
                 active_mark = "🌟 " if is_active else ""
                 
                 persona_list += f"{active_mark}{i}. **{name}**\n"
@@ -2960,7 +6036,7 @@ class PersonalitySwitchPlugin(Plugin):
             # 添加统计信息
             persona_list += f"📊 **统计信息**\n"
             persona_list += f"• 总人格数: {len(PERSONALITIES)} 个\n"
-            persona_list += f"• 当前活跃: {GLOBAL_CURRENT_PERSONALITY['command'] if GLOBAL_CURRENT_PERSONALITY else 'None'}\n"
+            persona_list += f"• 当前活跃: {session.persona_name}\n"
             
             # 获取人格活跃度
             if DB_MANAGER.enable:
@@ -3005,78 +6081,235 @@ class PersonalitySwitchPlugin(Plugin):
             return
 
         # 9. 智能化交互（意图+情绪识别）
-        user_intent = self._recognize_user_intent(message)
-        user_emotion, emotion_intensity = self._recognize_emotion_intensity(message)
+        user_intent = features.intent
+        user_emotion, emotion_intensity = self._recognize_emotion_intensity(message, features)
         # 更新用户习惯
-        self._update_user_habits(user_id, message)
+        self._update_user_habits(user_id, message, user_intent)
+        if user_intent != "general":
+            session.topic = user_intent
+        session.updated_at = time.time()
 
-        # 10. 缓存检查
-        current_persona_name = GLOBAL_CURRENT_PERSONALITY["command"]
-        cache_reply = self._check_cache(user_id, message, current_persona_name)
+        # 10. 缓存检查（先查跨用户共享缓存，再查用户缓存）
+        current_persona_name = session.persona_name
+        current_scene = self._get_user_current_scene(user_id)
+        current_mood = session.mood
+        cache_scope = f"{current_scene}_{current_mood}"
+        # 加载对话历史（上下文，共享缓存Key也依赖最近上下文）
+        conversation_history = DB_MANAGER.get_conversation(user_id, limit=5) if DB_MANAGER.enable else USER_CONVERSATION_HISTORY.get(user_id, [])
+        shared_key = self._get_shared_cache_key(features, message, current_persona_name, current_scene, current_mood, conversation_history)
+        cache_reply = await self._check_cache(user_id, message, current_persona_name, cache_scope, shared_key)
+        semantic_scope = self._get_semantic_scope(user_id, features, current_persona_name, current_scene, current_mood)
+        if not cache_reply and semantic_scope:
+            cache_reply = SEMANTIC_CACHE.get(semantic_scope, message)
         if cache_reply:
             await ctx.send(cache_reply)
             return
 
-        # 11. 构建LLM提示词（融合人格+场景+情绪+意图）
-        current_scene = self._get_user_current_scene(user_id)
-        scene_config = self._get_scene_specific_config(GLOBAL_CURRENT_PERSONALITY, current_scene)
-        # 人格核心描述
-        persona_desc = GLOBAL_CURRENT_PERSONALITY["personality_desc"]
-        # 情绪适配
-        current_mood = PERSONA_MOOD[current_persona_name]
-        mood_style = GLOBAL_CURRENT_PERSONALITY.get("mood_reply_style", {}).get(current_mood, scene_config["reply_style"])
-        # 构建提示词
-        prompt = f"""
-        你现在的身份是：{persona_desc}
-        当前场景：{current_scene}，场景专属回复风格：{scene_config['reply_style']}
-        当前情绪：{current_mood}，情绪回复风格：{mood_style}
-        用户意图：{user_intent}，用户情绪：{user_emotion}（强度：{emotion_intensity}）
-        用户消息：{message}
-        回复要求：
-        1. 严格贴合人格设定和当前情绪，不偏离人设
-        2. 适配当前场景，符合场景回复风格
-        3. 回应用户的情绪和意图，有共情力
-        4. 回复简短自然，不超过3句话
-        5. 保留人格专属水印：{GLOBAL_CURRENT_PERSONALITY.get('watermark', '')}
-        """
-        # 加载对话历史（上下文）
-        conversation_history = DB_MANAGER.get_conversation(user_id, limit=5) if DB_MANAGER.enable else USER_CONVERSATION_HISTORY.get(user_id, [])
-        messages = [{"role": "system", "content": prompt}]
-        for hist_time, hist_persona, hist_content in conversation_history:
-            messages.append({"role": "user", "content": hist_content})
+        # 11. 构建LLM提示词（人格+场景+情绪组成固定前缀，意图/情绪/消息放在最后）
+        compiled_persona = get_compiled_persona(current_persona_name)
+        messages = PROMPT_BUILDER.build(
+            compiled_persona, current_scene, current_mood,
+            [hist_content for hist_time, hist_persona, hist_content in conversation_history],
+            message, user_intent, user_emotion, emotion_intensity
+        )
 
-        # 12. 调用LLM生成回复
+        # 12. 调用LLM生成回复（先过限流，被限流时降级为模板回复或提示）
         llm_client = LLM_CLIENTS.get(current_persona_name, LLM_CLIENTS["default"])
-        llm_reply = llm_client.generate_reply(messages)
+        watermark = compiled_persona.watermark
+        if RATE_LIMITER:
+            limited = await RATE_LIMITER.acquire({
+                "user": user_id,
+                "group": getattr(ctx, "group_id", ""),
+                "persona": current_persona_name,
+                "client": llm_client.name
+            })
+            if limited:
+                await ctx.send(self._rate_limited_reply(limited, message, current_persona_name, features))
+                return
+        # LLM超过场景时限时先发人格模板回复，LLM结果到达后按late_reply追发或只记录缓存
+        scene_timeout = self._get_scene_reply_timeout(current_scene)
+        fallback_reply = self._slow_fallback_reply(message, current_persona_name, features) if scene_timeout else ""
+        # 迟到的LLM结果在会话锁外等待（同一会话的后续消息不必排队等它），到达后按late_reply处理
+        late_args = (ctx, session_key, user_id, message, current_persona_name, watermark, features,
+                     cache_scope, shared_key, semantic_scope)
+        # 相同提示词的并发请求合并为一次LLM调用（流式和非流式都合并）
+        inflight_key = self._get_inflight_key(llm_client, messages)
+        # 流式模式：按句子边生成边发送（多模态回复需要完整文本，走非流式）
+        if CONFIG["llm"].get("stream", False) and not features.has("image") and not features.has("voice"):
+            shared_stream = LLM_SINGLE_FLIGHT.stream(inflight_key, lambda: llm_client.astream_reply(messages, deadline))
+            stream = iter_with_first_timeout(shared_stream, scene_timeout)
+            try:
+                first = await stream.__anext__()
+            except CircuitOpenError:
+                await ctx.send(await self._circuit_open_reply(message, current_persona_name, features))
+                return
+            except StopAsyncIteration:
+                return
+            if first is _FIRST_ITEM_TIMEOUT:
+                SLOW_REPLY_STATS["template_replies"] += 1
+                await ctx.send(fallback_reply)
+                self._start_late_reply(collect_stream(stream), *late_args)
+                return
+            final_reply = await self._send_streaming_reply(ctx, stream, first, watermark)
+            await self._record_reply(user_id, message, current_persona_name, final_reply, cache_scope, shared_key, semantic_scope)
+            return
+        llm_task = asyncio.ensure_future(
+            LLM_SINGLE_FLIGHT.do(inflight_key, lambda: llm_client.agenerate_reply(messages, deadline))
+        )
+        if scene_timeout:
+            done, _ = await asyncio.wait({llm_task}, timeout=scene_timeout)
+            if not done:
+                SLOW_REPLY_STATS["template_replies"] += 1
+                await ctx.send(fallback_reply)
+                self._start_late_reply(llm_task, *late_args)
+                return
+        try:
+            llm_reply = await llm_task
+        except CircuitOpenError:
+            # 熔断器打开：不等待注定失败的请求，直接降级
+            await ctx.send(await self._circuit_open_reply(message, current_persona_name, features))
+            return
         # 添加水印
-        watermark = GLOBAL_CURRENT_PERSONALITY.get("watermark", "")
         final_reply = f"{llm_reply} {watermark}".strip()
 
         # 13. 多模态扩展（图片/语音）
-        if "生成图片" in message or "画画" in message:
+        final_reply, voice_path = await self._generate_multimodal(message, final_reply, current_persona_name, features)
+        if voice_path:
+            await ctx.send_file(voice_path)  # 发送语音文件
+
+        # 14. 发送回复并记录
+        await ctx.send(final_reply)
+        await self._record_reply(user_id, message, current_persona_name, final_reply, cache_scope, shared_key, semantic_scope)
+
+    def _start_late_reply(self, llm_result, *args):
+        """在后台等待迟到的LLM结果（llm_result为返回回复文本的任务/协程）"""
+        task = asyncio.ensure_future(self._finish_late_reply(llm_result, *args))
+        LATE_REPLY_TASKS.add(task)
+        task.add_done_callback(LATE_REPLY_TASKS.discard)
+
+    async def _finish_late_reply(self, llm_result, ctx: MessageContext, session_key: Tuple[str, str],
+                                 user_id: str, message: str, persona_name: str, watermark: str, features: MessageFeatures,
+                                 cache_scope: str, shared_key: Optional[str], semantic_scope: Optional[str]):
+        """已发过模板回复后等待迟到的LLM结果：按late_reply追发或只记录（发送和记录时短暂持有会话锁，保持同一会话的消息顺序）"""
+        try:
+            llm_reply = (await llm_result).strip()
+        except CircuitOpenError:
+            return
+        except Exception as e:
+            LOGGER.error(f"等待超时后的LLM回复失败：{str(e)}")
+            return
+        if not llm_reply or llm_reply == LLM_FALLBACK_REPLY:
+            # 已经发过模板回复，不再追发"卡壳"提示
+            SLOW_REPLY_STATS["late_failed"] += 1
+            return
+        final_reply = f"{llm_reply} {watermark}".strip()
+        followup = self._send_late_reply()
+        voice_path = None
+        if followup:
+            final_reply, voice_path = await self._generate_multimodal(message, final_reply, persona_name, features)
+        async with SESSION_STORE.lock(session_key):
+            if followup:
+                SLOW_REPLY_STATS["late_followups"] += 1
+                if voice_path:
+                    await ctx.send_file(voice_path)
+                await ctx.send(final_reply)
+            else:
+                SLOW_REPLY_STATS["late_dropped"] += 1
+            await self._record_reply(user_id, message, persona_name, final_reply, cache_scope, shared_key, semantic_scope)
+
+    async def _generate_multimodal(self, message: str, final_reply: str, persona_name: str,
+                                   features: MessageFeatures) -> Tuple[str, Optional[str]]:
+        """多模态扩展：需要图片时把图片链接附在回复后，需要语音时生成语音文件；返回（回复, 语音文件路径）"""
+        voice_path = None
+        if features.has("image"):
             image_prompt = message.replace("生成图片", "").replace("画画", "").strip()
-            image_url = await self._generate_image(image_prompt, current_persona_name)
+            image_url = await self._generate_image(image_prompt, persona_name)
             if image_url:
                 final_reply += f"\n{image_url}"
-        if "语音回复" in message or "说出来" in message:
-            voice_path = await self._generate_voice(final_reply, current_persona_name)
-            if voice_path:
-                await ctx.send_file(voice_path)  # 发送语音文件
+        if features.has("voice"):
+            voice_path = await self._generate_voice(final_reply, persona_name)
+        return final_reply, voice_path
 
-        # 14. 发送回复并记录
-        await ctx.send(final_reply)
+    async def _circuit_open_reply(self, message: str, persona_name: str, features: MessageFeatures) -> str:
+        """LLM熔断时的降级回复：开启use_local_model且本地模型可用时用本地模型回复，否则用人格模板回复（均不加离线标记）"""
+        if CONFIG["llm"].get("circuit_breaker", {}).get("use_local_model", False):
+            local_reply = await self._local_model_reply(message, persona_name)
+            if local_reply:
+                return f"{local_reply} {get_compiled_persona(persona_name).watermark}".strip()
+        return self._slow_fallback_reply(message, persona_name, features)
+
+    def _get_scene_reply_timeout(self, scene_name: str) -> Optional[float]:
+        """场景的LLM回复时限（秒），超过后先发模板回复；未配置或为0表示不限"""
+        timeouts = CONFIG["scene"].get("reply_timeout", {})
+        timeout = timeouts.get(scene_name, timeouts.get(CONFIG["scene"]["default_scene"]))
+        return timeout or None
+
+    def _send_late_reply(self) -> bool:
+        """超时后到达的LLM回复是否追发（followup），drop则只写入对话记录和缓存"""
+        return CONFIG["scene"].get("late_reply", "followup") == "followup"
+
+    def _slow_fallback_reply(self, message: str, persona_name: str, features: MessageFeatures) -> str:
+        """LLM响应慢时的人格模板回复（不加离线标记）"""
+        watermark = get_compiled_persona(persona_name).watermark
+        return f"{self._get_offline_reply(message, persona_name, features, mark_offline=False)} {watermark}".strip()
+
+    def _rate_limited_reply(self, level: str, message: str, persona_name: str, features: MessageFeatures) -> str:
+        """被限流时的降级回复：notice提示用户稍后再聊，template用人格模板回复（不加离线标记）"""
+        if RATE_LIMITER.on_limit(level) == "notice":
+            return CONFIG["rate_limit"].get("notice", "消息有点多，我先缓一缓，稍后再聊吧~")
+        return self._slow_fallback_reply(message, persona_name, features)
+
+    async def _send_streaming_reply(self, ctx: MessageContext, stream, first: str, watermark: str) -> str:
+        """流式发送回复：从first开始每凑满一句就发送，水印附在最后一段；返回完整回复文本"""
+        chunker = SentenceChunker(
+            min_chars=CONFIG["llm"].get("stream_min_chars", 8),
+            max_chars=CONFIG["llm"].get("stream_max_chars", 120)
+        )
+        parts: List[str] = []
+        pending: Optional[str] = None  # 暂存最近一句，收到后续内容后再发送，以便把水印附在最后一句
+
+        async def texts():
+            yield first
+            async for text in stream:
+                yield text
+
+        async for text in texts():
+            if pending is not None and text.strip():
+                await ctx.send(pending)
+                pending = None
+            for chunk in chunker.feed(text):
+                if pending is not None:
+                    await ctx.send(pending)
+                pending = chunk
+                parts.append(chunk)
+        tail = chunker.flush()
+        if tail:
+            if pending is not None:
+                await ctx.send(pending)
+            pending = tail
+            parts.append(tail)
+        await ctx.send(f"{pending or ''} {watermark}".strip())
+        return f"{''.join(parts)} {watermark}".strip()
+
+    async def _record_reply(self, user_id: str, message: str, persona_name: str, final_reply: str,
+                      cache_scope: str = "", shared_key: Optional[str] = None, semantic_scope: Optional[str] = None):
+        """回复发送后的记录：对话历史、缓存（用户缓存+共享回复池+语义缓存）、操作日志"""
         # 保存对话历史
         time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        DB_MANAGER.insert_conversation(user_id, time_str, current_persona_name, message)
+        DB_MANAGER.insert_conversation(user_id, time_str, persona_name, message)
         # 更新对话历史内存
         if not DB_MANAGER.enable:
             if user_id not in USER_CONVERSATION_HISTORY:
                 USER_CONVERSATION_HISTORY[user_id] = []
-            USER_CONVERSATION_HISTORY[user_id].append((time_str, current_persona_name, message))
+            USER_CONVERSATION_HISTORY[user_id].append((time_str, persona_name, message))
         # 设置缓存
-        self._set_cache(user_id, message, current_persona_name, final_reply)
+        await self._set_cache(user_id, message, persona_name, final_reply, cache_scope)
+        if shared_key:
+            await self._add_shared_reply(shared_key, final_reply)
+        if semantic_scope and final_reply.strip() and LLM_FALLBACK_REPLY not in final_reply:
+            SEMANTIC_CACHE.set(semantic_scope, message, final_reply)
         # 记录操作日志
-        self._log_operation(user_id, "message.reply", f"成功：使用{current_persona_name}人格回复")
+        self._log_operation(user_id, "message.reply", f"成功：使用{persona_name}人格回复")
 
-# 插件实例化
-plugin = PersonalitySwitchPlugin()
\ No newline at end of file
+# 插件实例化（设置环境变量PERSONALITY_SWITCH_NO_AUTOLOAD时跳过，供测试/基准脚本只导入模块内的类和函数）
+plugin = None if os.environ.get("PERSONALITY_SWITCH_NO_AUTOLOAD") else PersonalitySwitchPlugin()
\ No newline at end of file
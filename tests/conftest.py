@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""测试公共配置：只导入plugin模块中的类和函数，不实例化插件（不读取config.toml，不启动数据库/调度器/监控面板）"""
+
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("PERSONALITY_SWITCH_NO_AUTOLOAD", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import plugin  # noqa: E402
+
+
+@pytest.fixture
+def database_config(tmp_path, monkeypatch):
+    """临时SQLite数据库配置（关闭延迟写入，人格为甲/乙），返回数据库文件路径"""
+    path = str(tmp_path / "plugin.db")
+    monkeypatch.setitem(plugin.CONFIG, "database", {
+        "enable": True,
+        "type": "sqlite",
+        "path": path,
+        "write_behind": {"enable": False}
+    })
+    monkeypatch.setattr(plugin, "PERSONALITIES", {"甲": {}, "乙": {}})
+    monkeypatch.setattr(plugin, "DB_CONN", None)
+    return path
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的时钟，同时替换plugin模块里的time.time和time.monotonic"""
+    fake = FakeClock()
+    monkeypatch.setattr(plugin.time, "time", fake)
+    monkeypatch.setattr(plugin.time, "monotonic", fake)
+    return fake
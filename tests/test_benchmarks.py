@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""基准测试脚本的回归断言：优化后的路径必须比原路径快/结果一致"""
+
+import argparse
+
+import pytest
+
+from benchmarks import bench_plugin
+
+
+def test_switch_single_transaction_faster_than_per_statement():
+    result = bench_plugin.benchmark_persona_switch(rounds=30)
+    assert result["rounds"] == 30
+    assert result["single_transaction_ms"] < result["per_statement_ms"]
+
+
+def test_semantic_cache_hits_near_duplicate_messages():
+    records = [
+        ("u1", "名字", "今天上班好累啊，真的不想上班了", "general", "平静"),
+        ("u1", "名字", "今天上班好累啊，不想上班了", "general", "平静"),
+        ("u1", "名字", "帮我查一下明天的天气", "general", "平静")
+    ]
+    result = bench_plugin.benchmark_semantic_cache(records, bench_plugin.MessageClassifier(), {})
+    # 三条消息归一化后都不相同，精确缓存一条也命中不了；第二条是第一条的近似重复，语义缓存应命中
+    assert result["exact_hit_rate"] == 0
+    assert result["hit_rate"] == round(1 / 3, 3)
+    assert result["entries"] == 2
+
+
+def test_semantic_cache_isolated_by_scene_and_mood():
+    records = [
+        ("u1", "名字", "今天上班好累啊，真的不想上班了", "general", "平静"),
+        ("u1", "名字", "今天上班好累啊，不想上班了", "work", "平静"),
+        ("u1", "名字", "今天上班好累啊，不想上班了", "general", "开心")
+    ]
+    result = bench_plugin.benchmark_semantic_cache(records, bench_plugin.MessageClassifier(), {})
+    # 与插件相同的隔离范围：场景或情绪不同的近似重复消息不能命中
+    assert result["hit_rate"] == 0
+    assert result["entries"] == 3
+
+
+PERSONALITIES = {
+    "名字": {
+        "command": "/名字",
+        "personality_desc": "温柔的歌手",
+        "reply_style": "语气温柔",
+        "watermark": "[名字]🎤",
+        "default_mood": "温柔",
+        "mood_triggers": {"唱歌": "开心"},
+        "mood_reply_style": {"温柔": "多用颜文字", "开心": "语气活泼"},
+        "scene_config": {"work": {"reply_style": "简洁专业"}, "game": {"reply_style": "带游戏梗"}}
+    },
+    "路人": {"personality_desc": "普通路人", "reply_style": "平平淡淡"}
+}
+SCENE_CONFIG = {"default_scenes": {"general": "通用", "work": "工作"}, "scene_specific_config": True}
+
+
+def test_compiled_persona_prompts_match_dict_composed_prompts():
+    compiled = bench_plugin.compile_personas(PERSONALITIES, SCENE_CONFIG)
+    assert set(compiled) == set(PERSONALITIES)
+    # 预编译的 场景×情绪 组合，以及未预编译的场景/情绪（现场生成）都必须和字典版逐字一致
+    for name, persona in PERSONALITIES.items():
+        for scene in ("general", "work", "game", "未知场景"):
+            for mood in (*compiled[name].moods, "未知情绪"):
+                prompt, _ = compiled[name].system_prompt(scene, mood)
+                assert prompt == bench_plugin.dict_system_prompt(persona, scene, mood)
+
+
+def test_compiled_persona_benchmark_reports_both_paths():
+    result = bench_plugin.benchmark_compiled_personas(PERSONALITIES, SCENE_CONFIG, rounds=200)
+    assert result["rounds"] == 200 and result["personas"] == 2
+    assert result["dict_us"] > 0 and result["compiled_us"] > 0
+
+
+@pytest.mark.parametrize("value", ["0", str(bench_plugin.MAX_ROUNDS + 1)])
+def test_rounds_out_of_range_rejected(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        bench_plugin._rounds(value)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""BotConfigWriter：去抖窗口随每次切换重新计时，最多等待max_wait_ms"""
+
+import time
+
+import pytest
+import toml
+
+from plugin import BotConfigWriter
+
+
+@pytest.fixture
+def bot_config(tmp_path):
+    path = tmp_path / "bot_config.toml"
+    path.write_text('[bot]\ncurrent_personality = "甲"\n', encoding="utf-8")
+    return path
+
+
+def wait_for_write(writer, written=1, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while writer.stats()["written"] < written and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return writer.stats()
+
+
+def test_each_switch_restarts_debounce_window(bot_config):
+    writer = BotConfigWriter(str(bot_config), debounce_ms=150, max_wait_ms=2000)
+    for name in ("乙", "丙", "丁"):
+        writer.submit(name)
+        time.sleep(0.1)
+    # 每次间隔都小于去抖窗口，最后一次切换后仍在窗口内，不会写入
+    assert writer.stats()["written"] == 0
+    stats = wait_for_write(writer)
+    assert stats["written"] == 1 and stats["coalesced"] == 2 and stats["pending"] is None
+    assert toml.load(str(bot_config))["bot"]["current_personality"] == "丁"
+
+
+def test_continuous_switches_are_written_within_max_wait(bot_config):
+    writer = BotConfigWriter(str(bot_config), debounce_ms=100, max_wait_ms=200)
+    start = time.monotonic()
+    while time.monotonic() - start < 0.6:
+        writer.submit("乙")
+        time.sleep(0.02)
+    # 一直有新的切换时，最多等max_wait_ms也要写入
+    assert writer.stats()["written"] >= 1
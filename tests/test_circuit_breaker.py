@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""CircuitBreaker：closed → open → half_open → closed/open 的状态转换"""
+
+import asyncio
+
+import pytest
+
+from plugin import CircuitBreaker, DynamicLLMClient
+
+BREAKER_CONFIG = {
+    "window": 10,
+    "min_calls": 4,
+    "failure_rate": 0.5,
+    "slow_call_ms": 1000,
+    "slow_call_rate": 0.75,
+    "open_seconds": 30,
+    "half_open_max_calls": 2
+}
+
+
+def trip(breaker):
+    for success in (True, False, True, False):
+        assert breaker.acquire()
+        breaker.record(success, 10)
+
+
+def test_stays_closed_below_min_calls_and_threshold(clock):
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    # 不足min_calls次调用时全部失败也不打开
+    for _ in range(3):
+        breaker.record(False, 10)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    for _ in range(7):
+        breaker.record(True, 10)
+    for _ in range(3):
+        breaker.record(False, 10)
+    # 窗口内10次调用3次失败，低于50%
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["recent_failure_rate"] == 0.3
+
+
+def test_opens_on_failure_rate_and_rejects(clock):
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    trip(breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock.now += 29
+    assert not breaker.acquire()
+    assert breaker.stats()["rejected"] == 1 and breaker.stats()["opened"] == 1
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    for elapsed in (5000, 5000, 10, 5000):
+        breaker.record(True, elapsed)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_limits_probes_and_closes_after_successes(clock):
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    trip(breaker)
+    clock.now += 30
+    assert breaker.acquire() and breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.acquire()
+    # 探测名额用完，其余请求继续拒绝
+    assert not breaker.acquire()
+    breaker.record(True, 10)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record(True, 10)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.stats()["recent_calls"] == 0
+
+
+def test_half_open_failure_reopens(clock):
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    trip(breaker)
+    clock.now += 30
+    assert breaker.acquire()
+    breaker.record(False, 10)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.stats()["opened"] == 2
+    # 重新计时
+    clock.now += 29
+    assert not breaker.acquire()
+    clock.now += 1
+    assert breaker.acquire() and breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_half_open_release_returns_probe_slot(clock):
+    breaker = CircuitBreaker("test", BREAKER_CONFIG)
+    trip(breaker)
+    clock.now += 30
+    assert breaker.acquire() and breaker.acquire()
+    breaker.release()
+    assert breaker.acquire()
+    assert not breaker.acquire()
+
+
+def test_unexpected_error_in_half_open_probe_does_not_leak_slot(clock):
+    client = DynamicLLMClient({"model_type": "openai", "api_key": "test", "timeout": 10,
+                               "endpoints": [{"api_base": "http://127.0.0.1:9000", "api_key": "test"}]})
+    client.breaker = CircuitBreaker("test", dict(BREAKER_CONFIG, half_open_max_calls=1))
+    trip(client.breaker)
+    clock.now += 30
+
+    async def broken_generate(messages, deadline, tried):
+        raise ValueError("响应解析失败")
+
+    client._generate = broken_generate
+    with pytest.raises(ValueError):
+        asyncio.run(client.agenerate_reply([]))
+    # 探测失败重新打开，open_seconds后还能再放行探测，而不是一直卡在没有名额的半开状态
+    assert client.breaker.state == CircuitBreaker.OPEN
+    clock.now += 30
+    assert client.breaker.acquire()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""ConnectivityMonitor：被动失败信号触发探测后重新计数，探测间隔不低于probe_min_interval"""
+
+import threading
+import time
+
+from plugin import ConnectivityMonitor
+
+OFFLINE_CONFIG = {"probe_interval": 60, "probe_backoff_min": 60, "failure_threshold": 3, "probe_min_interval": 0.2}
+
+
+def test_failure_counter_resets_after_each_wakeup():
+    monitor = ConnectivityMonitor(OFFLINE_CONFIG)
+    monitor._thread = threading.Thread(target=time.sleep, args=(1,), daemon=True)
+    monitor._thread.start()
+    for _ in range(9):
+        monitor.report_failure()
+    assert monitor.stats()["wakeups"] == 3
+    assert monitor.online
+
+
+def test_failures_without_probe_thread_go_offline():
+    monitor = ConnectivityMonitor(OFFLINE_CONFIG)
+    for _ in range(2):
+        monitor.report_failure()
+    assert monitor.online
+    monitor.report_failure()
+    assert not monitor.online
+    monitor.report_success()
+    assert monitor.online
+
+
+def test_wakeups_respect_min_probe_interval():
+    monitor = ConnectivityMonitor(OFFLINE_CONFIG)
+    probe_times = []
+
+    def probe():
+        probe_times.append(time.monotonic())
+        return True
+
+    monitor._probe = probe
+    monitor._thread = threading.Thread(target=monitor._run, daemon=True)
+    monitor._thread.start()
+    deadline = time.monotonic() + 0.7
+    while time.monotonic() < deadline:
+        monitor.report_failure()
+        time.sleep(0.005)
+    monitor.stop()
+    monitor._thread.join(1)
+    assert not monitor._thread.is_alive()
+    # 0.7秒内不断被唤醒：首次探测 + 每0.2秒最多一次
+    assert 2 <= len(probe_times) <= 5
+    assert all(b - a >= 0.19 for a, b in zip(probe_times, probe_times[1:]))
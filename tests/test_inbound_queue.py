@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""连发消息合并：会触发动作的消息不等去抖窗口，合并批次按每条消息各自的分类结果处理"""
+
+import asyncio
+
+import pytest
+
+import plugin
+from plugin import InboundQueue, MessageClassifier, PersonaTriggerIndex, PersonalitySwitchPlugin, SessionStateStore
+
+
+class FakeContext:
+    def __init__(self, content, user_id="u1", group_id="group1"):
+        self.content = content
+        self.user = type("User", (), {"id": user_id})()
+        self.group_id = group_id
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    monkeypatch.setattr(plugin, "INBOUND_QUEUE", InboundQueue({"debounce_ms": 200, "max_wait_ms": 1000}))
+    monkeypatch.setattr(plugin, "SESSION_STORE", SessionStateStore())
+    monkeypatch.setattr(plugin, "PERSONA_TRIGGER_INDEX", PersonaTriggerIndex({"甲": {"trigger_names": ["小甲"]}}))
+    monkeypatch.setitem(plugin.CONFIG, "tools", {"enable": True})
+    monkeypatch.setitem(plugin.CONFIG, "scene", {"default_scene": "general"})
+    instance = PersonalitySwitchPlugin.__new__(PersonalitySwitchPlugin)
+    instance.classifier = MessageClassifier()
+    instance.tools = {"weather": {}}
+    instance.user_current_scene = {}
+    instance.processed = []
+
+    async def process_message(ctx, user_id, message, session_key, features=None):
+        instance.processed.append((message, features, asyncio.get_running_loop().time()))
+
+    instance._process_message = process_message
+    return instance
+
+
+@pytest.mark.parametrize("message", ["小甲在吗", "今天天气怎么样", "提醒我八点开会", "人格列表"])
+def test_action_messages_skip_debounce(bot, message):
+    async def scenario():
+        start = asyncio.get_running_loop().time()
+        await bot.handle_message(FakeContext(message))
+        return bot.processed[0][2] - start
+
+    assert asyncio.run(scenario()) < 0.1
+    assert bot.processed[0][0] == message
+    assert plugin.INBOUND_QUEUE.metrics["batches"] == 0
+
+
+def test_merged_batch_does_not_combine_keywords_across_messages(bot):
+    async def scenario():
+        leader = asyncio.create_task(bot.handle_message(FakeContext("记得提醒")))
+        await asyncio.sleep(0.05)
+        await bot.handle_message(FakeContext("你好开心"))
+        await leader
+
+    asyncio.run(scenario())
+    message, features, _ = bot.processed[0]
+    assert message == "记得提醒\n你好开心"
+    # "提醒"和"你"分别在两条消息里，合并后不会被当成添加提醒
+    assert not features.has("reminder")
+    assert features.has("pronoun")
+    assert features.emotion == "happy"
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""KeywordAutomaton：单次扫描的结果必须与逐个关键词查找的朴素循环一致"""
+
+import random
+
+from plugin import OFFLINE_TEMPLATE_KEYWORDS, KeywordAutomaton, MessageClassifier, PersonaTriggerIndex
+
+
+def naive_matches(keywords, text):
+    """朴素实现：对每个关键词找出全部出现位置（含重叠），产出（结束位置, payload）"""
+    matches = []
+    for keyword, payload in keywords:
+        if not keyword:
+            continue
+        start = text.find(keyword)
+        while start >= 0:
+            matches.append((start + len(keyword) - 1, payload))
+            start = text.find(keyword, start + 1)
+    return sorted(matches)
+
+
+def test_overlapping_and_nested_keywords():
+    keywords = [("he", 1), ("she", 2), ("his", 3), ("hers", 4), ("", 5)]
+    text = "ushershishe"
+    assert sorted(KeywordAutomaton(keywords).iter_matches(text)) == naive_matches(keywords, text)
+
+
+def test_duplicate_keywords_keep_every_payload():
+    keywords = [("开心", "a"), ("开心", "b"), ("心", "c")]
+    matches = sorted(KeywordAutomaton(keywords).iter_matches("好开心"))
+    assert matches == [(2, "a"), (2, "b"), (2, "c")]
+
+
+def test_random_keywords_match_naive_loop():
+    rng = random.Random(20240601)
+    alphabet = "ab开心难过"
+    for _ in range(200):
+        keywords = [("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))), i) for i in range(rng.randint(1, 12))]
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        automaton = KeywordAutomaton(keywords)
+        assert sorted(automaton.iter_matches(text)) == naive_matches(keywords, text)
+        assert automaton.keyword_count == len(keywords)
+
+
+def test_persona_trigger_index_prefers_config_order():
+    personalities = {
+        "甲": {"trigger_names": ["小甲"]},
+        "乙": {"trigger_names": ["甲乙"]}
+    }
+    # 两个人格的触发词都命中时取配置中靠前的人格，与逐个人格扫描一致
+    triggered, mentioned = PersonaTriggerIndex(personalities).scan("叫一下甲乙和小甲")
+    assert triggered == "甲"
+    assert set(mentioned) == {"甲", "乙"}
+
+
+def test_classifier_matches_case_sensitively_like_in_checks():
+    classifier = MessageClassifier()
+    for message in ("hi", "Hi", "HI there", "早上好", "Hello"):
+        expected = next((category for category, words in OFFLINE_TEMPLATE_KEYWORDS.items()
+                         if any(word in message for word in words)), None)
+        assert classifier.classify(message).offline_category == expected
+    assert classifier.classify("Hi").offline_category is None
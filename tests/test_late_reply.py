@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""场景时限后的迟到LLM回复：在会话锁外等待，追发/记录时才短暂持有会话锁"""
+
+import asyncio
+
+import pytest
+
+import plugin
+from plugin import MessageFeatures, PersonalitySwitchPlugin, SessionStateStore
+
+SESSION_KEY = ("group1", "general")
+
+
+class FakeContext:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    monkeypatch.setattr(plugin, "SESSION_STORE", SessionStateStore())
+    monkeypatch.setitem(plugin.CONFIG, "scene", {"late_reply": "followup"})
+    monkeypatch.setattr(plugin, "SLOW_REPLY_STATS", dict.fromkeys(plugin.SLOW_REPLY_STATS, 0))
+    instance = PersonalitySwitchPlugin.__new__(PersonalitySwitchPlugin)
+    instance.recorded = []
+
+    async def record_reply(user_id, message, persona_name, final_reply, *args):
+        instance.recorded.append(final_reply)
+
+    instance._record_reply = record_reply
+    return instance
+
+
+def start_late_reply(bot, ctx, llm_result):
+    bot._start_late_reply(llm_result, ctx, SESSION_KEY, "u1", "在吗", "名字", "[名字]", MessageFeatures("在吗"), "", None, None)
+
+
+def test_late_reply_waits_outside_session_lock(bot):
+    async def scenario():
+        ctx = FakeContext()
+        llm_result = asyncio.get_running_loop().create_future()
+        start_late_reply(bot, ctx, llm_result)
+        await asyncio.sleep(0)
+        # 等待LLM期间，同一会话的下一条消息可以立即拿到会话锁
+        lock = plugin.SESSION_STORE.lock(SESSION_KEY)
+        await asyncio.wait_for(lock.acquire(), timeout=0.5)
+        llm_result.set_result("我在呢")
+        await asyncio.sleep(0.05)
+        # 后一条消息处理完之前，迟到回复不会插进来
+        assert ctx.sent == []
+        ctx.sent.append("下一条消息的回复")
+        lock.release()
+        await asyncio.gather(*plugin.LATE_REPLY_TASKS)
+        return ctx.sent
+
+    assert asyncio.run(scenario()) == ["下一条消息的回复", "我在呢 [名字]"]
+    assert bot.recorded == ["我在呢 [名字]"]
+    assert plugin.SLOW_REPLY_STATS["late_followups"] == 1
+
+
+def test_late_reply_dropped_but_recorded(bot, monkeypatch):
+    monkeypatch.setitem(plugin.CONFIG, "scene", {"late_reply": "drop"})
+
+    async def reply():
+        return "我在呢"
+
+    async def scenario():
+        ctx = FakeContext()
+        start_late_reply(bot, ctx, reply())
+        await asyncio.gather(*plugin.LATE_REPLY_TASKS)
+        return ctx.sent
+
+    assert asyncio.run(scenario()) == []
+    assert bot.recorded == ["我在呢 [名字]"]
+    assert plugin.SLOW_REPLY_STATS["late_dropped"] == 1
+
+
+def test_late_fallback_reply_is_not_sent(bot):
+    async def reply():
+        return plugin.LLM_FALLBACK_REPLY
+
+    async def scenario():
+        ctx = FakeContext()
+        start_late_reply(bot, ctx, reply())
+        await asyncio.gather(*plugin.LATE_REPLY_TASKS)
+        return ctx.sent
+
+    assert asyncio.run(scenario()) == []
+    assert bot.recorded == []
+    assert plugin.SLOW_REPLY_STATS["late_failed"] == 1
+
+
+def test_collect_stream_joins_chunks():
+    async def chunks():
+        for text in ("你", "好", "呀"):
+            yield text
+
+    assert asyncio.run(plugin.collect_stream(chunks())) == "你好呀"
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""DynamicLLMClient重试计数：只有确实换到了新的接入点才计一次重试"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from plugin import LLM_FALLBACK_REPLY, Deadline, DynamicLLMClient
+
+
+def make_client(endpoint_count):
+    client = DynamicLLMClient({
+        "model_type": "openai", "api_key": "test", "timeout": 10, "max_attempts": 3, "min_retry_budget": 0,
+        "endpoints": [{"api_base": f"http://127.0.0.1:{9000 + i}", "api_key": "test"} for i in range(endpoint_count)]
+    })
+
+    async def create(**kwargs):
+        raise ConnectionError("接入点不可用")
+
+    for endpoint in client.endpoints:
+        endpoint.async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return client
+
+
+@pytest.mark.parametrize("endpoint_count, retries", [(1, 0), (2, 1), (5, 2)])
+def test_generate_counts_only_real_retries(endpoint_count, retries):
+    client = make_client(endpoint_count)
+    assert asyncio.run(client._generate([], Deadline(5), [])) is None
+    assert client.metrics["retries"] == retries
+
+
+@pytest.mark.parametrize("endpoint_count, retries", [(1, 0), (2, 1), (5, 2)])
+def test_stream_counts_only_real_retries(endpoint_count, retries):
+    client = make_client(endpoint_count)
+
+    async def scenario():
+        return [delta async for delta in client.astream_reply([], Deadline(5))]
+
+    assert asyncio.run(scenario()) == [LLM_FALLBACK_REPLY]
+    assert client.metrics["retries"] == retries
+    assert client.metrics["exhausted"] == 1
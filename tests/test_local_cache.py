@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""LocalReplyCache：统计指标按分片在分片锁下累计，多线程并发读写时总数不丢"""
+
+import threading
+
+from plugin import LocalReplyCache
+
+
+def test_metrics_exact_under_concurrent_access():
+    cache = LocalReplyCache(max_entries=100000, shards=8)
+    threads, rounds = 8, 2000
+
+    def worker(n):
+        for i in range(rounds):
+            key = f"{n}:{i}"
+            cache.set(key, "回复")
+            cache.get(key)
+            cache.get(f"{key}:miss")
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    stats = cache.stats()
+    assert stats["sets"] == stats["hits"] == stats["misses"] == threads * rounds
+    assert stats["entries"] == threads * rounds
+    assert stats["hit_rate"] == 0.5
+
+
+def test_evictions_and_rejections_summed_across_shards():
+    cache = LocalReplyCache(max_entries=8, max_bytes=1024, shards=2, policy="lru")
+    for i in range(50):
+        cache.set(f"k{i}", "v")
+    cache.set("大", "x" * 1024)
+    metrics = cache.metrics
+    assert metrics["sets"] == 50
+    assert metrics["evictions"] == 50 - len(cache)
+    assert metrics["rejections"] == 1
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""SCHEMA_MIGRATIONS：全新数据库和停在v1的旧数据库都要升级到最新版本"""
+
+import json
+import sqlite3
+
+import pytest
+
+import plugin
+from plugin import DatabaseManager, SCHEMA_MIGRATIONS
+
+LATEST_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+def index_names(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    finally:
+        conn.close()
+
+
+def applied_versions(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    finally:
+        conn.close()
+
+
+def test_fresh_database_migrates_to_latest(database_config):
+    manager = DatabaseManager()
+    try:
+        assert manager.schema_version == LATEST_VERSION
+        assert applied_versions(database_config) == [version for version, _, _ in SCHEMA_MIGRATIONS]
+        assert {
+            "idx_user_conversation_user", "idx_persona_switch_user", "idx_reminders_user_status_time",
+            "idx_reminders_status_time", "idx_reminders_time", "idx_user_persona_preference_count"
+        } <= index_names(database_config)
+        assert manager.get_preference("u1") == {"甲": 0, "乙": 0}
+    finally:
+        manager.close()
+
+
+def test_v1_database_migrates_and_keeps_preferences(database_config):
+    # 先构造一个停在v1的旧库：建表、只应用v1，并写入旧格式的JSON偏好
+    manager = DatabaseManager.__new__(DatabaseManager)
+    manager.type = "sqlite"
+    manager.write_lock = plugin.threading.RLock()
+    manager.conn = sqlite3.connect(database_config)
+    manager._create_tables()
+    cursor = manager.conn.cursor()
+    cursor.execute("CREATE TABLE schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_time TEXT NOT NULL)")
+    for step in SCHEMA_MIGRATIONS[0][2]:
+        cursor.execute(step)
+    cursor.execute("INSERT INTO schema_version VALUES (1, ?, '2024-01-01 00:00:00')", (SCHEMA_MIGRATIONS[0][1],))
+    cursor.executemany("INSERT INTO user_preference (user_id, preference_json) VALUES (?, ?)", [
+        ("u1", json.dumps({"甲": 3, "乙": 0})),
+        ("u2", json.dumps({"乙": 5})),
+        ("u3", "不是JSON")
+    ])
+    manager.conn.commit()
+    manager.conn.close()
+
+    manager = DatabaseManager()
+    try:
+        assert manager.schema_version == LATEST_VERSION
+        assert applied_versions(database_config) == [version for version, _, _ in SCHEMA_MIGRATIONS]
+        assert manager.get_preference("u1") == {"甲": 3, "乙": 0}
+        assert manager.get_preference("u2") == {"甲": 0, "乙": 5}
+        # 无法解析的旧数据跳过，不影响迁移
+        assert manager.get_preference("u3") == {"甲": 0, "乙": 0}
+        assert manager.get_top_personas("u2") == [("乙", 5)]
+    finally:
+        manager.close()
+
+
+def test_migration_is_not_reapplied(database_config):
+    DatabaseManager().close()
+    manager = DatabaseManager()
+    try:
+        assert manager.schema_version == LATEST_VERSION
+        assert applied_versions(database_config) == [version for version, _, _ in SCHEMA_MIGRATIONS]
+    finally:
+        manager.close()
+
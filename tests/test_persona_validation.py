@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""人格校验与编译结果回退：编译不通过的人格不能写入，消息处理取不到编译结果时回退到默认人格"""
+
+import plugin
+from plugin import compile_personas
+
+PERSONALITIES = {
+    "名字": {"command": "名字", "personality_desc": "温柔的歌手", "reply_style": "语气温柔", "watermark": "[名字]"},
+    "路人": {"command": "路人", "personality_desc": "普通路人", "reply_style": "平平淡淡", "watermark": "[路人]"}
+}
+
+
+def test_check_persona_rejects_empty_required_fields(monkeypatch):
+    monkeypatch.setattr(plugin, "CONFIG", {"scene": {"default_scenes": {"general": "通用"}}})
+    assert plugin.check_persona("名字", PERSONALITIES["名字"]) is None
+    assert "reply_style" in plugin.check_persona("名字", {**PERSONALITIES["名字"], "reply_style": ""})
+    assert "personality_desc" in plugin.check_persona("名字", {"reply_style": "语气温柔"})
+    assert plugin.check_persona("名字", {**PERSONALITIES["名字"], "mood_reply_style": ["不是字典"]})
+
+
+def test_get_compiled_persona_falls_back_to_default(monkeypatch):
+    monkeypatch.setattr(plugin, "COMPILED_PERSONAS", compile_personas(PERSONALITIES, {}))
+    monkeypatch.setattr(plugin, "DEFAULT_PERSONALITY", PERSONALITIES["名字"])
+    assert plugin.get_compiled_persona("路人").watermark == "[路人]"
+    # 会话里记着的人格已被删除/编译失败
+    assert plugin.get_compiled_persona("已删除").name == "名字"
+    monkeypatch.setattr(plugin, "DEFAULT_PERSONALITY", {"command": "也不存在"})
+    assert plugin.get_compiled_persona("已删除").name in PERSONALITIES
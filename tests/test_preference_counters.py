@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""用户偏好计数行：计数+1的UPSERT按数据库类型生成，整体覆盖与计数+1按提交顺序落盘"""
+
+import sqlite3
+
+import pytest
+
+import plugin
+from plugin import DatabaseManager
+
+
+@pytest.mark.parametrize("db_type, clause", [("sqlite", "ON CONFLICT"), ("mysql", "ON DUPLICATE KEY UPDATE")])
+def test_preference_increment_matches_database_type(db_type, clause):
+    manager = DatabaseManager.__new__(DatabaseManager)
+    manager.type = db_type
+    manager._preference_cache = {"u1": {"甲": 2}}
+    sql, params = manager.increment_preference("u1", "甲")
+    assert clause in sql and "count = count + 1" in sql
+    assert params == ("u1", "甲")
+    assert manager._preference_cache["u1"]["甲"] == 3
+
+
+def test_overwrite_keeps_order_with_queued_increments(database_config):
+    # 延迟写入开启且刷新间隔很长：切换产生的计数+1还在队列里时整体覆盖偏好
+    plugin.CONFIG["database"]["write_behind"] = {"enable": True, "batch_size": 1000, "flush_interval_ms": 60000}
+    manager = DatabaseManager()
+    try:
+        for _ in range(3):
+            manager.record_persona_switch("u1", "2024-01-01 00:00:00", "甲", "command")
+        manager.update_preference("u1", {"甲": 1, "乙": 7})
+        manager.record_persona_switch("u1", "2024-01-01 00:00:01", "乙", "command")
+        expected = manager.get_preference("u1")
+    finally:
+        manager.close()
+    conn = sqlite3.connect(database_config)
+    try:
+        stored = dict(conn.execute("SELECT persona_name, count FROM user_persona_preference WHERE user_id = 'u1'"))
+    finally:
+        conn.close()
+    assert expected == {"甲": 1, "乙": 8}
+    assert stored == expected
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""RateLimiter：进程内令牌桶和Redis令牌桶（fakeredis+Lua）的放行、拒绝与补充"""
+
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+import plugin
+from plugin import RateLimiter
+
+LIMIT_CONFIG = {
+    "user": {"rate_per_minute": 60, "burst": 2, "overrides": {"vip": {"rate_per_minute": 600, "burst": 5}}},
+    "group": {"rate_per_minute": 60, "burst": 3},
+    "persona": {"rate_per_minute": 0}
+}
+
+
+def acquire_local(limiter, **identities):
+    buckets = []
+    for level in plugin.RATE_LIMIT_LEVELS:
+        ident = identities.get(level)
+        limit = limiter._limit(level, ident) if ident else None
+        if limit:
+            buckets.append((level, f"{limiter.key_prefix}:{level}:{ident}", *limit))
+    return limiter._acquire_local(buckets)
+
+
+def test_local_bucket_denies_after_burst_and_refills(clock):
+    limiter = RateLimiter(LIMIT_CONFIG)
+    assert acquire_local(limiter, user="u1") is None
+    assert acquire_local(limiter, user="u1") is None
+    assert acquire_local(limiter, user="u1") == "user"
+    clock.now += 0.5
+    assert acquire_local(limiter, user="u1") == "user"
+    # 每分钟60个令牌 = 每秒1个
+    clock.now += 0.5
+    assert acquire_local(limiter, user="u1") is None
+    assert acquire_local(limiter, user="u1") == "user"
+    # 补充不超过桶容量
+    clock.now += 3600
+    assert [acquire_local(limiter, user="u1") for _ in range(3)] == [None, None, "user"]
+
+
+def test_local_bucket_override_and_unlimited_level(clock):
+    limiter = RateLimiter(LIMIT_CONFIG)
+    assert [acquire_local(limiter, user="vip") for _ in range(6)] == [None] * 5 + ["user"]
+    assert all(acquire_local(limiter, persona="名字") is None for _ in range(100))
+
+
+def test_prune_uses_bucket_own_override_limits(clock):
+    config = {"user": {"rate_per_minute": 60, "burst": 2, "overrides": {"slow": {"rate_per_minute": 6, "burst": 1}}}}
+    limiter = RateLimiter(config, max_buckets=1)
+    assert acquire_local(limiter, user="slow") is None
+    clock.now += 2
+    # 再建一个桶触发清理：按默认限额2秒就补满了，但slow每10秒才补1个令牌，它的桶不能被当成已补满清掉
+    assert acquire_local(limiter, user="u1") is None
+    assert "ratelimit:user:slow" in limiter._buckets
+    assert acquire_local(limiter, user="slow") == "user"
+    clock.now += 8
+    assert acquire_local(limiter, user="u2") is None
+    assert "ratelimit:user:slow" not in limiter._buckets
+    assert acquire_local(limiter, user="slow") is None
+
+
+def test_local_bucket_is_all_or_nothing(clock):
+    limiter = RateLimiter(LIMIT_CONFIG)
+    for i in range(3):
+        assert acquire_local(limiter, user=f"u{i}", group="g1") is None
+    # 群限额用完：这次不放行，用户u9的令牌也不能被扣掉
+    assert acquire_local(limiter, user="u9", group="g1") == "group"
+    assert [acquire_local(limiter, user="u9") for _ in range(3)] == [None, None, "user"]
+
+
+def test_acquire_counts_metrics_without_redis():
+    async def scenario():
+        limiter = RateLimiter(LIMIT_CONFIG)
+        return [await limiter.acquire({"user": "u1", "persona": "名字"}) for _ in range(3)], limiter.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == [None, None, "user"]
+    assert stats["backend"] == "memory"
+    assert stats["allowed"] == 2 and stats["limited_user"] == 1
+
+
+def test_redis_bucket_denies_and_refills(clock):
+    pytest.importorskip("lupa")
+    clock.now = time.time()
+
+    async def scenario():
+        limiter = RateLimiter(LIMIT_CONFIG, fakeredis.aioredis.FakeRedis(decode_responses=True))
+        results = [await limiter.acquire({"user": "u1", "group": "g1"}) for _ in range(3)]
+        clock.now += 1
+        results.append(await limiter.acquire({"user": "u1", "group": "g1"}))
+        # 群桶：3个令牌，第3次被用户桶拒绝时没有扣减，1秒后补回1个
+        results.append(await limiter.acquire({"user": "u2", "group": "g1"}))
+        results.append(await limiter.acquire({"user": "u3", "group": "g1"}))
+        state = await limiter._redis.hgetall("ratelimit:user:u1")
+        return results, state, limiter.stats()
+
+    results, state, stats = asyncio.run(scenario())
+    assert results == [None, None, "user", None, None, "group"]
+    assert float(state["tokens"]) == pytest.approx(0)
+    assert stats["backend"] == "redis" and stats["redis_errors"] == 0
+    assert stats["limited_user"] == 1 and stats["limited_group"] == 1
+
+
+def test_redis_failure_falls_back_to_local_buckets():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        server.connected = False
+        limiter = RateLimiter(LIMIT_CONFIG, fakeredis.aioredis.FakeRedis(server=server, decode_responses=True))
+        return [await limiter.acquire({"user": "u1"}) for _ in range(3)], limiter.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == [None, None, "user"]
+    assert stats["redis_errors"] == 1 and stats["backend"] == "memory"
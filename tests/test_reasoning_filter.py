@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""ReasoningFilter：<think>片段被拆在任意分片边界时也要完整去除"""
+
+import pytest
+
+from plugin import ReasoningFilter
+
+
+def run(chunks):
+    reasoning_filter = ReasoningFilter()
+    return "".join(reasoning_filter.feed(chunk) for chunk in chunks) + reasoning_filter.flush()
+
+
+def split_every(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 100])
+def test_think_block_split_across_chunks(size):
+    text = "<think>先想一想用户要什么</think>\n\n你好呀～今天过得怎么样？"
+    assert run(split_every(text, size)) == "你好呀～今天过得怎么样？"
+
+
+def test_tags_split_at_every_position():
+    text = "开头<think>隐藏内容</think>结尾"
+    for cut in range(1, len(text)):
+        assert run([text[:cut], text[cut:]]) == "开头结尾"
+
+
+def test_partial_open_tag_that_is_not_a_tag_is_kept():
+    assert run(["a <thi", "nk about it"]) == "a <think about it"
+    assert run(["比较 1 <", " 2"]) == "比较 1 < 2"
+
+
+def test_unclosed_think_block_is_dropped():
+    assert run(["回复", "<think>没有结束的思考"]) == "回复"
+
+
+def test_multiple_think_blocks():
+    chunks = split_every("<think>a</think>第一句。<think>b</think>第二句。", 4)
+    assert run(chunks) == "第一句。第二句。"
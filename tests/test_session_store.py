@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""SessionStateStore：会话数有上限、闲置会话过期，随机人格切换作用于没有在处理消息的会话"""
+
+import asyncio
+
+import pytest
+
+import plugin
+from plugin import SessionStateStore
+
+
+@pytest.fixture(autouse=True)
+def personalities(monkeypatch):
+    monkeypatch.setattr(plugin, "PERSONALITIES", {"甲": {}, "乙": {}, "丙": {}})
+    monkeypatch.setattr(plugin, "PERSONA_MOOD", {"甲": "平静", "乙": "开心", "丙": "平静"})
+
+
+def test_least_recently_used_session_evicted(clock):
+    store = SessionStateStore(max_sessions=2, idle_expire=0)
+    store.switch_persona(("g1", "general"), "乙")
+    store.get(("g2", "general"), "甲")
+    # 访问g1后g2成为最久未访问的会话
+    store.get(("g1", "general"), "甲")
+    store.get(("g3", "general"), "甲")
+    stats = store.stats()
+    assert stats["session_count"] == 2 and stats["evicted"] == 1
+    assert store.get(("g1", "general"), "甲").persona_name == "乙"
+
+
+def test_idle_session_expires(clock):
+    store = SessionStateStore(idle_expire=60)
+    store.switch_persona(("g1", "general"), "乙")
+    clock.now += 30
+    assert store.get(("g1", "general"), "甲").persona_name == "乙"
+    clock.now += 61
+    # 其他会话的访问也会清理闲置过久的会话
+    store.get(("g2", "general"), "甲")
+    assert store.stats()["session_count"] == 1 and store.metrics["expired"] == 1
+    assert store.get(("g1", "general"), "甲").persona_name == "甲"
+
+
+def test_busy_session_is_not_evicted(clock):
+    store = SessionStateStore(max_sessions=1, idle_expire=0)
+
+    async def scenario():
+        store.switch_persona(("g1", "general"), "乙")
+        async with store.lock(("g1", "general")):
+            store.get(("g2", "general"), "甲")
+            return store.stats()["session_count"]
+
+    # g1正在处理消息，暂时超出上限也不淘汰它
+    assert asyncio.run(scenario()) == 2
+
+
+def test_random_switch_applies_to_idle_sessions(clock):
+    store = SessionStateStore()
+
+    async def scenario():
+        store.switch_persona(("g1", "general"), "甲")
+        store.switch_persona(("g2", "general"), "乙")
+        async with store.lock(("g2", "general")):
+            switched = store.switch_idle("丙")
+        return switched
+
+    assert asyncio.run(scenario()) == 1
+    assert store.get(("g1", "general"), "甲").persona_name == "丙"
+    assert store.get(("g2", "general"), "甲").persona_name == "乙"
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""SingleFlight：并发的相同请求（含流式请求）只调用一次；最后一个等待者离开后，新的调用不会加入正在取消的请求"""
+
+import asyncio
+
+import pytest
+
+from plugin import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "回复"
+
+    async def scenario():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("k", factory) for _ in range(5)))
+        return results, flight.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == ["回复"] * 5 and len(calls) == 1
+    assert stats == {"inflight": 0, "calls": 1, "coalesced": 4, "cancelled": 0}
+
+
+def test_caller_after_last_waiter_cancelled_starts_fresh_flight():
+    started = []
+
+    async def factory():
+        started.append(1)
+        try:
+            await asyncio.sleep(10 if len(started) == 1 else 0)
+        except asyncio.CancelledError:
+            # 模拟底层请求收到取消后还要一会儿才真正结束
+            await asyncio.sleep(0.05)
+            raise
+        return f"第{len(started)}次"
+
+    async def scenario():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("k", factory))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        # 第一次调用还在处理取消，新的调用应发起新请求而不是收到CancelledError
+        return await flight.do("k", factory), flight.stats()
+
+    result, stats = asyncio.run(scenario())
+    assert result == "第2次"
+    assert stats["calls"] == 2 and stats["coalesced"] == 0 and stats["cancelled"] == 1
+
+
+class FakeUpstream:
+    """模拟astream_reply：逐段产出，记录被调用和被关闭的次数"""
+
+    def __init__(self, chunks, delay=0.01, error=None):
+        self.chunks = chunks
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.closed = 0
+
+    async def generate(self):
+        self.calls += 1
+        try:
+            for chunk in self.chunks:
+                await asyncio.sleep(self.delay)
+                yield chunk
+            if self.error:
+                raise self.error
+        finally:
+            self.closed += 1
+
+
+async def consume(flight, key, upstream, delay=0):
+    await asyncio.sleep(delay)
+    return [chunk async for chunk in flight.stream(key, upstream.generate)]
+
+
+def test_concurrent_streams_share_one_upstream():
+    upstream = FakeUpstream(["你", "好", "呀"])
+
+    async def scenario():
+        flight = SingleFlight()
+        # 第二个调用方在上游已经产出分片后才加入，也要从头收到完整内容
+        results = await asyncio.gather(consume(flight, "k", upstream), consume(flight, "k", upstream, delay=0.015))
+        return results, flight.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == [["你", "好", "呀"]] * 2
+    assert upstream.calls == 1 and upstream.closed == 1
+    assert stats == {"inflight": 0, "calls": 1, "coalesced": 1, "cancelled": 0}
+
+
+def test_stream_error_reaches_every_subscriber():
+    upstream = FakeUpstream(["一"], error=ConnectionError("断开"))
+
+    async def scenario():
+        flight = SingleFlight()
+        return await asyncio.gather(consume(flight, "k", upstream), consume(flight, "k", upstream), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert upstream.calls == 1
+
+
+def test_upstream_closed_when_last_subscriber_leaves():
+    upstream = FakeUpstream(["一", "二", "三"], delay=0.05)
+
+    async def scenario():
+        flight = SingleFlight()
+        subscribers = [flight.stream("k", upstream.generate) for _ in range(2)]
+        for subscriber in subscribers:
+            assert await subscriber.__anext__() == "一"
+        await subscribers[0].aclose()
+        assert upstream.closed == 0
+        await subscribers[1].aclose()
+        await asyncio.sleep(0.01)
+        # 上游已取消并移出进行中表，新的调用重新发起
+        fresh = await consume(flight, "k", FakeUpstream(["新"]))
+        return fresh, flight.stats()
+
+    fresh, stats = asyncio.run(scenario())
+    assert upstream.closed == 1
+    assert fresh == ["新"]
+    assert stats["cancelled"] == 1 and stats["calls"] == 2
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""DynamicLLMClient._iter_stream_deltas：分片等待受消息时限约束，结束/放弃时关闭底层流"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from plugin import Deadline, DynamicLLMClient
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+class FakeAsyncStream:
+    def __init__(self, texts, delay):
+        self.texts = list(texts)
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.texts:
+            raise StopAsyncIteration
+        await asyncio.sleep(self.delay)
+        return chunk(self.texts.pop(0))
+
+    async def close(self):
+        self.closed = True
+
+
+def make_client(stream):
+    client = DynamicLLMClient({"model_type": "openai", "api_base": "http://127.0.0.1:9", "api_key": "test", "timeout": 10})
+    endpoint = client.endpoints[0]
+
+    async def create(**kwargs):
+        return stream
+
+    endpoint.async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    return client, endpoint
+
+
+def test_chunk_wait_is_bounded_by_deadline():
+    stream = FakeAsyncStream(["你好", "慢"], delay=0.3)
+    stream.texts.insert(0, "快")
+    client, endpoint = make_client(stream)
+
+    async def scenario():
+        received = []
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            async for delta in client._iter_stream_deltas(endpoint, [], Deadline(0.4)):
+                received.append(delta)
+        return received, time.monotonic() - start
+
+    received, elapsed = asyncio.run(scenario())
+    # 单次超时10秒，但消息时限只剩0.4秒，不应等满单次超时
+    assert received == ["快"]
+    assert elapsed < 1.5
+    assert stream.closed
+
+
+def test_stream_closed_when_consumer_stops_early():
+    stream = FakeAsyncStream(["一", "二", "三"], delay=0)
+    client, endpoint = make_client(stream)
+
+    async def scenario():
+        deltas = client._iter_stream_deltas(endpoint, [], Deadline(5))
+        async for delta in deltas:
+            break
+        await deltas.aclose()
+        return delta
+
+    assert asyncio.run(scenario()) == "一"
+    assert stream.closed
+
+
+def test_sync_stream_pump_stops_when_consumer_stops():
+    client, endpoint = make_client(None)
+    endpoint.async_client = None
+    produced = []
+    closed = threading.Event()
+
+    class SyncStream:
+        def __iter__(self):
+            for i in range(100):
+                produced.append(i)
+                time.sleep(0.01)
+                yield chunk(str(i))
+
+        def close(self):
+            closed.set()
+
+    client._create_completion = lambda endpoint, messages, stream=False: SyncStream()
+
+    async def scenario():
+        deltas = client._iter_stream_deltas(endpoint, [], Deadline(5))
+        async for delta in deltas:
+            break
+        await deltas.aclose()
+
+    asyncio.run(scenario())
+    assert closed.wait(1)
+    assert len(produced) < 100
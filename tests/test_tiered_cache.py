@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""TieredReplyCache：L1/L2两级查询、L2故障降级、节流标记（Lua脚本MGET及无脚本时的退化路径，L2使用fakeredis）"""
+
+import asyncio
+import json
+
+import fakeredis
+import pytest
+
+from plugin import LocalReplyCache, TieredReplyCache
+
+
+def make_cache(server=None, **kwargs):
+    client = fakeredis.aioredis.FakeRedis(server=server or fakeredis.FakeServer(), decode_responses=True)
+    return TieredReplyCache(client, LocalReplyCache(max_entries=100, shards=2), **kwargs)
+
+
+def test_l2_hit_is_promoted_to_l1():
+    async def scenario():
+        cache = make_cache()
+        await cache.client.set("k1", json.dumps("你好～"))
+        assert await cache.get("k1") == "你好～"
+        assert await cache.get("k1") == "你好～"
+        return cache.metrics
+
+    metrics = asyncio.run(scenario())
+    assert metrics["l2_hits"] == 1 and metrics["l2_round_trips"] == 1
+    assert metrics["l1_hits"] == 1
+
+
+def test_l2_miss_is_negatively_cached_in_l1():
+    async def scenario():
+        cache = make_cache(negative_ttl=60)
+        assert await cache.lookup(["k1", "k2"]) == [None, None]
+        assert await cache.lookup(["k1", "k2"]) == [None, None]
+        return cache.metrics
+
+    metrics = asyncio.run(scenario())
+    assert metrics["l2_round_trips"] == 1 and metrics["l2_misses"] == 2
+    assert metrics["l1_negative_hits"] == 2
+
+
+def test_set_writes_both_tiers_and_legacy_format_is_decoded():
+    async def scenario():
+        cache = make_cache()
+        await cache.set("k1", "回复", ttl=600)
+        stored = json.loads(await cache.client.get("k1"))
+        assert 0 < await cache.client.ttl("k1") <= 600
+        await cache.client.set("legacy", json.dumps({"reply": "旧回复", "time": 0}))
+        return stored, await cache.get("legacy")
+
+    stored, legacy = asyncio.run(scenario())
+    assert stored == "回复"
+    assert legacy == "旧回复"
+
+
+def test_l2_failure_falls_back_to_l1_until_retry_after():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        cache = make_cache(server, retry_after=60)
+        await cache.set("k1", "本地也有", ttl=600)
+        server.connected = False
+        first = await cache.lookup(["k1", "k2"])
+        second = await cache.lookup(["k2"])
+        await cache.set("k3", "只写L1", ttl=600)
+        return first, second, await cache.get("k3"), cache
+
+    first, second, third, cache = asyncio.run(scenario())
+    assert first == ["本地也有", None] and second == [None]
+    assert third == "只写L1"
+    # 第一次失败后进入降级期，之后的查询和写入都不再访问Redis
+    assert cache.metrics["l2_errors"] == 1
+    assert cache.stats()["l2_available"] is False
+
+
+@pytest.mark.parametrize("use_script", [True, False])
+def test_throttle_stamp_written_only_on_hit(use_script):
+    if use_script:
+        pytest.importorskip("lupa")
+
+    async def scenario():
+        cache = make_cache()
+        cache._use_script = use_script
+        await cache.client.set("shared", json.dumps("共享回复"))
+        hit = await cache.lookup(["user", "shared"], throttle_key="throttle:u1", throttle_index=1)
+        stamped = await cache.client.exists("throttle:u1")
+        ttl = await cache.client.ttl("throttle:u1")
+        miss = await cache.lookup(["user2", "shared2"], throttle_key="throttle:u2", throttle_index=1)
+        return hit, stamped, ttl, miss, await cache.client.exists("throttle:u2"), cache
+
+    hit, stamped, ttl, miss, stamped_on_miss, cache = asyncio.run(scenario())
+    assert hit == [None, "共享回复"]
+    assert stamped == 1 and 0 < ttl <= 180
+    assert miss == [None, None] and stamped_on_miss == 0
+    assert cache.metrics["l2_round_trips"] == 2
+    assert cache.stats()["l2_lua"] is use_script
+
+
+@pytest.mark.parametrize("use_script", [True, False])
+def test_concurrent_pool_appends_are_not_lost(use_script):
+    if use_script:
+        pytest.importorskip("lupa")
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        # 两个进程各自的客户端同时向同一个共享回复池追加
+        caches = [make_cache(server), make_cache(server)]
+        for cache in caches:
+            cache._use_script = use_script
+        replies = [f"回复{i}" for i in range(6)]
+        results = await asyncio.gather(*(caches[i % 2].append_to_pool("pool", reply, 4, 600) for i, reply in enumerate(replies)))
+        pool = json.loads(await caches[0].client.get("pool"))
+        duplicate = await caches[0].append_to_pool("pool", pool[0], 10, 600)
+        return results, pool, await caches[0].client.ttl("pool"), duplicate
+
+    results, pool, ttl, duplicate = asyncio.run(scenario())
+    appended = [reply for reply, result in zip([f"回复{i}" for i in range(6)], results) if result is not None]
+    # 追加成功的回复都还在池里（没有被并发写覆盖），池不超过容量也不重复
+    assert sorted(pool) == sorted(appended)
+    assert 0 < len(pool) <= 4 and len(set(pool)) == len(pool)
+    if use_script:
+        assert len(pool) == 4
+    assert 0 < ttl <= 600
+    assert duplicate is None
+
+
+def test_local_pool_append_under_shard_lock():
+    cache = LocalReplyCache(max_entries=100, shards=2)
+    assert cache.append_to_pool("pool", "甲", 2) == ["甲"]
+    assert cache.append_to_pool("pool", "甲", 2) is None
+    assert cache.append_to_pool("pool", "乙", 2) == ["甲", "乙"]
+    assert cache.append_to_pool("pool", "丙", 2) is None
+    assert cache.get("pool") == ["甲", "乙"]